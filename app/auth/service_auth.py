@@ -1,17 +1,24 @@
 import datetime
+import json
 import logging
 import os
+import re
+import threading
+import time
 import traceback
 
 import flask
 
 import google.auth
+import google.auth.credentials
+import google.auth.jwt
+import google.auth.transport
 from google.auth.transport import requests as grequests
 from google.oauth2 import id_token, credentials
 import googleapiclient.discovery
-from typing import Optional, NamedTuple
+from typing import Mapping, Optional, NamedTuple, Set
 
-from app.util.exceptions import BadPubSubTokenException
+from app.util.exceptions import AuthorizationException, BadPubSubTokenException
 
 
 IMPORT_SERVICE_SCOPES = [
@@ -50,7 +57,19 @@ class CachedCreds:
         return datetime.datetime.strptime(trunc_time, "%Y-%m-%dT%H:%M:%SZ")
 
 
+# Callers will refresh the import service SA creds themselves if they're within REQUEST_REFRESH_MARGIN of expiring.
+# The background refresher (see start_isvc_creds_refresher) refreshes them earlier than that, at
+# BACKGROUND_REFRESH_MARGIN, so in practice request threads should never have to wait on Google.
+REQUEST_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+BACKGROUND_REFRESH_MARGIN = datetime.timedelta(minutes=15)
+BACKGROUND_RETRY_SECONDS = 30
+
 _cached_isvc_creds: Optional[CachedCreds] = None
+# Held while refreshing, so that concurrent callers wait for one refresh instead of all asking Google at once.
+# This also serializes use of _iam_client, which (like all googleapiclient clients) isn't thread-safe.
+_isvc_creds_lock = threading.Lock()
+_iam_client = None
+_refresher_thread: Optional[threading.Thread] = None
 
 
 def get_isvc_credential() -> credentials.Credentials:
@@ -58,6 +77,21 @@ def get_isvc_credential() -> credentials.Credentials:
     return _get_isvc_cached_creds().creds
 
 
+class IsvcCredentials(google.auth.credentials.Credentials):
+    """Credentials for the import service SA that refresh themselves from our creds cache.
+    Use these for long-lived clients; the Credentials from get_isvc_credential can't refresh, so stop working after
+    an hour."""
+    def refresh(self, request) -> None:
+        cached = _get_isvc_cached_creds()
+        self.token = cached.creds.token
+        self.expiry = cached.expiry
+
+
+def get_isvc_refreshing_credential() -> IsvcCredentials:
+    """Get a Credentials object for the import service SA that's safe to keep around."""
+    return IsvcCredentials()
+
+
 def get_isvc_token() -> str:
     """Get an access token for the import service SA."""
     return _get_isvc_cached_creds().creds.token
@@ -65,11 +99,26 @@ def get_isvc_token() -> str:
 
 def _get_isvc_cached_creds() -> CachedCreds:
     """Use the cached creds if it still exists and we have at least 5 minutes until it expires."""
-    if _cached_isvc_creds is not None and \
-            _cached_isvc_creds.expiry > datetime.datetime.utcnow() + datetime.timedelta(minutes=5):
+    return _refresh_isvc_creds_if_expiring(REQUEST_REFRESH_MARGIN)
+
+
+def _creds_valid_for(creds: Optional[CachedCreds], margin: datetime.timedelta) -> bool:
+    return creds is not None and creds.expiry > datetime.datetime.utcnow() + margin
+
+
+def _refresh_isvc_creds_if_expiring(margin: datetime.timedelta) -> CachedCreds:
+    """Return the cached creds if they're good for at least margin, otherwise refresh them.
+    Only one thread refreshes at a time; anyone else who needs new creds waits and then uses the result."""
+    cached = _cached_isvc_creds
+    if _creds_valid_for(cached, margin):
         logging.debug("using cached creds for import service SA")
-        return _cached_isvc_creds
-    else:
+        return cached  # type: ignore
+
+    with _isvc_creds_lock:
+        # someone else may have refreshed the creds while we were waiting for the lock
+        cached = _cached_isvc_creds
+        if _creds_valid_for(cached, margin):
+            return cached  # type: ignore
         logging.info("generating new creds for import service SA")
         return _update_isvc_creds()
 
@@ -83,6 +132,44 @@ def _update_isvc_creds() -> CachedCreds:
     return _cached_isvc_creds
 
 
+def start_isvc_creds_refresher() -> None:
+    """Start a daemon thread that refreshes the import service SA creds before they get close to expiring.
+    Threads don't survive a fork, so this is safe to call again in a forked worker."""
+    global _refresher_thread
+    if _refresher_thread is not None and _refresher_thread.is_alive():
+        return
+    _refresher_thread = threading.Thread(target=_refresh_isvc_creds_loop, name="isvc-creds-refresher", daemon=True)
+    _refresher_thread.start()
+
+
+def _refresh_isvc_creds_loop() -> None:
+    while True:
+        time.sleep(_refresh_isvc_creds_in_background())
+
+
+def _refresh_isvc_creds_in_background() -> float:
+    """Refresh the creds if they're within BACKGROUND_REFRESH_MARGIN of expiring.
+    Returns the number of seconds to wait before we next need to do this."""
+    try:
+        creds = _refresh_isvc_creds_if_expiring(BACKGROUND_REFRESH_MARGIN)
+    except Exception:
+        # Catch-all so the refresher thread never dies. Request threads will refresh the creds themselves if need be.
+        logging.warning(f"Failed to refresh creds for import service SA in background:\n{traceback.format_exc()}")
+        return BACKGROUND_RETRY_SECONDS
+
+    next_refresh = creds.expiry - BACKGROUND_REFRESH_MARGIN - datetime.datetime.utcnow()
+    return max(next_refresh.total_seconds(), 1)
+
+
+def _get_iam_client():
+    """Building the iamcredentials client is slow, so we only do it once. Callers must hold _isvc_creds_lock."""
+    global _iam_client
+    if _iam_client is None:
+        credentials, project = google.auth.default()
+        _iam_client = googleapiclient.discovery.build('iamcredentials', 'v1', credentials=credentials)
+    return _iam_client
+
+
 def _get_isvc_token_from_google() -> dict:
     # create service account name
     email = os.environ.get('IMPORT_SVC_SA_EMAIL')
@@ -93,15 +180,161 @@ def _get_isvc_token_from_google() -> dict:
         'scope': IMPORT_SERVICE_SCOPES
     }
 
-    credentials, project = google.auth.default()
-    iam = googleapiclient.discovery.build('iamcredentials', 'v1', credentials=credentials)
-
-    return iam.projects().serviceAccounts().generateAccessToken(
+    return _get_iam_client().projects().serviceAccounts().generateAccessToken(
         name=name,
         body=body,
     ).execute()
 
 
+GOOGLE_OAUTH2_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+# Used if the certs endpoint doesn't tell us how long to cache its response for.
+CERTS_DEFAULT_MAX_AGE_SECONDS = 300
+# Once cached certs pass their max-age we keep using them while we fetch new ones in the background, but only for so long.
+CERTS_MAX_STALE_SECONDS = 3600
+# Tokens signed with a key we don't know trigger a refetch, but no more often than this, so bad tokens can't make us
+# hammer Google.
+CERTS_MIN_FORCED_REFRESH_SECONDS = 60
+# After a failed fetch we don't try again for this long, so an outage at Google doesn't turn every push into a request.
+CERTS_FAILURE_BACKOFF_SECONDS = 30
+
+
+class CachedCertsResponse(google.auth.transport.Response):
+    def __init__(self, status: int, headers: Mapping[str, str], data: bytes):
+        self._status = status
+        self._headers = headers
+        self._data = data
+
+    @property
+    def status(self):
+        return self._status
+
+    @property
+    def headers(self):
+        return self._headers
+
+    @property
+    def data(self):
+        return self._data
+
+
+class CachedCerts(google.auth.transport.Request):
+    """A google.auth transport that serves Google's public signing certs from a cache, honouring the max-age in the
+    cert endpoint's Cache-Control header. Once the certs go stale we keep serving them while a background thread
+    fetches new ones. Requests for any other URL are passed through uncached."""
+    def __init__(self, certs_url: str = GOOGLE_OAUTH2_CERTS_URL):
+        self.certs_url = certs_url
+        self._response: Optional[CachedCertsResponse] = None
+        self._key_ids: Set[str] = set()
+        self._fetched_at = 0.0
+        self._expires_at = 0.0
+        self._retry_at = 0.0  # when we may fetch again after a failure
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def __call__(self, url, method="GET", body=None, headers=None, timeout=None, **kwargs):
+        if url != self.certs_url or method != "GET":
+            return grequests.Request()(url, method=method, body=body, headers=headers, timeout=timeout, **kwargs)
+        return self.get()
+
+    def get(self) -> CachedCertsResponse:
+        response = self._response
+        now = time.monotonic()
+        if response is not None:
+            if now < self._expires_at:
+                return response
+            if now < self._expires_at + CERTS_MAX_STALE_SECONDS:
+                if now >= self._retry_at:
+                    self._refresh_in_background()
+                return response
+
+        with self._lock:
+            # someone else may have fetched the certs while we were waiting for the lock
+            if self._response is not None and time.monotonic() < self._expires_at:
+                return self._response
+            if time.monotonic() < self._retry_at:
+                # we just failed to fetch them; verifying the token fails just as it would if we'd tried again
+                return CachedCertsResponse(503, {}, b"")
+            return self._fetch()
+
+    def refresh_if_unknown_key(self, key_id: Optional[str]) -> bool:
+        """If we don't have a cert for this key id, refetch the certs, since Google may have rotated them.
+        Returns True if we refetched."""
+        if key_id is None or key_id in self._key_ids:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if key_id in self._key_ids or now - self._fetched_at < CERTS_MIN_FORCED_REFRESH_SECONDS \
+                    or now < self._retry_at:
+                return False
+            logging.info(f"Refetching Google certs for unknown key id {key_id}")
+            self._fetch()
+            return True
+
+    def _refresh_in_background(self) -> None:
+        # unlocked check, so we never make a request wait. if two threads race here, the second refresh is a no-op.
+        if self._refreshing:
+            return
+        self._refreshing = True
+        threading.Thread(target=self._background_refresh, name="google-certs-refresher", daemon=True).start()
+
+    def _background_refresh(self) -> None:
+        try:
+            with self._lock:
+                if time.monotonic() >= max(self._expires_at, self._retry_at):
+                    self._fetch()
+        except Exception:
+            # we'll carry on using the stale certs and try again on the next request
+            logging.warning(f"Failed to refresh Google certs in background:\n{traceback.format_exc()}")
+        finally:
+            self._refreshing = False
+
+    def _fetch(self) -> CachedCertsResponse:
+        """Fetch the certs and cache them if it worked, or back off for CERTS_FAILURE_BACKOFF_SECONDS if it didn't.
+        Callers must hold self._lock."""
+        try:
+            raw = grequests.Request()(self.certs_url, method="GET")
+        except Exception:
+            self._retry_at = time.monotonic() + CERTS_FAILURE_BACKOFF_SECONDS
+            raise
+        response = CachedCertsResponse(raw.status, raw.headers, raw.data)
+        if response.status != 200:
+            logging.warning(f"Fetching Google certs failed with status {response.status}")
+            self._retry_at = time.monotonic() + CERTS_FAILURE_BACKOFF_SECONDS
+            return response
+
+        now = time.monotonic()
+        self._response = response
+        self._key_ids = set(json.loads(response.data.decode("utf-8")).keys())
+        self._fetched_at = now
+        self._expires_at = now + self._max_age_seconds(response.headers)
+        return response
+
+    @classmethod
+    def _max_age_seconds(cls, headers: Mapping[str, str]) -> int:
+        """How long we can cache a response for, per its Cache-Control and Age headers."""
+        cache_control = next((v for k, v in headers.items() if k.lower() == "cache-control"), "")
+        age = next((v for k, v in headers.items() if k.lower() == "age"), "0")
+        max_age = re.search(r"max-age=(\d+)", cache_control)
+        if max_age is None:
+            return CERTS_DEFAULT_MAX_AGE_SECONDS
+        return max(int(max_age.group(1)) - (int(age) if age.isdigit() else 0), 0)
+
+
+_google_certs = CachedCerts()
+
+
+def _verify_oauth2_token(token: str, audience: Optional[str]) -> dict:
+    """Verify a Google-signed ID token using our cached copy of Google's certs."""
+    try:
+        return id_token.verify_oauth2_token(token, _google_certs, audience=audience)
+    except ValueError:
+        # Google may have rotated its keys since we cached them. If the token was signed with a key we haven't seen,
+        # refetch the certs and try again.
+        if not _google_certs.refresh_if_unknown_key(google.auth.jwt.decode_header(token).get("kid")):
+            raise
+        return id_token.verify_oauth2_token(token, _google_certs, audience=audience)
+
+
 def verify_pubsub_jwt(request: flask.Request) -> None:
     """Verify that this request came from Cloud Pub/Sub.
     This looks for a secret token in a queryparam, then decodes the Bearer token
@@ -116,8 +349,7 @@ def verify_pubsub_jwt(request: flask.Request) -> None:
     token = bearer_token.split(' ', maxsplit=1)[1]
 
     try:
-        claim = id_token.verify_oauth2_token(token, grequests.Request(),
-                                             audience=os.environ.get('PUBSUB_AUDIENCE'))
+        claim = _verify_oauth2_token(token, audience=os.environ.get('PUBSUB_AUDIENCE'))
         if claim['iss'] not in [
             'accounts.google.com',
             'https://accounts.google.com'
@@ -132,4 +364,22 @@ def verify_pubsub_jwt(request: flask.Request) -> None:
     except Exception as e:
         # eats all exceptions, including ones thrown by verify_oauth2_token if e.g. audience is wrong
         logging.info(traceback.format_exc())
-        raise BadPubSubTokenException()
\ No newline at end of file
+        raise BadPubSubTokenException()
+
+
+def verify_operator(request: flask.Request) -> None:
+    """Verify that this request came from the import service itself or one of the Google accounts in the comma-separated
+    OPERATOR_EMAILS, by checking the Google ID token in its Authorization header. For endpoints that aren't for users,
+    like /metrics; get a token with `gcloud auth print-identity-token`."""
+    emails = [os.environ.get('IMPORT_SVC_SA_EMAIL', '')] + os.environ.get('OPERATOR_EMAILS', '').split(',')
+    allowed = {email.strip() for email in emails if email.strip()}
+    try:
+        token = request.headers.get('Authorization', '').split(' ', maxsplit=1)[1]
+        claim = _verify_oauth2_token(token, audience=None)
+        if claim['iss'] not in ['accounts.google.com', 'https://accounts.google.com'] \
+                or not claim.get('email_verified') or claim['email'] not in allowed:
+            raise AuthorizationException()
+    except Exception:
+        # as above, don't tell the caller which part was wrong
+        logging.info(traceback.format_exc())
+        raise AuthorizationException()
@@ -4,7 +4,7 @@ import flask
 import logging
 
 from app.util.exceptions import AuthorizationException
-from app.external import rawls
+from app.external import rawls, sam
 from app.external.rawls import RawlsWorkspaceResponse
 
 
@@ -21,8 +21,21 @@ def extract_auth_token(request: flask.Request) -> str:
 
 def workspace_uuid_and_project_with_auth(workspace_ns: str, workspace_name: str, bearer_token: str, sam_action: str = "read") -> RawlsWorkspaceResponse:
     """Checks Rawls to get the workspace UUID, and then checks Sam to see if the user has the given action on the workspace resource.
-    If so, returns the workspace UUID."""
-    uuid_and_project = rawls.get_rawls_workspace_info(workspace_ns, workspace_name, bearer_token)
+    If so, returns the workspace UUID.
+    Workspace info is cached across users, so on a cache hit we only ask about the user's permission."""
+    uuid_and_project = rawls.get_cached_workspace_info(workspace_ns, workspace_name)
+
+    if uuid_and_project is not None and sam_action == "read":
+        if _user_can_read_workspace(uuid_and_project.workspace_id, bearer_token):
+            return uuid_and_project
+        # either the user can't see the workspace, or it's been deleted (and maybe recreated) since we cached it.
+        # fall through to Rawls, which will return the right answer or error in both cases.
+        rawls.invalidate_workspace_info(workspace_ns, workspace_name)
+        uuid_and_project = None
+
+    if uuid_and_project is None:
+        uuid_and_project = rawls.get_rawls_workspace_info(workspace_ns, workspace_name, bearer_token)
+        rawls.cache_workspace_info(workspace_ns, workspace_name, uuid_and_project)
 
     # the read check is done when you ask rawls for the workspace UUID, so don't redo it
     if sam_action != "read" and not rawls.check_workspace_iam_action(workspace_ns, workspace_name, sam_action, bearer_token):
@@ -31,3 +44,12 @@ def workspace_uuid_and_project_with_auth(workspace_ns: str, workspace_name: str,
         raise AuthorizationException(f"Cannot perform the action {sam_action} on {workspace_ns}/{workspace_name}.")
 
     return uuid_and_project
+
+
+def _user_can_read_workspace(workspace_id: str, bearer_token: str) -> bool:
+    """Asks Sam whether the user can read the workspace. Any error is treated as a no."""
+    try:
+        return sam.get_user_action_on_resource(sam.WORKSPACE_RESOURCE, workspace_id, "read", bearer_token)
+    except Exception:
+        logging.info(f"Sam read check failed for workspace {workspace_id}, falling back to Rawls", exc_info=True)
+        return False
@@ -1,16 +1,139 @@
-from app.db import db, model
 import logging
+import os
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+from typing import Optional
+
+from app import outbox, translate
+from app.db import db, model
+
+# Most stalled imports we time out in one UPDATE, and how many of those we'll run per cleanup. Anything left over gets
+# picked up by the next cleanup, so a big backlog after an outage never turns into one long, lock-heavy transaction.
+CLEANUP_BATCH_SIZE = int(os.environ.get("CLEANUP_BATCH_SIZE", "500"))
+CLEANUP_MAX_BATCHES = int(os.environ.get("CLEANUP_MAX_BATCHES", "10"))
+
+# Finished imports submitted more than this many days ago get moved to the archive table, to keep the imports table
+# (and its indexes) down to roughly the imports that are running or recently finished. 0 turns archiving off.
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "30"))
+# Status transitions older than this many days are deleted. They're only for app/stats.py, which looks back at most
+# stats.MAX_WINDOW, plus however long the imports in that window had been running.
+TRANSITION_RETENTION_DAYS = int(os.environ.get("TRANSITION_RETENTION_DAYS", "30"))
+# How often each running instance looks for translations whose lease ran out (see start_translation_recovery).
+RECOVERY_INTERVAL_SECONDS = float(os.environ.get("TRANSLATION_RECOVERY_INTERVAL_SECONDS", "120"))
+
+_recovery_thread: Optional[threading.Thread] = None
 
-from app.db.model import Import, ImportStatus
 
+def clean_up_stale_imports(job_age_hours: int) -> list[str]:
+    """Time out imports that still aren't in a terminal state after job_age_hours. Returns the ids we timed out."""
+    timed_out: list[str] = []
+    for _ in range(CLEANUP_MAX_BATCHES):
+        # a short transaction per batch, so we don't hold locks on the whole backlog at once
+        with db.session_ctx() as sess:
+            batch = model.Import.time_out_stalled_imports(sess, job_age_hours, CLEANUP_BATCH_SIZE)
+        timed_out += batch
+        if len(batch) < CLEANUP_BATCH_SIZE:
+            break
+    else:
+        logging.warning(f"Timed out the maximum of {CLEANUP_MAX_BATCHES * CLEANUP_BATCH_SIZE} stalled imports; "
+                        f"the next cleanup will get the rest")
 
-def clean_up_stale_imports(job_age_hours: int):
+    if timed_out:
+        logging.warning(f"Timed out {len(timed_out)} imports that weren't in a terminal state after {job_age_hours} "
+                        f"hours: {', '.join(timed_out)}")
+    return timed_out
+
+
+def recover_stalled_translations() -> tuple[list[str], list[str]]:
+    """Requeue translations whose lease has run out, or error them if they've had translate.MAX_TRANSLATION_ATTEMPTS.
+    Returns the ids of (requeued, errored) imports.
+    A redelivered translate message takes over an import with an expired lease by itself (see translate.handle); this
+    is for when there isn't one."""
     with db.session_ctx() as sess:
-        stuck_jobs = model.Import.get_stalled_imports(sess, job_age_hours)
-        if len(stuck_jobs) > 0:
-            logging.warning(f"We have {len(stuck_jobs)} imports that aren't in a terminal state "
-                            f"after {job_age_hours} hours")
-        for job in stuck_jobs:
-            logging.warning(f"Job id {job.id} was submitted {job.submit_time}, has status {job.status} "
-                            f"and is more than {job_age_hours} hours old")
-            Import.update_status_exclusively(job.id, job.status, ImportStatus.TimedOut, sess)
+        requeued, errored = model.Import.recover_stalled_translations(sess, translate.MAX_TRANSLATION_ATTEMPTS,
+                                                                      CLEANUP_BATCH_SIZE)
+        for import_id in requeued:
+            outbox.enqueue(sess, outbox.SELF, {"action": "translate", "import_id": import_id})
+
+    if requeued:
+        logging.warning(f"Requeued {len(requeued)} translations whose lease ran out: {', '.join(requeued)}")
+        outbox.relay_soon()
+    if errored:
+        logging.warning(f"Gave up on {len(errored)} translations whose lease ran out "
+                        f"{translate.MAX_TRANSLATION_ATTEMPTS} times: {', '.join(errored)}")
+    return requeued, errored
+
+
+def start_translation_recovery() -> None:
+    """Start a daemon thread that runs recover_stalled_translations every RECOVERY_INTERVAL_SECONDS. Doing it on the
+    instances that are up anyway means a dead translation gets requeued within minutes, without a frequent cron that
+    would keep an instance running around the clock; the cron only has to catch up after every instance went away."""
+    global _recovery_thread
+    if _recovery_thread is not None and _recovery_thread.is_alive():
+        return
+    _recovery_thread = threading.Thread(target=_recovery_loop, name="translation-recovery", daemon=True)
+    _recovery_thread.start()
+
+
+def _recovery_loop() -> None:
+    while True:
+        time.sleep(RECOVERY_INTERVAL_SECONDS)
+        try:
+            recover_stalled_translations()
+        except Exception:
+            # Catch-all so the thread never dies. The stalled translations will still be there next time.
+            logging.error(f"Exception in translation recovery thread:\n{traceback.format_exc()}")
+
+
+def archive_terminal_imports() -> int:
+    """Move finished imports older than ARCHIVE_AFTER_DAYS to the archive, in batches like clean_up_stale_imports.
+    Returns how many we moved."""
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return 0
+    submitted_before = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    archived = 0
+    for _ in range(CLEANUP_MAX_BATCHES):
+        with db.session_ctx() as sess:
+            batch = model.ArchivedImport.archive_terminal_imports(sess, submitted_before, CLEANUP_BATCH_SIZE)
+        archived += len(batch)
+        if len(batch) < CLEANUP_BATCH_SIZE:
+            break
+
+    if archived:
+        logging.info(f"Archived {archived} imports that finished before {submitted_before}")
+    return archived
+
+
+def purge_staged_manifests() -> int:
+    """Delete staged TDR manifests of imports that won't be translated now, e.g. because they errored or timed out.
+    Translation deletes the manifest itself when it succeeds. Returns how many we deleted."""
+    purged = 0
+    for _ in range(CLEANUP_MAX_BATCHES):
+        with db.session_ctx() as sess:
+            batch = model.StagedTDRManifest.purge_unneeded(sess, CLEANUP_BATCH_SIZE)
+        purged += batch
+        if batch < CLEANUP_BATCH_SIZE:
+            break
+
+    if purged:
+        logging.info(f"Deleted {purged} staged TDR manifests of imports that are no longer being translated")
+    return purged
+
+
+def purge_old_transitions() -> int:
+    """Delete status transitions older than TRANSITION_RETENTION_DAYS, in batches like clean_up_stale_imports.
+    Returns how many we deleted."""
+    before = datetime.now() - timedelta(days=TRANSITION_RETENTION_DAYS)
+    purged = 0
+    for _ in range(CLEANUP_MAX_BATCHES):
+        with db.session_ctx() as sess:
+            batch = model.ImportStatusTransition.purge_older_than(sess, before, CLEANUP_BATCH_SIZE)
+        purged += batch
+        if batch < CLEANUP_BATCH_SIZE:
+            break
+
+    if purged:
+        logging.info(f"Deleted {purged} status transitions from before {before}")
+    return purged
@@ -1,35 +1,67 @@
 import os
 import logging
 from contextlib import contextmanager
-from typing import Iterator
+from typing import Iterator, Optional
 
 import sqlalchemy.engine.url
+import sqlalchemy.event
 import sqlalchemy.orm
 
+from app.util import metrics
+
 DBSession = sqlalchemy.orm.session.Session
 
 db_connection_name = os.environ.get("CLOUD_SQL_CONNECTION_NAME")
+# Optional read replica. Read-only sessions (status reads, mostly) go here if it's set, so users polling for status
+# don't compete with the writes that drive imports along. Unset means everything goes to the primary.
+db_replica_connection_name = os.environ.get("CLOUD_SQL_REPLICA_CONNECTION_NAME")
+# How far behind the primary we expect the replica might be. Reads that need to see writes more recent than this
+# should go to the primary.
+REPLICA_MAX_LAG_SECONDS = int(os.environ.get("DB_REPLICA_MAX_LAG_SECONDS", "30"))
+
+# Connection pool settings. Each thread that's using the db (request threads, pub/sub pull handlers, the outbox relay)
+# holds a connection while it does, so the pool needs to be big enough for them not to queue behind each other.
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+POOL_MAX_OVERFLOW = int(os.environ.get("DB_POOL_MAX_OVERFLOW", "0"))
+POOL_TIMEOUT_SECONDS = int(os.environ.get("DB_POOL_TIMEOUT_SECONDS", "30"))
+# Close connections older than this, so the db (or the Cloud SQL proxy) never gets to time them out first. -1 = never.
+POOL_RECYCLE_SECONDS = int(os.environ.get("DB_POOL_RECYCLE_SECONDS", "1800"))
+# Before doing things, send a "ping" request to the db to make sure the connection didn't drop. This costs a round trip
+# every time a connection is checked out; with POOL_RECYCLE_SECONDS set it's reasonably safe to turn it off.
+POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
 
 # Store the db so it can be reused between GAE invocations.
 _db = None
 _sessionmaker = None
+_replica_db = None
+_replica_sessionmaker = None
+
 
+def has_replica() -> bool:
+    return _replica_db is not None or db_replica_connection_name is not None
 
-def get_session() -> DBSession:
+
+def get_session(read_only: bool = False) -> DBSession:
+    """A session on the primary, or on the replica if read_only and there is one."""
     global _db
     global _sessionmaker
+    global _replica_db
+    global _replica_sessionmaker
+
+    if read_only and has_replica():
+        if _replica_db is None:
+            _replica_db = _create_engine(db_replica_connection_name, "db.replica_pool")
+        if _replica_sessionmaker is None:
+            _replica_sessionmaker = sqlalchemy.orm.sessionmaker(bind=_replica_db, expire_on_commit=False)
+        return _replica_sessionmaker()
 
     if _db is None:
-        _db = sqlalchemy.create_engine(
-            db_connection_name,
-            pool_size=1,
-            max_overflow=0,
-            pool_pre_ping=True  # before doing things, send a "ping" request to the db to make sure the connection didn't drop
-        )
+        engine = _create_engine(db_connection_name, "db.pool")
 
-        from app.db import model
-        logging.info("Creating new database tables...")
-        model.Base.metadata.create_all(_db)
+        from app.db import schema
+        schema.bootstrap(engine)
+        # only once bootstrapping worked, so if it didn't, the next session tries again
+        _db = engine
 
     if _sessionmaker is None:
         # NOTE on the use of expire_on_commit = False here.
@@ -43,14 +75,45 @@ def get_session() -> DBSession:
     return _sessionmaker()
 
 
+def _create_engine(connection_name: Optional[str], metrics_prefix: str) -> sqlalchemy.engine.Engine:
+    if connection_name is None:
+        raise RuntimeError(f"No database connection name set for {metrics_prefix}; "
+                           f"see CLOUD_SQL_CONNECTION_NAME and CLOUD_SQL_REPLICA_CONNECTION_NAME")
+    engine = sqlalchemy.create_engine(
+        connection_name,
+        pool_size=POOL_SIZE,
+        max_overflow=POOL_MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT_SECONDS,
+        pool_recycle=POOL_RECYCLE_SECONDS,
+        pool_pre_ping=POOL_PRE_PING
+    )
+    _instrument_pool(engine, metrics_prefix)
+    return engine
+
+
+def _instrument_pool(engine: sqlalchemy.engine.Engine, prefix: str) -> None:
+    sqlalchemy.event.listen(engine, "checkout", lambda *args: metrics.increment(f"{prefix}.checkouts"))
+    sqlalchemy.event.listen(engine, "connect", lambda *args: metrics.increment(f"{prefix}.connections_opened"))
+
+
 @contextmanager
-def session_ctx() -> Iterator[DBSession]:
-    """Provide a transactional scope around a series of operations."""
-    session = get_session()
+def session_ctx(read_only: bool = False) -> Iterator[DBSession]:
+    """Provide a transactional scope around a series of operations.
+    read_only sessions go to the replica if there is one, and never commit. Bear in mind the replica can be up to
+    REPLICA_MAX_LAG_SECONDS behind."""
+    session = get_session(read_only)
     try:
+        # get a connection up front, so we can measure how long we wait for one
+        with metrics.timed("db.replica_pool.checkout_wait" if read_only and has_replica() else "db.pool.checkout_wait"):
+            session.connection()
         yield session
-        session.commit()
-        session.expunge_all()  # see above NOTE in get_session.
+        if read_only:
+            # nothing to commit. Detach first, as rolling back would expire everything we loaded.
+            session.expunge_all()
+            session.rollback()
+        else:
+            session.commit()
+            session.expunge_all()  # see above NOTE in get_session.
     except:
         session.rollback()
         raise
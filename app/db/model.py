@@ -3,14 +3,16 @@ from __future__ import annotations
 import enum
 import logging
 import uuid
+import zlib
 from datetime import datetime, timedelta
-from typing import Optional, Dict
+from typing import Any, Dict, Optional
 
 from flask_restx import fields
-from sqlalchemy import Column, DateTime, String
-from sqlalchemy.orm import validates
+from sqlalchemy import Column, DateTime, Index, Integer, LargeBinary, String, Text, and_, literal, or_, select
+from sqlalchemy.orm import object_session, validates
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.schema import Table
+from sqlalchemy.sql import ClauseElement
 from sqlalchemy.sql.sqltypes import Boolean
 from sqlalchemy_repr import RepresentableBase
 
@@ -18,6 +20,9 @@ from app.db import DBSession
 
 Base = declarative_base(cls=RepresentableBase)  # sqlalchemy magic base class.
 
+# session.info key for the ids of imports whose status changed in the session's transaction
+STATUS_CHANGED_KEY = "changed_import_ids"
+
 
 class ImportServiceTable:
     """sqlalchemy's declarative_base() function constructs a base class for declarative class definitions -- in this
@@ -96,7 +101,7 @@ ModelDefinition = Dict[str, Type[fields.Raw]]
 # Note: this should really be a namedtuple but for https://github.com/noirbizarre/flask-restplus/issues/364
 # This is an easy fix in flask-restx if we decide to go this route.
 class ImportStatusResponse:
-    def __init__(self, jobId: str, status: str, filetype: str, message: Optional[str]):
+    def __init__(self, jobId: str, status: str, filetype: Optional[str], message: Optional[str]):
         self.jobId = jobId
         self.status = status
         self.filetype = filetype
@@ -110,9 +115,17 @@ class ImportStatusResponse:
             "filetype": fields.String,
             "message": fields.String}
 
+    def to_dict(self) -> Dict[str, str]:
+        """What marshalling with get_model() and skip_none=True gives you, without flask-restx's per-field machinery,
+        which adds up when listing thousands of imports."""
+        return {name: str(value) for name, value in
+                (("jobId", self.jobId), ("status", self.status), ("filetype", self.filetype), ("message", self.message))
+                if value is not None}
 
-class Import(ImportServiceTable, EqMixin, Base):
-    __tablename__ = 'imports'
+
+class ImportColumns:
+    """The columns of an import, shared by the imports table and its archive."""
+    MAX_ERROR_MESSAGE_LENGTH = 2048
 
     id = Column(String(36), primary_key=True)
     workspace_name = Column(String(254), nullable=False)
@@ -124,10 +137,48 @@ class Import(ImportServiceTable, EqMixin, Base):
     submit_time = Column(DateTime, nullable=False)
     status = Column(Enum(ImportStatus), nullable=False)
     filetype = Column(String(10), nullable=False)
-    error_message = Column(String(2048), nullable=True)
+    error_message = Column(String(MAX_ERROR_MESSAGE_LENGTH), nullable=True)
     is_upsert = Column(Boolean, nullable=False, default=True)
     snapshot_id = Column(String(100), nullable=True)
     is_tdr_sync_required = Column(Boolean, nullable=True, default=False)
+    # last time whoever is translating this import renewed their lease
+    heartbeat_time = Column(DateTime, nullable=True)
+    # how many times we've started translating this import
+    translation_attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    # the translation lease: who's translating this import, and until when. If the lease runs out, someone else may
+    # take the import over; the owner only gets to finish if it still holds the lease.
+    lease_owner = Column(String(255), nullable=True)
+    lease_expires = Column(DateTime, nullable=True)
+    # a hash of the workspace, submitter and Idempotency-Key header the import was submitted with, if any
+    idempotency_key = Column(String(64), nullable=True)
+
+    def to_status_response(self) -> ImportStatusResponse:
+        return ImportStatusResponse(self.id, self.status.name, self.filetype, self.error_message)
+
+    @classmethod
+    def status_response_columns(cls) -> tuple:
+        """Just the columns to_status_response() needs. Query these instead of whole Imports to skip loading import_url
+        and hydrating ORM objects; turn the rows into responses with status_response_from_row()."""
+        return cls.id, cls.status, cls.filetype, cls.error_message
+
+    @classmethod
+    def status_response_from_row(cls, row) -> ImportStatusResponse:
+        return ImportStatusResponse(row.id, row.status.name, row.filetype, row.error_message)
+
+
+class Import(ImportServiceTable, ImportColumns, EqMixin, Base):
+    __tablename__ = 'imports'
+    __table_args__ = (
+        # listing a workspace's imports, newest first
+        Index('ix_imports_workspace_submit_time', 'workspace_namespace', 'workspace_name', 'submit_time'),
+        # listing a workspace's running imports; with filetype, it also covers the summary's GROUP BY on its own
+        Index('ix_imports_workspace_status_submit_time_filetype',
+              'workspace_namespace', 'workspace_name', 'status', 'submit_time', 'filetype'),
+        # finding stalled imports across all workspaces
+        Index('ix_imports_status_submit_time', 'status', 'submit_time'),
+        # one import per idempotency key, and finding it again
+        Index('ix_imports_idempotency_key', 'idempotency_key', unique=True),
+    )
 
     SNAPSHOT_FIELD_NAME = 'snapshot_id'
 
@@ -156,6 +207,11 @@ class Import(ImportServiceTable, EqMixin, Base):
         self.is_upsert = is_upsert
         self.snapshot_id = None
         self.is_tdr_sync_required = is_tdr_sync_required
+        self.heartbeat_time = None
+        self.translation_attempts = 0
+        self.lease_owner = None
+        self.lease_expires = None
+        self.idempotency_key = None
 
     @classmethod
     def get(cls, import_id: str, sess: DBSession) -> Import:
@@ -163,13 +219,108 @@ class Import(ImportServiceTable, EqMixin, Base):
         return sess.query(Import).filter(Import.id == import_id).one()
 
     @classmethod
-    def get_stalled_imports(cls, sess: DBSession, job_age_hours: int) -> list[Import]:
-        """Retrieve those jobs still in a 'transient/processing' state after more than 36 hours."""
-        return sess.query(Import).filter(Import.status.notin_(ImportStatus.terminal_statuses()),
-                                         # don't put the db in a different tz and start setting the submit_time using
-                                         # db functions, in which case this might no longer measure job_age_hours
-                                         # hours since submission
-                                         Import.submit_time < datetime.now() - timedelta(hours=job_age_hours)).all()
+    def time_out_stalled_imports(cls, sess: DBSession, job_age_hours: int, limit: int) -> list[str]:
+        """Move up to limit stalled imports to TimedOut with one conditional UPDATE, and return the ids that moved.
+        The UPDATE re-checks the status, so an import that reached a terminal status since we looked stays put."""
+        stalled = [Import.status.notin_(ImportStatus.terminal_statuses()),
+                   Import.submit_time < datetime.now() - timedelta(hours=job_age_hours)]
+        candidate_ids = [row[0] for row in sess.query(Import.id).filter(*stalled).limit(limit)]
+        if not candidate_ids:
+            return []
+
+        sess.execute(Import.__table__.update()
+                     .where(Import.id.in_(candidate_ids), *stalled)
+                     .values(status=ImportStatus.TimedOut))
+        # nothing else sets TimedOut, so these are the ones we just moved
+        timed_out = [row[0] for row in sess.query(Import.id)
+                     .filter(Import.id.in_(candidate_ids), Import.status == ImportStatus.TimedOut)]
+        if timed_out:
+            ImportStatusTransition.record(sess, ImportStatus.TimedOut, timed_out)
+        return timed_out
+
+    @classmethod
+    def start_translating(cls, import_id: str, owner: str, lease_seconds: int, max_attempts: int,
+                          sess: DBSession) -> bool:
+        """Take the translation lease on an import that's Pending, or that's Translating but whose lease has run out
+        (i.e. whoever was translating it has most likely died) and hasn't had max_attempts yet.
+        Returns False if we can't have it."""
+        now = datetime.now()
+        update = Import.__table__.update() \
+            .where(Import.id == import_id) \
+            .where(or_(Import.status == ImportStatus.Pending,
+                       and_(Import.status == ImportStatus.Translating, Import.lease_expires < now,
+                            Import.translation_attempts < max_attempts))) \
+            .values(status=ImportStatus.Translating, lease_owner=owner, lease_expires=now + timedelta(seconds=lease_seconds),
+                    heartbeat_time=now, translation_attempts=Import.translation_attempts + 1)
+        return cls._recorded(sess, import_id, ImportStatus.Translating, sess.execute(update).rowcount > 0)
+
+    @classmethod
+    def renew_lease(cls, import_id: str, owner: str, lease_seconds: int, sess: DBSession) -> bool:
+        """Extend owner's translation lease. Returns False if owner has lost it, i.e. the import has been taken over,
+        requeued or errored since."""
+        now = datetime.now()
+        update = Import.__table__.update() \
+            .where(Import.id == import_id) \
+            .where(Import.status == ImportStatus.Translating) \
+            .where(Import.lease_owner == owner) \
+            .values(heartbeat_time=now, lease_expires=now + timedelta(seconds=lease_seconds))
+        return sess.execute(update).rowcount > 0
+
+    @classmethod
+    def finish_translating(cls, import_id: str, owner: str, sess: DBSession) -> bool:
+        """Flip an import from Translating to ReadyForUpsert and release the lease, but only if owner still holds it.
+        Returns False if it doesn't."""
+        update = Import.__table__.update() \
+            .where(Import.id == import_id) \
+            .where(Import.status == ImportStatus.Translating) \
+            .where(Import.lease_owner == owner) \
+            .values(status=ImportStatus.ReadyForUpsert, lease_owner=None, lease_expires=None)
+        return cls._recorded(sess, import_id, ImportStatus.ReadyForUpsert, sess.execute(update).rowcount > 0)
+
+    @classmethod
+    def fail_translating(cls, import_id: str, owner: str, error_message: str, sess: DBSession) -> bool:
+        """Flip an import from Translating to Error and release the lease, but only if owner still holds it.
+        Returns False if it doesn't."""
+        update = Import.__table__.update() \
+            .where(Import.id == import_id) \
+            .where(Import.status == ImportStatus.Translating) \
+            .where(Import.lease_owner == owner) \
+            .values(status=ImportStatus.Error, error_message=error_message[:Import.MAX_ERROR_MESSAGE_LENGTH],
+                    lease_owner=None, lease_expires=None)
+        return cls._recorded(sess, import_id, ImportStatus.Error, sess.execute(update).rowcount > 0)
+
+    @classmethod
+    def recover_stalled_translations(cls, sess: DBSession, max_attempts: int, limit: int) -> tuple[list[str], list[str]]:
+        """Find up to limit translations whose lease has run out. Put the ones that have had fewer than max_attempts
+        back to Pending and error the rest. Returns the ids of (requeued, errored) imports.
+        Like time_out_stalled_imports, the UPDATEs re-check the lease, so a translation that just renewed it or was
+        just taken over is left alone."""
+        stalled = [Import.status == ImportStatus.Translating, Import.lease_expires < datetime.now()]
+        candidates = sess.query(Import.id, Import.translation_attempts).filter(*stalled).limit(limit).all()
+        retry_ids = [row.id for row in candidates if row.translation_attempts < max_attempts]
+        give_up_ids = [row.id for row in candidates if row.translation_attempts >= max_attempts]
+
+        if retry_ids:
+            sess.execute(Import.__table__.update()
+                         .where(Import.id.in_(retry_ids), *stalled)
+                         .values(status=ImportStatus.Pending, lease_owner=None, lease_expires=None))
+            # nothing else puts an import back to Pending
+            retry_ids = [row[0] for row in sess.query(Import.id)
+                         .filter(Import.id.in_(retry_ids), Import.status == ImportStatus.Pending)]
+            if retry_ids:
+                ImportStatusTransition.record(sess, ImportStatus.Pending, retry_ids)
+        if give_up_ids:
+            sess.execute(Import.__table__.update()
+                         .where(Import.id.in_(give_up_ids), *stalled)
+                         .values(status=ImportStatus.Error, lease_owner=None, lease_expires=None,
+                                 error_message=f"Translation stopped responding {max_attempts} times. "
+                                               f"Please try again, or file a bug report if this keeps happening."))
+            give_up_ids = [row[0] for row in sess.query(Import.id)
+                           .filter(Import.id.in_(give_up_ids), Import.status == ImportStatus.Error,
+                                   Import.lease_owner.is_(None), Import.translation_attempts >= max_attempts)]
+            if give_up_ids:
+                ImportStatusTransition.record(sess, ImportStatus.Error, give_up_ids)
+        return retry_ids, give_up_ids
 
     @classmethod
     def update_status_exclusively(cls, import_id: str, current_status: ImportStatus, new_status: ImportStatus,
@@ -183,7 +334,34 @@ class Import(ImportServiceTable, EqMixin, Base):
             .where(Import.status == current_status) \
             .values(status=new_status)
         num_affected_rows = sess.execute(update).rowcount
-        return num_affected_rows > 0
+        return cls._recorded(sess, import_id, new_status, num_affected_rows > 0)
+
+    @classmethod
+    def _recorded(cls, sess: DBSession, import_id: str, new_status: ImportStatus, moved: bool) -> bool:
+        """Record the transition to new_status if the import moved, and pass on whether it did."""
+        if moved:
+            ImportStatusTransition.record(sess, new_status, [import_id])
+        return moved
+
+    @classmethod
+    def transition_status(cls, import_id: str, new_status: ImportStatus, sess: DBSession,
+                          error_message: Optional[str] = None, only_if: Optional[ClauseElement] = None) -> bool:
+        """Move an import forward to new_status in a single conditional UPDATE. Imports only ever move forward, and
+        never out of a terminal status, so the UPDATE only matches imports in a running status before new_status,
+        and that also match only_if, if given. Returns False if the import didn't match; read it to find out why."""
+        allowed_from = [s for s in ImportStatus.running_statuses() if s.value < new_status.value]
+        values: Dict[str, Any] = {"status": new_status}
+        if error_message is not None:
+            # the @validates truncation doesn't apply to bulk updates
+            values["error_message"] = error_message[:Import.MAX_ERROR_MESSAGE_LENGTH]
+
+        update = Import.__table__.update() \
+            .where(Import.id == import_id) \
+            .where(Import.status.in_(allowed_from)) \
+            .values(**values)
+        if only_if is not None:
+            update = update.where(only_if)
+        return cls._recorded(sess, import_id, new_status, sess.execute(update).rowcount > 0)
 
     @classmethod
     def save_snapshot_id_exclusively(cls, import_job_id: str, snapshot_id: str, sess: DBSession) -> bool:
@@ -199,6 +377,140 @@ class Import(ImportServiceTable, EqMixin, Base):
     def write_error(self, msg: str) -> None:
         self.error_message = msg
         self.status = ImportStatus.Error
+        sess = object_session(self)
+        if sess is not None:
+            sess.add(ImportStatusTransition(self.id, ImportStatus.Error, self.filetype, datetime.now()))
+            ImportStatusTransition.mark_changed(sess, [self.id])
+
+
+class ArchivedImport(ImportServiceTable, ImportColumns, EqMixin, Base):
+    """An import that finished long enough ago to be moved out of the imports table. See archive_terminal_imports."""
+    __tablename__ = 'imports_archive'
+    __table_args__ = (
+        Index('ix_imports_archive_workspace_submit_time', 'workspace_namespace', 'workspace_name', 'submit_time'),
+        # covers the workspace summary query, which would otherwise read every archived import in the workspace
+        Index('ix_imports_archive_workspace_status_filetype', 'workspace_namespace', 'workspace_name', 'status',
+              'filetype'),
+        # finding an import by idempotency key after it's been archived
+        Index('ix_imports_archive_idempotency_key', 'idempotency_key'),
+    )
+
+    archived_time = Column(DateTime, nullable=False)
 
-    def to_status_response(self) -> ImportStatusResponse:
-        return ImportStatusResponse(self.id, self.status.name, self.filetype, self.error_message)
+    @classmethod
+    def archive_terminal_imports(cls, sess: DBSession, submitted_before: datetime, limit: int) -> list[str]:
+        """Move up to limit imports that reached a terminal status and were submitted before submitted_before from
+        imports into the archive. Returns their ids. Imports never leave a terminal status, so once we've picked them
+        nothing else will touch them."""
+        archivable = [Import.status.in_(ImportStatus.terminal_statuses()), Import.submit_time < submitted_before]
+        ids = [row[0] for row in sess.query(Import.id).filter(*archivable).limit(limit)]
+        if not ids:
+            return []
+
+        columns = [column.name for column in Import.__table__.columns]
+        sess.execute(cls.__table__.insert().from_select(
+            columns + ["archived_time"],
+            select(*Import.__table__.columns, literal(datetime.now(), DateTime()))  # type: ignore[call-arg]
+            .where(Import.id.in_(ids), *archivable)))
+        sess.execute(Import.__table__.delete().where(Import.id.in_(ids), *archivable))
+        return ids
+
+
+class ImportStatusTransition(ImportServiceTable, EqMixin, Base):
+    """A record of an import entering a status, so we can tell how long imports spend in each one. See app/stats.py."""
+    __tablename__ = 'import_status_transitions'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    import_id = Column(String(36), nullable=False, index=True)
+    status = Column(Enum(ImportStatus), nullable=False)
+    filetype = Column(String(10), nullable=False)  # copied from the import, so we don't need a join to filter on it
+    time = Column(DateTime, nullable=False, index=True)
+
+    def __init__(self, import_id: str, status: ImportStatus, filetype: str, time: datetime):
+        self.import_id = import_id
+        self.status = status
+        self.filetype = filetype
+        self.time = time
+
+    @classmethod
+    def record(cls, sess: DBSession, status: ImportStatus, import_ids: list[str]) -> None:
+        """Record that import_ids just entered status. This is one INSERT ... SELECT however many imports there are,
+        so call it right after the UPDATE that moved them."""
+        sess.execute(cls.__table__.insert().from_select(
+            ["import_id", "status", "filetype", "time"],
+            select(Import.id, literal(status, cls.status.type), Import.filetype,  # type: ignore[arg-type]
+                   literal(datetime.now(), DateTime()))
+            .where(Import.id.in_(import_ids))))
+        cls.mark_changed(sess, import_ids)
+
+    @classmethod
+    def purge_older_than(cls, sess: DBSession, before: datetime, limit: int) -> int:
+        """Delete up to limit transitions from before before. Returns how many we deleted."""
+        ids = [row[0] for row in sess.query(cls.id).filter(cls.time < before).order_by(cls.time).limit(limit)]
+        if not ids:
+            return 0
+        return sess.execute(cls.__table__.delete().where(cls.id.in_(ids))).rowcount
+
+    @staticmethod
+    def mark_changed(sess: DBSession, import_ids: list[str]) -> None:
+        """Note in the session that import_ids changed status, so app/status_watch.py can wake anyone waiting on them
+        once it commits."""
+        sess.info.setdefault(STATUS_CHANGED_KEY, set()).update(import_ids)
+
+
+class StagedTDRManifest(ImportServiceTable, EqMixin, Base):
+    """The manifest of a tdrexport import as we downloaded it to validate the import, so translating it doesn't need to
+    download it again. Deleted once the import is translated, or by cleanup if it never is."""
+    __tablename__ = 'staged_tdr_manifests'
+
+    # MEDIUMBLOB on MySQL. Manifests are mostly similar URLs, so they compress a lot; we don't stage any bigger than this.
+    MAX_COMPRESSED_BYTES = 2 ** 24 - 1
+
+    import_id = Column(String(36), primary_key=True)
+    manifest = Column(LargeBinary(MAX_COMPRESSED_BYTES), nullable=False)  # zlib-compressed manifest json
+
+    def __init__(self, import_id: str, manifest: bytes):
+        self.import_id = import_id
+        self.manifest = zlib.compress(manifest)
+
+    @classmethod
+    def get(cls, import_id: str, sess: DBSession) -> Optional[bytes]:
+        """The import's manifest json, if we staged it."""
+        row = sess.query(cls.manifest).filter(cls.import_id == import_id).one_or_none()
+        return zlib.decompress(row[0]) if row is not None else None
+
+    @classmethod
+    def discard(cls, import_id: str, sess: DBSession) -> None:
+        sess.execute(cls.__table__.delete().where(cls.import_id == import_id))
+
+    @classmethod
+    def purge_unneeded(cls, sess: DBSession, limit: int) -> int:
+        """Delete up to limit manifests of imports that aren't waiting to be translated or being translated any more,
+        e.g. because translating them failed. Returns how many we deleted."""
+        needed = select(Import.id).where(  # type: ignore[arg-type]
+            Import.status.in_([ImportStatus.Pending, ImportStatus.Translating]))
+        ids = [row[0] for row in sess.query(cls.import_id).filter(cls.import_id.notin_(needed)).limit(limit)]
+        if not ids:
+            return 0
+        return sess.execute(cls.__table__.delete().where(cls.import_id.in_(ids))).rowcount
+
+
+class PubSubOutboxMessage(ImportServiceTable, EqMixin, Base):
+    """A Pub/Sub message waiting to be published. Writing one of these in the same transaction as a status change
+    means the message can't get lost if we die (or Pub/Sub is slow) after the commit. See app/outbox.py."""
+    __tablename__ = 'pubsub_outbox'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    destination = Column(String(10), nullable=False)  # one of the outbox.DESTINATIONS
+    attributes = Column(Text, nullable=False)  # json-encoded message attributes
+    created_time = Column(DateTime, nullable=False)
+    claim_token = Column(String(36), nullable=True)  # set by the relay that's currently publishing this message
+    claimed_until = Column(DateTime, nullable=True)  # other relays leave this message alone until then
+    attempts = Column(Integer, nullable=False, default=0)
+    sent_time = Column(DateTime, nullable=True, index=True)
+
+    def __init__(self, destination: str, attributes: str):
+        self.destination = destination
+        self.attributes = attributes
+        self.created_time = datetime.now()
+        self.attempts = 0
@@ -0,0 +1,188 @@
+"""Versioned schema bootstrap.
+
+Creating tables on every cold start means a round of table-existence queries every time an instance spins up. Instead
+we record the schema version in the database and only do any work when it's behind SCHEMA_VERSION.
+
+To change the schema:
+  * new tables need adding to model.py and a SCHEMA_VERSION bump; create_all makes them, and their migration can
+    just make sure they're there.
+  * changes to existing tables (new columns, indexes) also need a migration. Bump SCHEMA_VERSION and add a function to
+    MIGRATIONS that takes the schema from the previous version to the new one. Fresh databases get the whole model from
+    create_all and skip migrations entirely, so migrations only need to handle databases that already exist."""
+import logging
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+import sqlalchemy
+from sqlalchemy import Column, Integer, MetaData, Table, inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.schema import CreateColumn
+
+# Version 1 is the schema as it was before we started versioning it.
+SCHEMA_VERSION = 11
+
+
+def _create_indexes(conn: Connection, table: Table, *names: str) -> None:
+    for index in table.indexes:
+        if index.name in names:
+            index.create(conn, checkfirst=True)  # type: ignore[call-arg]
+
+
+def _drop_indexes(conn: Connection, table: Table, *names: str) -> None:
+    existing = {index["name"] for index in inspect(conn).get_indexes(table.name)}
+    for name in names:
+        if name in existing:
+            on_table = f" ON {table.name}" if conn.dialect.name == "mysql" else ""
+            conn.execute(text(f"DROP INDEX {name}{on_table}"))
+
+
+def _add_columns(conn: Connection, table: Table, *names: str) -> None:
+    existing = {column["name"] for column in inspect(conn).get_columns(table.name)}
+    for name in names:
+        if name not in existing:
+            column_ddl = CreateColumn(table.columns[name]).compile(dialect=conn.dialect)
+            conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column_ddl}"))
+
+
+def _migrate_2_imports_indexes(conn: Connection) -> None:
+    from app.db import model
+    _create_indexes(conn, model.Import.__table__, 'ix_imports_workspace_submit_time',
+                    'ix_imports_workspace_status_submit_time', 'ix_imports_status_submit_time')
+
+
+def _migrate_3_translation_heartbeat(conn: Connection) -> None:
+    from app.db import model
+    _add_columns(conn, model.Import.__table__, 'heartbeat_time', 'translation_attempts')
+
+
+def _migrate_4_translation_lease(conn: Connection) -> None:
+    from app.db import model
+    _add_columns(conn, model.Import.__table__, 'lease_owner', 'lease_expires')
+
+
+def _migrate_5_import_status_transitions(conn: Connection) -> None:
+    from app.db import model
+    model.ImportStatusTransition.__table__.create(conn, checkfirst=True)
+
+
+def _migrate_6_imports_archive(conn: Connection) -> None:
+    from app.db import model
+    model.ArchivedImport.__table__.create(conn, checkfirst=True)
+
+
+def _migrate_7_summary_index(conn: Connection) -> None:
+    from app.db import model
+    # the new index does everything the old one did, and covers the workspace summary query too
+    _create_indexes(conn, model.Import.__table__, 'ix_imports_workspace_status_submit_time_filetype')
+    _drop_indexes(conn, model.Import.__table__, 'ix_imports_workspace_status_submit_time')
+
+
+def _migrate_8_idempotency_keys(conn: Connection) -> None:
+    from app.db import model
+    _add_columns(conn, model.Import.__table__, 'idempotency_key')
+    _add_columns(conn, model.ArchivedImport.__table__, 'idempotency_key')
+    _create_indexes(conn, model.Import.__table__, 'ix_imports_idempotency_key')
+
+
+def _migrate_9_staged_tdr_manifests(conn: Connection) -> None:
+    from app.db import model
+    model.StagedTDRManifest.__table__.create(conn, checkfirst=True)
+
+
+def _migrate_10_archive_summary_index(conn: Connection) -> None:
+    from app.db import model
+    _create_indexes(conn, model.ArchivedImport.__table__, 'ix_imports_archive_workspace_status_filetype')
+
+
+def _migrate_11_archive_idempotency_key_index(conn: Connection) -> None:
+    from app.db import model
+    _create_indexes(conn, model.ArchivedImport.__table__, 'ix_imports_archive_idempotency_key')
+
+
+# version -> function that migrates a database from (version - 1) to version
+MIGRATIONS: Dict[int, Callable[[Connection], None]] = {
+    2: _migrate_2_imports_indexes,
+    3: _migrate_3_translation_heartbeat,
+    4: _migrate_4_translation_lease,
+    5: _migrate_5_import_status_transitions,
+    6: _migrate_6_imports_archive,
+    7: _migrate_7_summary_index,
+    8: _migrate_8_idempotency_keys,
+    9: _migrate_9_staged_tdr_manifests,
+    10: _migrate_10_archive_summary_index,
+    11: _migrate_11_archive_idempotency_key_index,
+}
+
+# Kept out of model.Base so create_all/drop_all in tests leave it alone.
+_version_metadata = MetaData()
+schema_version_table = Table("schema_version", _version_metadata, Column("version", Integer, nullable=False))
+
+# Held (on MySQL) while bootstrapping, so instances that start at the same time don't all migrate at once.
+_LOCK_NAME = "import_service_schema_bootstrap"
+_LOCK_TIMEOUT_SECONDS = 60
+
+
+def bootstrap(engine: Engine) -> None:
+    """Bring the database schema up to SCHEMA_VERSION. Cheap if it already is. A database that's already on a newer
+    version is left alone: during a rolling deploy, instances of the old version keep running against the new schema."""
+    with engine.connect() as conn:
+        if not _needs_upgrade(_get_version(conn)):
+            return
+
+    with engine.begin() as conn:
+        with _bootstrap_lock(conn):
+            # someone else may have done this while we waited for the lock
+            current = _get_version(conn)
+            if not _needs_upgrade(current):
+                return
+            _upgrade(conn, current)
+
+
+def _needs_upgrade(current: Optional[int]) -> bool:
+    if current is not None and current > SCHEMA_VERSION:
+        logging.info(f"Database schema is at version {current}, newer than our {SCHEMA_VERSION}; leaving it alone")
+    return current is None or current < SCHEMA_VERSION
+
+
+def _upgrade(conn: Connection, current: Optional[int]) -> None:
+    from app.db import model
+
+    if current is None:
+        # either a brand new database, or one from before we versioned the schema
+        current = 1 if inspect(conn).has_table(model.Import.__tablename__) else SCHEMA_VERSION
+
+    logging.info(f"Upgrading database schema from version {current} to {SCHEMA_VERSION}...")
+    model.Base.metadata.create_all(conn)
+    for version in range(current + 1, SCHEMA_VERSION + 1):
+        logging.info(f"Applying schema migration {version}")
+        MIGRATIONS[version](conn)
+    _set_version(conn, SCHEMA_VERSION)
+
+
+def _get_version(conn: Connection) -> Optional[int]:
+    if not inspect(conn).has_table(schema_version_table.name):
+        return None
+    return conn.execute(sqlalchemy.select(schema_version_table.c.version)).scalar()  # type: ignore[arg-type]
+
+
+def _set_version(conn: Connection, version: int) -> None:
+    _version_metadata.create_all(conn)
+    conn.execute(schema_version_table.delete())
+    conn.execute(schema_version_table.insert().values(version=version))
+
+
+@contextmanager
+def _bootstrap_lock(conn: Connection) -> Iterator[None]:
+    if conn.dialect.name != "mysql":
+        yield
+        return
+    # 1 if we got it, 0 if we timed out, NULL on error
+    locked = conn.execute(text("SELECT GET_LOCK(:name, :timeout)"),
+                          {"name": _LOCK_NAME, "timeout": _LOCK_TIMEOUT_SECONDS}).scalar()
+    if locked != 1:
+        raise RuntimeError(f"Couldn't get the {_LOCK_NAME} lock within {_LOCK_TIMEOUT_SECONDS}s; "
+                           f"another instance may be stuck migrating the schema")
+    try:
+        yield
+    finally:
+        conn.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": _LOCK_NAME})
@@ -1,19 +1,47 @@
-from google.cloud.pubsub_v1 import PublisherClient, SubscriberClient
-import os, contextlib
+from google.cloud.pubsub_v1 import PublisherClient, SubscriberClient, types
+from google.cloud.pubsub_v1.subscriber.futures import StreamingPullFuture
+from google.cloud.pubsub_v1.subscriber.message import Message
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+import os, contextlib, threading
 
 from app.auth import service_auth
-from typing import Dict, List, Optional
+from app.util import metrics
+from typing import Any, Callable, Dict, Optional
+
+# Messages published at around the same time (e.g. by concurrent requests) are sent to Pub/Sub in one batch.
+# A batch is sent as soon as it hits any of these limits.
+PUBLISH_BATCH_MAX_MESSAGES = int(os.environ.get("PUBSUB_PUBLISH_BATCH_MAX_MESSAGES", "100"))
+PUBLISH_BATCH_MAX_BYTES = int(os.environ.get("PUBSUB_PUBLISH_BATCH_MAX_BYTES", "1000000"))
+PUBLISH_BATCH_MAX_LATENCY_SECONDS = float(os.environ.get("PUBSUB_PUBLISH_BATCH_MAX_LATENCY_SECONDS", "0.01"))
+# If this many messages (or bytes) are waiting to be published, further publishes block until some have gone out.
+PUBLISH_MAX_OUTSTANDING_MESSAGES = int(os.environ.get("PUBSUB_PUBLISH_MAX_OUTSTANDING_MESSAGES", "1000"))
+PUBLISH_MAX_OUTSTANDING_BYTES = int(os.environ.get("PUBSUB_PUBLISH_MAX_OUTSTANDING_BYTES", "10000000"))
 
 _publisher_client: Optional[PublisherClient] = None
-_subscriber_client: Optional[SubscriberClient] = None
+# gRPC channels can't be used across a fork, so we remember which process made the client.
+_publisher_client_pid: Optional[int] = None
+_publisher_client_lock = threading.Lock()
 
 
 def _get_publisher_client() -> PublisherClient:
-    # global _publisher_client
-    # if _publisher_client is None:
-    #     _publisher_client = pubsub_v1.PublisherClient(credentials=service_auth.get_isvc_credential())
-    # return _publisher_client
-    return PublisherClient(credentials=service_auth.get_isvc_credential())
+    """Get the process-wide publisher client, making it if this process doesn't have one yet."""
+    global _publisher_client, _publisher_client_pid
+    with _publisher_client_lock:
+        if _publisher_client is None or _publisher_client_pid != os.getpid():
+            _publisher_client = PublisherClient(
+                batch_settings=types.BatchSettings(
+                    max_messages=PUBLISH_BATCH_MAX_MESSAGES,
+                    max_bytes=PUBLISH_BATCH_MAX_BYTES,
+                    max_latency=PUBLISH_BATCH_MAX_LATENCY_SECONDS),
+                publisher_options=types.PublisherOptions(
+                    flow_control=types.PublishFlowControl(
+                        message_limit=PUBLISH_MAX_OUTSTANDING_MESSAGES,
+                        byte_limit=PUBLISH_MAX_OUTSTANDING_BYTES,
+                        limit_exceeded_behavior=types.LimitExceededBehavior.BLOCK)),
+                # the client lives as long as the process, so it needs credentials that can refresh themselves
+                credentials=service_auth.get_isvc_refreshing_credential())
+            _publisher_client_pid = os.getpid()
+        return _publisher_client
 
 
 def create_topic_and_sub() -> None:
@@ -30,37 +58,32 @@ def create_topic_and_sub() -> None:
 
 def publish_self(data: Dict[str, str]) -> None:
     """Publish the data (as attributes, not in the message body) to ourselves using pub/sub."""
-    client = _get_publisher_client()
-    topic_path = client.topic_path(os.environ.get("PUBSUB_PROJECT"), os.environ.get("PUBSUB_TOPIC"))
-    future = client.publish(topic_path, b'', **data)
-    future.result()
+    _publish(os.environ.get("PUBSUB_PROJECT"), os.environ.get("PUBSUB_TOPIC"), data, "pubsub.publish_self")
 
 
 def publish_rawls(data: Dict[str, str]) -> None:
     """Publish the data (as attributes, not in the message body) to Rawls using pub/sub."""
-    client = _get_publisher_client()
-    topic_path = client.topic_path(os.environ.get("RAWLS_PUBSUB_PROJECT"), os.environ.get("RAWLS_PUBSUB_TOPIC"))
-    future = client.publish(topic_path, b'', **data)
-    future.result()  # wait on the future so we know it's done
+    _publish(os.environ.get("RAWLS_PUBSUB_PROJECT"), os.environ.get("RAWLS_PUBSUB_TOPIC"), data, "pubsub.publish_rawls")
 
 
-def _get_subscriber_client() -> SubscriberClient:
-    # global _subscriber_client
-    # if _subscriber_client is None:
-    #     _subscriber_client = pubsub_v1.SubscriberClient(credentials=service_auth.get_isvc_credential())
-    # return _subscriber_client
-    return SubscriberClient(credentials=service_auth.get_isvc_credential())
-
+def _publish(project: Optional[str], topic: Optional[str], data: Dict[str, str], metric_name: str) -> None:
+    client = _get_publisher_client()
+    topic_path = client.topic_path(project, topic)
+    with metrics.timed(metric_name):
+        future = client.publish(topic_path, b'', **data)
+        future.result()  # wait on the future so we know pub/sub has the message
 
-def pull_self(num_messages: int):
-    client = _get_subscriber_client()
-    subscription_path = client.subscription_path(os.environ.get("PUBSUB_PROJECT"), os.environ.get("PUBSUB_SUBSCRIPTION"))
-    response = client.pull(request={"subscription":subscription_path, "max_messages":num_messages, "return_immediately":True})
-    return response.received_messages
 
+def _get_subscriber_client() -> SubscriberClient:
+    # streaming pull keeps the client around for as long as the process, so it needs credentials that refresh
+    return SubscriberClient(credentials=service_auth.get_isvc_refreshing_credential())
 
 
-def acknowledge_self_messages(ack_ids: List[int]):
+def subscribe_self(callback: Callable[[Message], Any], flow_control: types.FlowControl,
+                   scheduler: ThreadScheduler) -> StreamingPullFuture:
+    """Start streaming-pulling messages sent to ourselves, calling callback on each one using the given scheduler.
+    Cancelling the returned future stops pulling, and waits for in-flight callbacks to finish."""
     client = _get_subscriber_client()
     subscription_path = client.subscription_path(os.environ.get("PUBSUB_PROJECT"), os.environ.get("PUBSUB_SUBSCRIPTION"))
-    client.acknowledge(request={"subscription":subscription_path, "ack_ids":ack_ids})
+    return client.subscribe(subscription_path, callback=callback, flow_control=flow_control, scheduler=scheduler,
+                            await_callbacks_on_shutdown=True)
@@ -1,12 +1,36 @@
 import flask
+import functools
 import logging
+import os
+import signal
+import sys
+import threading
 import traceback
-import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud.pubsub_v1 import types
+from google.cloud.pubsub_v1.subscriber.futures import StreamingPullFuture
+from google.cloud.pubsub_v1.subscriber.message import Message
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
 
 from app.external import pubsub
 from app.server import routes
 from app.server.requestutils import pubsubify_excs, PUBSUB_STATUS_RETRY
 
+# How many messages we handle at once. Each one may be a long-running translation.
+PULL_MAX_CONCURRENCY = int(os.environ.get("PULL_PUBSUB_MAX_CONCURRENCY", "4"))
+# How many messages (and bytes) we let Pub/Sub hand us before we've finished with earlier ones.
+PULL_MAX_OUTSTANDING_MESSAGES = int(os.environ.get("PULL_PUBSUB_MAX_OUTSTANDING_MESSAGES", str(PULL_MAX_CONCURRENCY)))
+PULL_MAX_OUTSTANDING_BYTES = int(os.environ.get("PULL_PUBSUB_MAX_OUTSTANDING_BYTES", "10000000"))
+# The subscriber keeps extending the ack deadline of a message we're handling for up to this long.
+PULL_MAX_LEASE_SECONDS = int(os.environ.get("PULL_PUBSUB_MAX_LEASE_SECONDS", str(4 * 60 * 60)))
+# How long to wait before resubscribing if the stream dies.
+RESUBSCRIBE_DELAY_SECONDS = 5
+# How often the pull loop checks whether the stream has died while it waits to be stopped.
+STREAM_CHECK_SECONDS = 1
+
+_stopping = threading.Event()
+
 
 @pubsubify_excs
 def process_one(attributes: dict) -> flask.Response:
@@ -15,25 +39,65 @@ def process_one(attributes: dict) -> flask.Response:
 
 def loop(app: flask.Flask):
     """Main loop for pulling messages from PubSub when in PULL_MODE."""
-    while True:
+    while not _stopping.is_set():
         try:
-            poll(app)
+            streaming_pull_future = subscribe(app)
+            while not streaming_pull_future.done():
+                if _stopping.wait(STREAM_CHECK_SECONDS):
+                    # cancelled here rather than in stop(), which runs in a signal handler
+                    streaming_pull_future.cancel()
+                    break
+            # blocks until the messages we're already handling are finished, or raises if the stream failed
+            streaming_pull_future.result()
         except Exception:
             # Catch-all for nasty surprises. If this thread dies, we stop polling.
             logging.error(f"Exception in pubsub_pull thread:\n{traceback.format_exc()}")
-        time.sleep(5)
-
-
-def poll(app: flask.Flask):
-    maybe_message = pubsub.pull_self(1)  # this is a list with 0 or 1 elems
-    for msg in maybe_message:
-        logging.info(f"Got message from pubsub: \n{msg}")
-        # call out to process_one to let @pubsubify_excs catch application exceptions.
-        # this means any other exception thrown in this thread will be from pubsub machinery.
-        # we need to provide a Flask app context so it doesn't complain when we call make_response
-        with app.app_context():
-            app_response = process_one(msg.message.attributes)
-        if getattr(app_response, 'status_code', 200) != PUBSUB_STATUS_RETRY:
-            # if app code throws an exception, pubsubify_excs will catch it and turn it into a Flask response.
-            # if the status code on that response is PUBSUB_STATUS_RETRY, don't ack the message so pubsub retries it.
-            pubsub.acknowledge_self_messages([msg.ack_id])
+        _stopping.wait(RESUBSCRIBE_DELAY_SECONDS)
+
+
+def subscribe(app: flask.Flask) -> StreamingPullFuture:
+    """Start a streaming pull that handles up to PULL_MAX_CONCURRENCY messages at once."""
+    flow_control = types.FlowControl(
+        max_messages=PULL_MAX_OUTSTANDING_MESSAGES,
+        max_bytes=PULL_MAX_OUTSTANDING_BYTES,
+        max_lease_duration=PULL_MAX_LEASE_SECONDS)
+    scheduler = ThreadScheduler(ThreadPoolExecutor(max_workers=PULL_MAX_CONCURRENCY, thread_name_prefix="pubsub-pull"))
+    return pubsub.subscribe_self(functools.partial(handle_message, app), flow_control, scheduler)
+
+
+def handle_message(app: flask.Flask, msg: Message) -> None:
+    logging.info(f"Got message from pubsub: \n{msg}")
+    # call out to process_one to let @pubsubify_excs catch application exceptions.
+    # this means any other exception thrown in this thread will be from pubsub machinery.
+    # we need to provide a Flask app context so it doesn't complain when we call make_response
+    with app.app_context():
+        app_response = process_one(msg.attributes)
+    if getattr(app_response, 'status_code', 200) == PUBSUB_STATUS_RETRY:
+        # if app code throws an exception, pubsubify_excs will catch it and turn it into a Flask response.
+        # if the status code on that response is PUBSUB_STATUS_RETRY, nack the message so pubsub retries it.
+        msg.nack()
+    else:
+        msg.ack()
+
+
+def stop() -> None:
+    """Stop pulling new messages. loop() returns once the messages we're already handling are done.
+    Only sets a flag, so it's safe to call from a signal handler."""
+    _stopping.set()
+
+
+def stop_on_sigterm() -> None:
+    """Drain the pull loop when we're told to shut down, then carry on with whatever SIGTERM did before.
+    Must be called from the main thread."""
+    previous_handler = signal.getsignal(signal.SIGTERM)
+
+    def on_sigterm(signum, frame):
+        logging.info("Got SIGTERM, draining pubsub pull")
+        stop()
+        if callable(previous_handler):
+            previous_handler(signum, frame)
+        elif previous_handler != signal.SIG_IGN:
+            # the default action kills us outright. exiting normally instead waits for the pull loop to drain.
+            sys.exit(128 + signum)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
@@ -1,7 +1,9 @@
 import logging
 import os
+import threading
+import time
 from dataclasses import dataclass
-from typing import Optional, Set
+from typing import Dict, Optional, Set, Tuple
 
 import requests
 from app.external.cloud_platform import CloudPlatform
@@ -17,6 +19,46 @@ class RawlsWorkspaceResponse:
      bucket_name: Optional[str] = None
 
 
+# The fields in RawlsWorkspaceResponse are fixed for the lifetime of a workspace, so we cache them by namespace/name.
+# Nothing in here is specific to a user: callers must still check that the user is allowed to see the workspace.
+# Set WORKSPACE_INFO_CACHE_TTL_SECONDS to 0 to disable the cache.
+WORKSPACE_INFO_CACHE_TTL_SECONDS = int(os.environ.get("WORKSPACE_INFO_CACHE_TTL_SECONDS", "300"))
+
+_workspace_info_cache: Dict[Tuple[str, str], Tuple[float, RawlsWorkspaceResponse]] = {}
+_workspace_info_cache_lock = threading.Lock()
+
+
+def get_cached_workspace_info(workspace_namespace: str, workspace_name: str) -> Optional[RawlsWorkspaceResponse]:
+    """Return the cached workspace info for this workspace, or None if we don't have a fresh copy."""
+    with _workspace_info_cache_lock:
+        cached = _workspace_info_cache.get((workspace_namespace, workspace_name))
+        if cached is None:
+            return None
+        expiry, workspace_info = cached
+        if expiry <= time.monotonic():
+            del _workspace_info_cache[(workspace_namespace, workspace_name)]
+            return None
+        return workspace_info
+
+
+def cache_workspace_info(workspace_namespace: str, workspace_name: str, workspace_info: RawlsWorkspaceResponse) -> None:
+    if WORKSPACE_INFO_CACHE_TTL_SECONDS <= 0:
+        return
+    with _workspace_info_cache_lock:
+        _workspace_info_cache[(workspace_namespace, workspace_name)] = \
+            (time.monotonic() + WORKSPACE_INFO_CACHE_TTL_SECONDS, workspace_info)
+
+
+def invalidate_workspace_info(workspace_namespace: str, workspace_name: str) -> None:
+    with _workspace_info_cache_lock:
+        _workspace_info_cache.pop((workspace_namespace, workspace_name), None)
+
+
+def clear_workspace_info_cache() -> None:
+    with _workspace_info_cache_lock:
+        _workspace_info_cache.clear()
+
+
 def get_rawls_workspace_info(workspace_namespace: str, workspace_name: str, bearer_token: str) -> RawlsWorkspaceResponse:
     resp = requests.get(
         f"{os.environ.get('RAWLS_URL')}/api/workspaces/{workspace_namespace}/{workspace_name}?fields=workspace.workspaceId,workspace.googleProject,workspace.authorizationDomain,workspace.bucketName,workspace.cloudPlatform",
@@ -35,7 +35,11 @@ def handle_health_check() -> HealthResponse:
 
 
 def check_health() -> bool:
-    with db.session_ctx() as sess:
+    return _check_db(read_only=False) and (not db.has_replica() or _check_db(read_only=True))
+
+
+def _check_db(read_only: bool) -> bool:
+    with db.session_ctx(read_only) as sess:
 
         res = sess.execute(text("select true")).rowcount
         return bool(res)
@@ -1,22 +1,27 @@
 import flask
+import hashlib
 import json
 import logging
+import requests.exceptions
+import sqlalchemy.exc
 
 from app.translate import FILETYPE_TRANSLATORS, FILETYPE_NOTRANSLATION
 from app.db import db, model
-from app.external import gcs, sam, pubsub
+from app.external import gcs, sam
 from app.external.cloud_platform import CloudPlatform
+from app.external.rawls import RawlsWorkspaceResponse
 from app.external.tdr_model import TDRManifest
 from app.auth import user_auth
 from app.util import exceptions, http
 
-from pydantic import AnyUrl, validate_arguments
-from typing import Optional, Set
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import AnyUrl, ValidationError, validate_arguments
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple, Union
 from urllib.parse import ParseResult, urlparse
 import os
 
 from app.auth.userinfo import UserInfo
-from app import protected_data
+from app import outbox, protected_data
 
 # Allow downloads from any GCS bucket, Azure storage container, or S3 bucket
 VALID_NETLOCS = [
@@ -33,6 +38,20 @@ additional_valid_netlocs = os.getenv("IMPORT_ALLOWED_NETLOCS")
 if additional_valid_netlocs:
     VALID_NETLOCS += [s.strip() for s in additional_valid_netlocs.split(",")]
 
+# Clients may send this header with a unique value per import; resubmitting with the same value returns the same import.
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+# Most imports we accept in one bulk request.
+MAX_BULK_IMPORTS = int(os.environ.get("BULK_IMPORT_MAX_ITEMS", "500"))
+# How many imports in a bulk request we validate at once.
+BULK_VALIDATION_CONCURRENCY = int(os.environ.get("BULK_IMPORT_VALIDATION_CONCURRENCY", "16"))
+
+class ValidatedImport(NamedTuple):
+    """A new import that passed validation, and what we'll save with it."""
+    new_import: model.Import
+    staged_manifest: Optional[model.StagedTDRManifest]
+
 def is_valid_netloc(parsed_url: ParseResult) -> bool:
     for valid_netloc in VALID_NETLOCS:
         if valid_netloc[0] == "*" and parsed_url.netloc.endswith(valid_netloc[1:]):
@@ -42,7 +61,9 @@ def is_valid_netloc(parsed_url: ParseResult) -> bool:
 
     return False
 
-def handle(request: flask.Request, ws_ns: str, ws_name: str) -> model.ImportStatusResponse:
+def handle(request: flask.Request, ws_ns: str, ws_name: str) -> Tuple[model.ImportStatusResponse, bool]:
+    """Accept an import request. Returns its status, and whether it's a new import rather than an existing one: one
+    with the same Idempotency-Key header, or the same in-flight import if options.deduplicate is set."""
     access_token = user_auth.extract_auth_token(request)
     user_info = sam.validate_user(access_token)
 
@@ -56,6 +77,110 @@ def handle(request: flask.Request, ws_ns: str, ws_name: str) -> model.ImportStat
 
     # make sure the user is allowed to import to this workspace
     workspace = user_auth.workspace_uuid_and_project_with_auth(ws_ns, ws_name, access_token, "write")
+
+    # a retry of an import we already have doesn't need validating again
+    idempotency_key = _idempotency_key(request, ws_ns, ws_name, user_info)
+    existing = _find_existing_import(request_json, ws_ns, ws_name, idempotency_key)
+    if existing is not None:
+        logging.info(f"Returning existing import {existing.id} rather than importing {existing.import_url} again")
+        return existing.to_status_response(), False
+
+    validated = _validate_new_import(request_json, ws_ns, ws_name, workspace, user_info)
+    new_import = validated.new_import
+    new_import.idempotency_key = idempotency_key
+    try:
+        _save_and_enqueue([validated])
+    except sqlalchemy.exc.IntegrityError:
+        # a concurrent request with the same idempotency key got in first
+        existing = _find_existing_import(request_json, ws_ns, ws_name, idempotency_key) if idempotency_key else None
+        if existing is None:
+            raise
+        return existing.to_status_response(), False
+    return new_import.to_status_response(), True
+
+def _idempotency_key(request: flask.Request, ws_ns: str, ws_name: str, user_info: UserInfo) -> Optional[str]:
+    """The stored form of the request's Idempotency-Key, if it has one. Keys only need to be unique per user and
+    workspace, so we store a hash of all three."""
+    key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+    if key is None:
+        return None
+    if not 1 <= len(key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+        raise exceptions.BadJsonException(f"{IDEMPOTENCY_KEY_HEADER} must be 1 to {MAX_IDEMPOTENCY_KEY_LENGTH} characters", audit_log = False)
+    return hashlib.sha256(json.dumps([ws_ns, ws_name, user_info.user_email, key]).encode()).hexdigest()
+
+def _find_existing_import(request_json: dict, ws_ns: str, ws_name: str, idempotency_key: Optional[str]) -> Optional[model.ImportColumns]:
+    """The import this request should get instead of a new one: the one submitted with the same idempotency key, or
+    if the request asks for deduplication, a matching import that hasn't started translating yet or is translating now."""
+    with db.session_ctx() as sess:
+        if idempotency_key is not None:
+            existing: Optional[model.ImportColumns] = \
+                sess.query(model.Import).filter(model.Import.idempotency_key == idempotency_key).one_or_none()
+            if existing is None:
+                # it may have finished long enough ago to be archived
+                existing = sess.query(model.ArchivedImport).\
+                    filter(model.ArchivedImport.idempotency_key == idempotency_key).first()
+            if existing is not None:
+                if (existing.import_url, existing.filetype, existing.is_upsert) != \
+                        (request_json["path"], request_json["filetype"], _parse_is_upsert(request_json)):
+                    raise exceptions.IdempotencyKeyReusedException()
+                return existing
+
+        if request_json.get("options", {}).get("deduplicate", False):
+            return sess.query(model.Import).\
+                filter(model.Import.workspace_namespace == ws_ns).\
+                filter(model.Import.workspace_name == ws_name).\
+                filter(model.Import.status.in_([model.ImportStatus.Pending, model.ImportStatus.Translating])).\
+                filter(model.Import.import_url == request_json["path"]).\
+                filter(model.Import.filetype == request_json["filetype"]).\
+                filter(model.Import.is_upsert == _parse_is_upsert(request_json)).\
+                order_by(model.Import.submit_time.desc()).first()
+    return None
+
+def handle_bulk(request: flask.Request, ws_ns: str, ws_name: str) -> List[Dict[str, Any]]:
+    """Accept a batch of imports into one workspace. We check the user and workspace once, validate the imports
+    concurrently, and save the valid ones in one transaction. Returns a result for each import, in order: its status
+    response and a 201 statusCode if we accepted it, or the statusCode and message it would have failed with alone."""
+    access_token = user_auth.extract_auth_token(request)
+    user_info = sam.validate_user(access_token)
+
+    # one key can't stand for many imports, and there's nowhere to say which were already accepted
+    if request.headers.get(IDEMPOTENCY_KEY_HEADER) is not None:
+        raise exceptions.BadJsonException(f"{IDEMPOTENCY_KEY_HEADER} is not supported for bulk imports", audit_log = False)
+
+    request_json_opt = request.get_json(force=True, silent=True)
+    items = request_json_opt.get("imports") if isinstance(request_json_opt, dict) else None
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise exceptions.BadJsonException("Input payload is not valid", audit_log = True)
+    if not 1 <= len(items) <= MAX_BULK_IMPORTS:
+        raise exceptions.BadJsonException(f"imports must have between 1 and {MAX_BULK_IMPORTS} items", audit_log = False)
+
+    workspace = user_auth.workspace_uuid_and_project_with_auth(ws_ns, ws_name, access_token, "write")
+
+    def validate(item: dict) -> Union[ValidatedImport, exceptions.ISvcException]:
+        try:
+            return _validate_new_import(item, ws_ns, ws_name, workspace, user_info)
+        except exceptions.ISvcException as ise:
+            for alog in ise.audit_logs:
+                logging.log(alog.loglevel, alog.msg)
+            return ise
+        except (ValidationError, json.JSONDecodeError, requests.exceptions.RequestException) as e:
+            # a TDR manifest we couldn't fetch or parse. That's a problem with this import, not the whole request.
+            logging.warning(f"Unable to read TDR manifest {item['path']}: {e}")
+            return exceptions.BadJsonException(f"Unable to read TDR manifest: {e}", audit_log = False)
+
+    # validating can mean fetching a TDR manifest, so do them side by side
+    with ThreadPoolExecutor(max_workers=min(BULK_VALIDATION_CONCURRENCY, len(items))) as executor:
+        validated = list(executor.map(validate, items))
+
+    _save_and_enqueue([v for v in validated if isinstance(v, ValidatedImport)])
+
+    return [{"statusCode": 201, **v.new_import.to_status_response().to_dict()} if isinstance(v, ValidatedImport)
+            else {"statusCode": v.http_status, "message": v.message}
+            for v in validated]
+
+def _validate_new_import(request_json: dict, ws_ns: str, ws_name: str, workspace: RawlsWorkspaceResponse,
+                         user_info: UserInfo) -> ValidatedImport:
+    """Check that this user may import request_json into the workspace, and make the Import for it (unsaved)."""
     workspace_uuid = workspace.workspace_id
     google_project = workspace.google_project
     authorization_domain = workspace.authorization_domain
@@ -63,11 +188,11 @@ def handle(request: flask.Request, ws_ns: str, ws_name: str) -> model.ImportStat
 
     import_url = request_json["path"]
     import_filetype = request_json["filetype"]
-    import_is_upsert = request_json.get("isUpsert", "true") # default to true if missing, to support legacy imports
+    is_upsert = _parse_is_upsert(request_json)
     options = request_json.get("options",{})
     is_tdr_sync_required = options.get("tdrSyncPermissions", False) # default to not sync permissions
 
-    logging.info(f"New import received for {import_url}, {import_filetype}, is_upsert: {import_is_upsert}, \
+    logging.info(f"New import received for {import_url}, {import_filetype}, is_upsert: {is_upsert}, \
         options: {options}, tdrSyncFlag: {is_tdr_sync_required}")
 
     # and validate the input's path
@@ -82,16 +207,14 @@ def handle(request: flask.Request, ws_ns: str, ws_name: str) -> model.ImportStat
         if is_protected_pfb(import_url) and not is_protected_workspace(authorization_domain, bucket_name):
             raise exceptions.ForbiddenImportException(import_url, user_info, "Unable to import protected data into an unprotected workspace")
     elif import_filetype == "tdrexport":
-        manifest = load_tdr_manifest(import_url, google_project=google_project, user_info=user_info)
+        manifest_json = download_tdr_manifest(import_url, google_project=google_project, user_info=user_info)
+        manifest = TDRManifest(**json.loads(manifest_json))
         if is_protected_snapshot(manifest) and not is_protected_workspace(authorization_domain, bucket_name):
             raise exceptions.ForbiddenImportException(import_url, user_info, "Unable to import protected data into an unprotected workspace")
 
         if not all_sources_on_cloud_platform(manifest, workspace.cloud_platform):
             raise exceptions.ForbiddenImportException(import_url, user_info, "Unable to import TDR data across cloud platforms")
 
-    # parse is_upsert from a str into a bool
-    is_upsert = str(import_is_upsert).strip().lower() == "true"
-
     new_import = model.Import(
         workspace_name=ws_name,
         workspace_ns=ws_ns,
@@ -103,13 +226,33 @@ def handle(request: flask.Request, ws_ns: str, ws_name: str) -> model.ImportStat
         is_upsert=is_upsert,
         is_tdr_sync_required=is_tdr_sync_required)
 
-    with db.session_ctx() as sess:
-        sess.add(new_import)
-        new_import_id = new_import.id
+    if import_filetype == "tdrexport":
+        # keep the manifest, so translating the import doesn't have to download it again
+        staged = model.StagedTDRManifest(new_import.id, manifest_json)
+        if len(staged.manifest) <= model.StagedTDRManifest.MAX_COMPRESSED_BYTES:
+            return ValidatedImport(new_import, staged)
+    return ValidatedImport(new_import, None)
 
-    pubsub.publish_self({"action": "translate", "import_id": new_import_id})
+def _parse_is_upsert(request_json: dict) -> bool:
+    import_is_upsert = request_json.get("isUpsert", "true") # default to true if missing, to support legacy imports
+    # parse is_upsert from a str into a bool
+    return str(import_is_upsert).strip().lower() == "true"
+
+def _save_and_enqueue(validated: List[ValidatedImport]) -> None:
+    """Save new imports and queue their translate messages, all in one transaction, then get the messages published."""
+    if not validated:
+        return
+
+    with db.session_ctx() as sess:
+        for new_import, staged_manifest in validated:
+            sess.add(new_import)
+            if staged_manifest is not None:
+                sess.add(staged_manifest)
+            sess.add(model.ImportStatusTransition(new_import.id, model.ImportStatus.Pending, new_import.filetype,
+                                                  new_import.submit_time))
+            outbox.enqueue(sess, outbox.SELF, {"action": "translate", "import_id": new_import.id})
 
-    return new_import.to_status_response()
+    outbox.relay_soon()
 
 def is_protected_workspace(authorization_domain: Optional[Set[str]], bucket_name: Optional[str]):
     if authorization_domain and len(authorization_domain) > 0:
@@ -172,6 +315,10 @@ def is_protected_pfb(import_url: str) -> bool:
 
 def load_tdr_manifest(manifest_url: str, *, google_project: str, user_info: UserInfo) -> TDRManifest:
     """Load and parse a TDR manifest."""
+    return TDRManifest(**json.loads(download_tdr_manifest(manifest_url, google_project=google_project, user_info=user_info)))
+
+def download_tdr_manifest(manifest_url: str, *, google_project: str, user_info: UserInfo) -> bytes:
+    """Download a TDR manifest's json."""
     parsed_url = urlparse(manifest_url)
     if parsed_url.scheme == "gs":
         filereader = gcs.open_file(google_project, parsed_url.netloc, parsed_url.path, user_info.user_email)
@@ -183,10 +330,7 @@ def load_tdr_manifest(manifest_url: str, *, google_project: str, user_info: User
         raise exceptions.InvalidPathException(manifest_url, user_info, "File cannot be imported from this URL.")
     
     with filereader as manifest_file:
-        manifest_json = json.load(manifest_file)
-
-    manifest = TDRManifest(**manifest_json)
-    return manifest
+        return manifest_file.read()
 
 def is_protected_snapshot(manifest: TDRManifest) -> bool:
     """Determine whether a TDR manifest contains protected data."""
@@ -0,0 +1,144 @@
+"""Transactional outbox for Pub/Sub messages.
+
+Instead of publishing after committing a status change, callers enqueue the message in the same transaction, then call
+relay_soon(). A relay publishes pending messages and marks them sent. Each instance runs a background relay (see
+start_relay), and the /cleanup-jobs cron runs one too, so messages left behind by a dead instance still go out."""
+import json
+import logging
+import os
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import or_
+
+from app.db import db, DBSession
+from app.db.model import PubSubOutboxMessage
+from app.external import pubsub
+
+SELF = "self"
+RAWLS = "rawls"
+DESTINATIONS = {SELF, RAWLS}
+
+# Most messages we claim and publish at once.
+RELAY_BATCH_SIZE = int(os.environ.get("OUTBOX_RELAY_BATCH_SIZE", "100"))
+# How many publishes we have in flight at once, so the publisher can batch them.
+RELAY_PUBLISH_CONCURRENCY = int(os.environ.get("OUTBOX_RELAY_PUBLISH_CONCURRENCY", "16"))
+# How often the background relay looks for messages it wasn't told about, e.g. from instances that died.
+RELAY_POLL_SECONDS = float(os.environ.get("OUTBOX_RELAY_POLL_SECONDS", "5"))
+# How long a relay has to publish the messages it claimed before another relay may try them.
+# This is also how long we wait before retrying a message that failed to publish.
+RELAY_CLAIM_SECONDS = int(os.environ.get("OUTBOX_RELAY_CLAIM_SECONDS", "30"))
+
+_wakeup = threading.Event()
+_relay_thread: Optional[threading.Thread] = None
+
+
+def enqueue(sess: DBSession, destination: str, attributes: Dict[str, str]) -> None:
+    """Add a message to the outbox as part of the caller's transaction. Call relay_soon() once it's committed."""
+    assert destination in DESTINATIONS, f"unknown outbox destination {destination}"
+    sess.add(PubSubOutboxMessage(destination, json.dumps(attributes)))
+
+
+def relay_soon() -> None:
+    """Get newly committed messages published: wake up the background relay if there is one, or do it ourselves."""
+    if _relay_thread is not None and _relay_thread.is_alive():
+        _wakeup.set()
+    else:
+        relay_pending()
+
+
+def relay_pending(limit: int = RELAY_BATCH_SIZE) -> int:
+    """Claim up to limit unsent messages, publish them, and mark the ones that worked as sent.
+    Returns the number of messages claimed."""
+    claimed = _claim(limit)
+    if not claimed:
+        return 0
+
+    if len(claimed) == 1:
+        results = [_publish(claimed[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=min(RELAY_PUBLISH_CONCURRENCY, len(claimed))) as executor:
+            results = list(executor.map(_publish, claimed))
+
+    sent_ids = [msg.id for msg, sent in zip(claimed, results) if sent]
+    if sent_ids:
+        with db.session_ctx() as sess:
+            sess.execute(PubSubOutboxMessage.__table__.update()
+                         .where(PubSubOutboxMessage.id.in_(sent_ids))
+                         .values(sent_time=datetime.now(), claim_token=None, claimed_until=None))
+
+    if len(sent_ids) < len(claimed):
+        logging.warning(f"Failed to publish {len(claimed) - len(sent_ids)} of {len(claimed)} outbox messages; "
+                        f"will retry in {RELAY_CLAIM_SECONDS}s")
+    return len(claimed)
+
+
+def purge_sent(older_than_hours: int) -> int:
+    """Delete messages that were sent more than older_than_hours ago."""
+    with db.session_ctx() as sess:
+        return sess.execute(PubSubOutboxMessage.__table__.delete()
+                            .where(PubSubOutboxMessage.sent_time < datetime.now() - timedelta(hours=older_than_hours))).rowcount
+
+
+def _claim(limit: int) -> List[PubSubOutboxMessage]:
+    """Claim unsent messages that no other relay is working on. Claiming is a conditional update, so two relays never
+    both claim the same message (though one may publish a message again if the other took too long to mark it sent)."""
+    now = datetime.now()
+    claim_token = str(uuid.uuid4())
+    claimable = [PubSubOutboxMessage.sent_time.is_(None),
+                 or_(PubSubOutboxMessage.claimed_until.is_(None), PubSubOutboxMessage.claimed_until < now)]
+
+    with db.session_ctx() as sess:
+        candidate_ids = [row[0] for row in sess.query(PubSubOutboxMessage.id).filter(*claimable)
+                         .order_by(PubSubOutboxMessage.id).limit(limit)]
+        if not candidate_ids:
+            return []
+
+        sess.execute(PubSubOutboxMessage.__table__.update()
+                     .where(PubSubOutboxMessage.id.in_(candidate_ids), *claimable)
+                     .values(claim_token=claim_token,
+                             claimed_until=now + timedelta(seconds=RELAY_CLAIM_SECONDS),
+                             attempts=PubSubOutboxMessage.attempts + 1))
+
+        return sess.query(PubSubOutboxMessage).filter(PubSubOutboxMessage.claim_token == claim_token)\
+            .order_by(PubSubOutboxMessage.id).all()
+
+
+def _publish(msg: PubSubOutboxMessage) -> bool:
+    try:
+        attributes = json.loads(msg.attributes)
+        if msg.destination == SELF:
+            pubsub.publish_self(attributes)
+        else:
+            pubsub.publish_rawls(attributes)
+        return True
+    except Exception:
+        logging.error(f"Failed to publish outbox message {msg.id} (attempt {msg.attempts}):\n{traceback.format_exc()}")
+        return False
+
+
+def start_relay() -> None:
+    """Start a daemon thread that publishes outbox messages as soon as relay_soon() is called, and polls for any we
+    weren't told about."""
+    global _relay_thread
+    if _relay_thread is not None and _relay_thread.is_alive():
+        return
+    _relay_thread = threading.Thread(target=_relay_loop, name="outbox-relay", daemon=True)
+    _relay_thread.start()
+
+
+def _relay_loop() -> None:
+    while True:
+        _wakeup.wait(RELAY_POLL_SECONDS)
+        _wakeup.clear()
+        try:
+            # keep going while there's a backlog
+            while relay_pending() == RELAY_BATCH_SIZE:
+                pass
+        except Exception:
+            # Catch-all so the relay thread never dies. The messages will still be there next time.
+            logging.error(f"Exception in outbox relay thread:\n{traceback.format_exc()}")
@@ -1,14 +1,17 @@
 import json
-from typing import Dict, Callable, Any
+from typing import Any, Callable, Dict, Optional
 
 import flask
 import humps
 from flask_restx import Api, Resource, fields
 
 import app.auth.service_auth
-from app import new_import, translate, status, health, cleanup
+from app import new_import, translate, status, status_watch, health, cleanup, outbox, stats
 from app.db import model
 from app.server.requestutils import httpify_excs, pubsubify_excs
+from app.util import metrics
+
+NEXT_PAGE_TOKEN_HEADER = "X-Next-Page-Token"
 
 routes = flask.Blueprint('import-service', __name__)
 
@@ -32,7 +35,17 @@ new_import_model = ns.model("NewImport",
                              {"path": fields.String(required=True),
                               "filetype": fields.String(enum=list(translate.FILETYPE_TRANSLATORS.keys()) + [translate.FILETYPE_NOTRANSLATION], required=True),
                               "isUpsert": fields.Boolean(required=False, default=True)})
+bulk_import_model = ns.model("BulkImport", {"imports": fields.List(fields.Nested(new_import_model), required=True)})
 import_status_response_model = ns.model("ImportStatusResponse", model.ImportStatusResponse.get_model())
+bulk_status_model = ns.model("BulkStatus", {"importIds": fields.List(fields.String, required=True)})
+bulk_import_result_model = ns.clone("BulkImportResult", import_status_response_model,
+                                    {"statusCode": fields.Integer(required=True, description="201 if the import was accepted, otherwise why not")})
+import_summary_model = ns.model("ImportSummary", {
+    "total": fields.Integer,
+    "byStatus": fields.Raw(description="Number of imports in each status"),
+    "byFiletype": fields.Raw(description="For each filetype, the number of imports in each status, if any"),
+    "oldestRunningSubmitTime": fields.String(description="When the oldest running import was submitted, if there is one"),
+    "oldestRunningAgeSeconds": fields.Float(description="How long ago that was")})
 health_response_model = ns.model("HealthResponse", health.HealthResponse.get_model(api))
 
 
@@ -42,10 +55,15 @@ health_response_model = ns.model("HealthResponse", health.HealthResponse.get_mod
 @ns.param('import_id', 'Import id')
 class SpecificImport(Resource):
     @httpify_excs
-    @ns.marshal_with(import_status_response_model, skip_none=True)
+    # serialized by hand rather than with marshal_with, so we can skip it entirely for 304s
+    @ns.response(200, 'Success', import_status_response_model)
+    @ns.response(304, 'Not Modified: the status matches the If-None-Match ETag')
+    @api.doc(params={'wait': {'in': 'query', 'type': 'integer',
+       'description': f"Wait up to this many seconds (max {status_watch.MAX_WAIT_SECONDS}) for the status to change before responding. With If-None-Match, wait for it to differ from that ETag. Returns straight away if the import is finished or the server is too busy to wait."}})
     def get(self, workspace_project, workspace_name, import_id):
         """Return status for this import."""
-        return status.handle_get_import_status(flask.request, workspace_project, workspace_name, import_id)
+        import_status = status.handle_get_import_status(flask.request, workspace_project, workspace_name, import_id)
+        return _conditional_response(status.status_etag([import_status]), lambda: import_status.to_dict())
 
 
 @ns.route('/<workspace_project>/<workspace_name>/imports')
@@ -55,17 +73,79 @@ class Imports(Resource):
     @httpify_excs
     @ns.expect(new_import_model, validate=True)
     @ns.marshal_with(import_status_response_model, code=201, skip_none=True)
+    @ns.response(200, 'An existing import: the one with the same Idempotency-Key, or with options.deduplicate, the same import already in flight')
+    @ns.response(422, 'The Idempotency-Key was already used for a different import')
+    @api.doc(params={new_import.IDEMPOTENCY_KEY_HEADER: {'in': 'header', 'type': 'string',
+       'description': "A unique value for this import, so that retrying the request doesn't import the file twice."}})
     def post(self, workspace_project, workspace_name):
         """Accept an import request."""
-        return new_import.handle(flask.request, workspace_project, workspace_name), 201
+        import_status, created = new_import.handle(flask.request, workspace_project, workspace_name)
+        return import_status, 201 if created else 200
 
     @httpify_excs
-    @ns.marshal_with(import_status_response_model, code=200, as_list=True, skip_none=True)
+    # serialized by hand rather than with marshal_with, which is slow for long lists; see ImportStatusResponse.to_dict
+    @ns.response(200, 'Success', [import_status_response_model])
+    @ns.response(304, 'Not Modified: the listing matches the If-None-Match ETag')
     @api.doc(params={'running_only': {'in':'query', 'type': 'boolean', 'default':False,
-       'description': "Return only running imports. Adding the query parameter ?running_only with no assigned value will assume true."}})
+       'description': "Return only running imports. Adding the query parameter ?running_only with no assigned value will assume true."},
+                     'page_size': {'in': 'query', 'type': 'integer',
+       'description': f"Return at most this many imports, newest first (max {status.MAX_PAGE_SIZE}). If there are more, the {NEXT_PAGE_TOKEN_HEADER} response header holds a page_token for the next page. Without page_size or page_token, all imports are returned."},
+                     'page_token': {'in': 'query', 'type': 'string',
+       'description': f"Continue listing from a previous page's {NEXT_PAGE_TOKEN_HEADER} response header."}})
     def get(self, workspace_project, workspace_name):
         """Return all imports in the workspace."""
-        return status.handle_list_import_status(flask.request, workspace_project, workspace_name)
+        import_statuses, next_page_token = status.handle_list_import_status(flask.request, workspace_project, workspace_name)
+        headers = {NEXT_PAGE_TOKEN_HEADER: next_page_token} if next_page_token else {}
+        return _conditional_response(status.status_etag(import_statuses, next_page_token),
+                                     lambda: [import_status.to_dict() for import_status in import_statuses], headers)
+
+
+def _conditional_response(etag: str, body: Callable[[], Any], headers: Optional[Dict[str, str]] = None):
+    """Return 304 Not Modified if the client's If-None-Match says it already has this ETag, and body() with the ETag
+    otherwise. Pollers mostly see the same status over and over, and this saves serializing and sending it."""
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304, headers=headers)
+        response.set_etag(etag)
+        return response
+    return body(), 200, {**(headers or {}), "ETag": f'"{etag}"'}
+
+
+@ns.route('/<workspace_project>/<workspace_name>/imports/bulk')
+@ns.param('workspace_project', 'Workspace project')
+@ns.param('workspace_name', 'Workspace name')
+class BulkImports(Resource):
+    @httpify_excs
+    @ns.expect(bulk_import_model, validate=True)
+    @ns.response(200, 'A result for each import, in order', [bulk_import_result_model])
+    def post(self, workspace_project, workspace_name):
+        """Accept up to BULK_IMPORT_MAX_ITEMS import requests at once. Valid ones are accepted even if others aren't."""
+        return new_import.handle_bulk(flask.request, workspace_project, workspace_name), 200
+
+
+@ns.route('/<workspace_project>/<workspace_name>/imports/status')
+@ns.param('workspace_project', 'Workspace project')
+@ns.param('workspace_name', 'Workspace name')
+class BulkImportStatus(Resource):
+    @httpify_excs
+    @ns.expect(bulk_status_model, validate=True)
+    @ns.response(200, 'Success', [import_status_response_model])
+    @ns.response(304, 'Not Modified: the statuses match the If-None-Match ETag')
+    def post(self, workspace_project, workspace_name):
+        """Return status for each of these imports, in order. Ids that aren't imports in this workspace are left out."""
+        import_statuses = status.handle_bulk_import_status(flask.request, workspace_project, workspace_name)
+        return _conditional_response(status.status_etag(import_statuses),
+                                     lambda: [import_status.to_dict() for import_status in import_statuses])
+
+
+@ns.route('/<workspace_project>/<workspace_name>/imports/summary')
+@ns.param('workspace_project', 'Workspace project')
+@ns.param('workspace_name', 'Workspace name')
+class ImportSummary(Resource):
+    @httpify_excs
+    @ns.marshal_with(import_summary_model, code=200)
+    def get(self, workspace_project, workspace_name):
+        """Return counts of the workspace's imports by status and filetype, and the age of the oldest running one."""
+        return status.handle_import_summary(flask.request, workspace_project, workspace_name), 200
 
 
 @ns.route('/health')
@@ -77,12 +157,36 @@ class Health(Resource):
         """Return whether we and all dependent subsystems are healthy."""
         return health.handle_health_check(), 200
 
+@ns.route('/metrics', doc=False)
+class Metrics(Resource):
+    @httpify_excs
+    def get(self):
+        """Return this instance's in-process metrics. Only for operators; see service_auth.verify_operator."""
+        app.auth.service_auth.verify_operator(flask.request)
+        return metrics.snapshot(), 200
+
+@ns.route('/stats/stage-durations', doc=False)
+class StageDurations(Resource):
+    @httpify_excs
+    def get(self):
+        """Return percentiles of how long imports spent in each status, over ?since to ?until, optionally for one
+        ?filetype. Only for operators; see service_auth.verify_operator."""
+        app.auth.service_auth.verify_operator(flask.request)
+        return stats.handle_stage_durations(flask.request), 200
+
 @ns.route('/cleanup-jobs')
 class CleanUp(Resource):
     @httpify_excs
     @api.doc(security=None)
     def get(self):
+        cleanup.recover_stalled_translations()
         cleanup.clean_up_stale_imports(job_age_hours=36)
+        cleanup.archive_terminal_imports()
+        cleanup.purge_staged_manifests()
+        cleanup.purge_old_transitions()
+        # the outbox relays on each instance should have done this already, but instances come and go
+        outbox.relay_pending()
+        outbox.purge_sent(older_than_hours=24)
         return "ok", 200
 
 
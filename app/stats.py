@@ -0,0 +1,83 @@
+"""How long imports spend in each status, worked out from the import_status_transitions table. When users say imports
+have got slow, this tells us whether it's the queue, translation, or Rawls."""
+import itertools
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import flask
+
+from app.db import db
+from app.db.model import ImportStatus, ImportStatusTransition
+from app.util import exceptions, metrics
+
+DEFAULT_WINDOW = timedelta(hours=24)
+MAX_WINDOW = timedelta(days=7)
+# Most transitions we'll load for one request. They all end up in memory, so past this we ask for a narrower window
+# rather than read them all; a busy week can easily have more.
+MAX_TRANSITIONS = int(os.environ.get("STATS_MAX_TRANSITIONS", "200000"))
+
+# The statuses an import waits in, in order. Leaving the last one is the end of the import.
+STAGES = [ImportStatus.Pending, ImportStatus.Translating, ImportStatus.ReadyForUpsert, ImportStatus.Upserting]
+TOTAL = "Total"
+
+
+def handle_stage_durations(request: flask.Request) -> dict:
+    until = _parse_time(request.args.get("until"), "until") or datetime.now()
+    since = _parse_time(request.args.get("since"), "since") or until - DEFAULT_WINDOW
+    if not timedelta(0) < until - since <= MAX_WINDOW:
+        raise exceptions.BadJsonException(f"since must be before until, and no more than {MAX_WINDOW} before it",
+                                          audit_log=False)
+    filetype = request.args.get("filetype")
+
+    durations = stage_durations(since, until, filetype)
+    return {
+        "since": since.isoformat(),
+        "until": until.isoformat(),
+        "filetype": filetype,
+        "stages": {stage: {"count": len(seconds),
+                           "mean_seconds": sum(seconds) / len(seconds) if seconds else 0.0,
+                           "max_seconds": max(seconds, default=0.0),
+                           **metrics.percentiles(seconds)}
+                   for stage, seconds in durations.items()}
+    }
+
+
+def stage_durations(since: datetime, until: datetime, filetype: Optional[str] = None) -> Dict[str, List[float]]:
+    """Seconds spent in each of the STAGES, for every time an import left that stage between since and until, plus
+    the total time from submission to a terminal status for imports that reached one in that window. Refuses with a
+    BadJsonException if that means reading more than MAX_TRANSITIONS transitions."""
+    T = ImportStatusTransition
+    with db.session_ctx() as sess:
+        in_window = sess.query(T.import_id).filter(T.time >= since, T.time < until)
+        if filetype is not None:
+            in_window = in_window.filter(T.filetype == filetype)
+        # all transitions for those imports, including the ones before the window, so we know when each stage began
+        rows = sess.query(T.import_id, T.status, T.time) \
+            .filter(T.import_id.in_(in_window.distinct().scalar_subquery())) \
+            .order_by(T.import_id, T.time, T.id).limit(MAX_TRANSITIONS + 1).all()
+    if len(rows) > MAX_TRANSITIONS:
+        raise exceptions.BadJsonException(f"More than {MAX_TRANSITIONS} status changes to look at; "
+                                          f"try a shorter window, or one filetype", audit_log=False)
+
+    durations: Dict[str, List[float]] = {stage.name: [] for stage in STAGES}
+    durations[TOTAL] = []
+    for _, group in itertools.groupby(rows, key=lambda row: row.import_id):
+        transitions = list(group)
+        for entered, left in zip(transitions, transitions[1:]):
+            if entered.status in STAGES and since <= left.time < until:
+                durations[entered.status.name].append((left.time - entered.time).total_seconds())
+        first, last = transitions[0], transitions[-1]
+        if first.status == ImportStatus.Pending and last.status in ImportStatus.terminal_statuses() \
+                and since <= last.time < until:
+            durations[TOTAL].append((last.time - first.time).total_seconds())
+    return durations
+
+
+def _parse_time(value: Optional[str], name: str) -> Optional[datetime]:
+    if value is None:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise exceptions.BadJsonException(f"{name} must be an ISO 8601 timestamp, not {value}", audit_log=False)
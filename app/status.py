@@ -1,16 +1,29 @@
+import base64
+import binascii
 import flask
+import hashlib
+import json
 import logging
+import os
 import traceback
-from sqlalchemy.orm.exc import NoResultFound
-from typing import Dict, List
+from datetime import datetime, timedelta
+from sqlalchemy import and_, func, null, or_, select, union_all
+from sqlalchemy.sql import Select
+from typing import Dict, List, Optional, Tuple, Type
 
 from app.auth import user_auth
 from app.db import db, model
 from app.db.model import ImportStatus
+from app import status_watch
 from app.external import sam
 from app.translators import sync_permissions as sync
 from app.util import exceptions
 
+# Largest page of imports we'll return when listing with ?page_size.
+MAX_PAGE_SIZE = int(os.environ.get("LIST_IMPORTS_MAX_PAGE_SIZE", "1000"))
+# Most imports we'll look up in one bulk status request.
+MAX_BULK_STATUS_IDS = int(os.environ.get("BULK_STATUS_MAX_IDS", "1000"))
+
 
 def handle_get_import_status(request: flask.Request, ws_ns: str, ws_name: str, import_id: str) -> model.ImportStatusResponse:
     access_token = user_auth.extract_auth_token(request)
@@ -18,22 +31,124 @@ def handle_get_import_status(request: flask.Request, ws_ns: str, ws_name: str, i
 
     # make sure the user is allowed to view the workspace containing the import
     user_auth.workspace_uuid_and_project_with_auth(ws_ns, ws_name, access_token, "read")
+    wait = _parse_wait(request.args.get("wait"))
 
-    try:
+    with db.session_ctx(read_only=True) as sess:
+        row = _find_import(sess, ws_ns, ws_name, import_id)
+    if db.has_replica() and (row is None or row.submit_time >= _replica_cutoff()):
+        # the replica may not have caught up with an import this new, so ask the primary
         with db.session_ctx() as sess:
-            imprt = sess.query(model.Import).\
-                filter(model.Import.workspace_namespace == ws_ns).\
-                filter(model.Import.workspace_name == ws_name).\
-                filter(model.Import.id == import_id).one()
-            return imprt.to_status_response()
-    except NoResultFound:
+            row = _find_import(sess, ws_ns, ws_name, import_id)
+
+    if row is None:
         raise exceptions.NotFoundException(message=f"Import {import_id} not found")
+    import_status = model.Import.status_response_from_row(row)
+
+    if wait and _should_wait(request, import_status):
+        etag = status_etag([import_status])
+
+        def changed() -> bool:
+            nonlocal import_status
+            # ask the primary: a waiter is woken as soon as a change commits, long before it reaches the replica
+            with db.session_ctx() as sess:
+                latest = _find_import(sess, ws_ns, ws_name, import_id)
+            if latest is not None:
+                import_status = model.Import.status_response_from_row(latest)
+            return status_etag([import_status]) != etag
+
+        status_watch.wait_until(import_id, changed, wait)
+    return import_status
+
+
+def _parse_wait(wait: Optional[str]) -> int:
+    if wait is None:
+        return 0
+    try:
+        seconds = int(wait)
+    except ValueError:
+        raise exceptions.BadJsonException(f"wait must be an integer number of seconds, not {wait}", audit_log=False)
+    if not 0 <= seconds <= status_watch.MAX_WAIT_SECONDS:
+        raise exceptions.BadJsonException(f"wait must be between 0 and {status_watch.MAX_WAIT_SECONDS}", audit_log=False)
+    return seconds
+
+
+def _should_wait(request: flask.Request, import_status: model.ImportStatusResponse) -> bool:
+    """Whether to hold a ?wait request until the import's status changes, rather than answering now."""
+    if ImportStatus.from_string(import_status.status) in ImportStatus.terminal_statuses():
+        return False  # it's never going to change
+    if request.if_none_match and not request.if_none_match.contains(status_etag([import_status])):
+        return False  # it's already changed since the client last looked
+    # A held request ties up its worker, which with a single-threaded worker means the whole worker.
+    return bool(request.environ.get("wsgi.multithread"))
+
+
+def handle_bulk_import_status(request: flask.Request, ws_ns: str, ws_name: str) -> List[model.ImportStatusResponse]:
+    """Statuses for the imports in the request body's importIds, in that order. Ids that aren't imports in this
+    workspace are left out."""
+    request_json = request.get_json(force=True, silent=True)
+    import_ids = request_json.get("importIds") if isinstance(request_json, dict) else None
+    if not isinstance(import_ids, list) or not all(isinstance(import_id, str) for import_id in import_ids):
+        raise exceptions.BadJsonException("Input payload is not valid", audit_log=False)
+    if not 1 <= len(import_ids) <= MAX_BULK_STATUS_IDS:
+        raise exceptions.BadJsonException(f"importIds must have between 1 and {MAX_BULK_STATUS_IDS} ids", audit_log=False)
+    import_ids = list(dict.fromkeys(import_ids))
+
+    access_token = user_auth.extract_auth_token(request)
+    sam.validate_user(access_token)
 
+    # make sure the user is allowed to view this workspace
+    user_auth.workspace_uuid_and_project_with_auth(ws_ns, ws_name, access_token, "read")
+
+    with db.session_ctx(read_only=True) as sess:
+        rows = _find_imports(sess, ws_ns, ws_name, import_ids)
+    if db.has_replica():
+        # as for a single import, ask the primary about any the replica may not have caught up with
+        cutoff = _replica_cutoff()
+        recheck = [import_id for import_id in import_ids if import_id not in rows or rows[import_id].submit_time >= cutoff]
+        if recheck:
+            with db.session_ctx() as sess:
+                rows.update(_find_imports(sess, ws_ns, ws_name, recheck))
+
+    return [model.Import.status_response_from_row(rows[import_id]) for import_id in import_ids if import_id in rows]
+
+
+def _find_import(sess: db.DBSession, ws_ns: str, ws_name: str, import_id: str):
+    return _find_imports(sess, ws_ns, ws_name, [import_id]).get(import_id)
+
+
+def _find_imports(sess: db.DBSession, ws_ns: str, ws_name: str, import_ids: List[str]) -> dict:
+    """Status response rows, plus submit_time, for whichever of import_ids are imports in this workspace, by id."""
+    found = {}
+    # imports that finished a while ago have been archived, so look there for any that aren't current ones
+    tables: Tuple[Type[model.ImportColumns], ...] = (model.Import, model.ArchivedImport)
+    for table in tables:
+        missing = [import_id for import_id in import_ids if import_id not in found]
+        if not missing:
+            break
+        for row in sess.query(*table.status_response_columns(), table.submit_time).\
+                filter(table.workspace_namespace == ws_ns).\
+                filter(table.workspace_name == ws_name).\
+                filter(table.id.in_(missing)):
+            found[row.id] = row
+    return found
 
-def handle_list_import_status(request: flask.Request, ws_ns: str, ws_name: str) -> List[model.ImportStatusResponse]:
+
+def _replica_cutoff() -> datetime:
+    """Imports submitted since this might not have reached the replica yet."""
+    return datetime.now() - timedelta(seconds=db.REPLICA_MAX_LAG_SECONDS)
+
+
+def handle_list_import_status(request: flask.Request, ws_ns: str, ws_name: str) -> Tuple[List[model.ImportStatusResponse], Optional[str]]:
+    """List imports in the workspace, newest first. Returns the imports and a token for the next page, if there is one.
+    Without ?page_size or ?page_token you get every import in the workspace, as before pagination existed."""
     # in the case where someone specifies ?running_only rather than ?running_only=true, assume true
     # this also means that ?running_only=boom is interpreted as true, but that seems okay to me
     running_only = request.args.get("running_only", "False").lower() != "false"
+    page_size = _parse_page_size(request.args.get("page_size"))
+    page_token = request.args.get("page_token")
+    after = _decode_page_token(page_token) if page_token else None
+    if after is not None and page_size is None:
+        page_size = MAX_PAGE_SIZE
 
     access_token = user_auth.extract_auth_token(request)
     sam.validate_user(access_token)
@@ -41,15 +156,124 @@ def handle_list_import_status(request: flask.Request, ws_ns: str, ws_name: str)
     # make sure the user is allowed to view this workspace
     user_auth.workspace_uuid_and_project_with_auth(ws_ns, ws_name, access_token, "read")
 
-    with db.session_ctx() as sess:
-        q = sess.query(model.Import).\
-            filter(model.Import.workspace_namespace == ws_ns).\
-            filter(model.Import.workspace_name == ws_name)
-        q = q.filter(model.Import.status.in_(ImportStatus.running_statuses())) if running_only else q
-        import_list = q.order_by(model.Import.submit_time.desc()).all()
-        import_statuses = [imprt.to_status_response() for imprt in import_list]
+    # fetch one extra so we know whether there's another page
+    limit = page_size + 1 if page_size is not None else None
+    listing = _listing_select(model.Import, ws_ns, ws_name, running_only, after, limit)
+    if not running_only:
+        # finished imports may have been archived; running ones never are
+        archived = _listing_select(model.ArchivedImport, ws_ns, ws_name, running_only, after, limit)
+        both = union_all(select(listing.subquery()), select(archived.subquery())).subquery()  # type: ignore[attr-defined]
+        listing = select(both).order_by(both.c.submit_time.desc(), both.c.id.desc()).limit(limit)
+
+    with db.session_ctx(read_only=True) as sess:
+        rows = sess.execute(listing).all()
+    if db.has_replica():
+        # the replica may be missing the newest imports, or have stale statuses for them; get those from the primary
+        cutoff = _replica_cutoff()
+        recent = _listing_select(model.Import, ws_ns, ws_name, running_only, after, limit).\
+            where(model.Import.submit_time >= cutoff)
+        with db.session_ctx() as sess:
+            rows = sess.execute(recent).all() + [row for row in rows if row.submit_time < cutoff]
+        rows = sorted(rows, key=lambda row: (row.submit_time, row.id), reverse=True)[:limit]
+
+    next_page_token = None
+    if page_size is not None and len(rows) > page_size:
+        rows = rows[:page_size]
+        next_page_token = _encode_page_token(rows[-1].submit_time, rows[-1].id)
+    return [model.Import.status_response_from_row(row) for row in rows], next_page_token
+
 
-        return import_statuses
+def _listing_select(table: Type[model.ImportColumns], ws_ns: str, ws_name: str, running_only: bool,
+                    after: Optional[Tuple[datetime, str]], limit: Optional[int]) -> Select:
+    # only load the columns we need: hydrating whole Imports costs more than the query itself for big listings
+    q = select(*table.status_response_columns(), table.submit_time)  # type: ignore[call-arg]
+    q = q.where(table.workspace_namespace == ws_ns).where(table.workspace_name == ws_name)
+    q = q.where(table.status.in_(ImportStatus.running_statuses())) if running_only else q
+
+    # keyset pagination: carry on from the last import on the previous page, so every page costs the same
+    # no matter how far back the workspace's history goes
+    if after is not None:
+        after_time, after_id = after
+        q = q.where(or_(table.submit_time < after_time, and_(table.submit_time == after_time, table.id < after_id)))
+    return q.order_by(table.submit_time.desc(), table.id.desc()).limit(limit)
+
+
+def handle_import_summary(request: flask.Request, ws_ns: str, ws_name: str) -> dict:
+    """Counts of the workspace's imports by status and by filetype, and how long the oldest running one has been going.
+    This is what dashboards want from a listing, without sending every import to count. Served from the replica if
+    there is one, so it can be up to REPLICA_MAX_LAG_SECONDS behind."""
+    access_token = user_auth.extract_auth_token(request)
+    sam.validate_user(access_token)
+
+    # make sure the user is allowed to view this workspace
+    user_auth.workspace_uuid_and_project_with_auth(ws_ns, ws_name, access_token, "read")
+
+    # Grouped in the database, which only needs to scan each table's workspace/status/filetype index, and sends back a
+    # handful of rows however many imports there are. Archived imports are all finished, so there's no oldest running
+    # one among them.
+    tables: Tuple[Type[model.ImportColumns], ...] = (model.Import, model.ArchivedImport)
+    counts = union_all(*[
+        select(table.status, table.filetype, func.count().label("count"),  # type: ignore[arg-type]
+               func.min(table.submit_time).label("oldest") if table is model.Import else null().label("oldest")).
+        where(table.workspace_namespace == ws_ns).
+        where(table.workspace_name == ws_name).
+        group_by(table.status, table.filetype)
+        for table in tables])
+    with db.session_ctx(read_only=True) as sess:
+        rows = sess.execute(counts).all()
+
+    by_status = {status.name: 0 for status in ImportStatus}
+    by_filetype: Dict[str, Dict[str, int]] = {}
+    oldest_running: Optional[datetime] = None
+    for row in rows:
+        by_status[row.status.name] += row.count
+        filetype_counts = by_filetype.setdefault(row.filetype, {})
+        filetype_counts[row.status.name] = filetype_counts.get(row.status.name, 0) + row.count
+        if row.status in ImportStatus.running_statuses() and (oldest_running is None or row.oldest < oldest_running):
+            oldest_running = row.oldest
+
+    return {
+        "total": sum(by_status.values()),
+        "byStatus": by_status,
+        "byFiletype": by_filetype,
+        "oldestRunningSubmitTime": oldest_running.isoformat() if oldest_running else None,
+        "oldestRunningAgeSeconds": (datetime.now() - oldest_running).total_seconds() if oldest_running else None
+    }
+
+
+def status_etag(import_statuses: List[model.ImportStatusResponse], next_page_token: Optional[str] = None) -> str:
+    """A strong ETag for a status response. It's a hash of everything in the response, so it changes exactly when
+    the response does."""
+    digest = hashlib.sha256()
+    for import_status in import_statuses:
+        digest.update(json.dumps([import_status.jobId, import_status.status, import_status.filetype,
+                                  import_status.message]).encode())
+    digest.update(json.dumps(next_page_token).encode())
+    return digest.hexdigest()[:32]
+
+
+def _parse_page_size(page_size: Optional[str]) -> Optional[int]:
+    if page_size is None:
+        return None
+    try:
+        size = int(page_size)
+    except ValueError:
+        raise exceptions.BadJsonException(f"page_size must be an integer, not {page_size}", audit_log=False)
+    if not 1 <= size <= MAX_PAGE_SIZE:
+        raise exceptions.BadJsonException(f"page_size must be between 1 and {MAX_PAGE_SIZE}", audit_log=False)
+    return size
+
+
+def _encode_page_token(submit_time: datetime, import_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([submit_time.isoformat(), import_id]).encode()).decode()
+
+
+def _decode_page_token(token: str) -> Tuple[datetime, str]:
+    try:
+        submit_time, import_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return datetime.fromisoformat(submit_time), str(import_id)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise exceptions.BadJsonException("Invalid page_token", audit_log=False)
 
 
 def external_update_status(msg: Dict[str, str]) -> model.ImportStatusResponse:
@@ -64,43 +288,77 @@ def external_update_status(msg: Dict[str, str]) -> model.ImportStatusResponse:
     if new_status != ImportStatus.Error and "current_status" not in msg:
         raise exceptions.BadJsonException(f"Missing current_status key from update status request for import {import_id}", audit_log = True)
 
-    update_successful = True
+    error_message = None
+    if new_status == ImportStatus.Error:
+        error_message = msg.get("error_message", "External service set this import to Error")
+    elif new_status == ImportStatus.Done:
+        # Most imports have no permissions to sync, so they go straight to Done in the same conditional UPDATE as any
+        # other status, and we only read the import if that doesn't match.
+        with db.session_ctx() as sess:
+            moved = model.Import.transition_status(import_id, new_status, sess, only_if=sync.SYNC_NOT_REQUIRED)
+            imp: Optional[model.Import] = None if moved else \
+                sess.query(model.Import).filter(model.Import.id == import_id).one_or_none()
+        if moved:
+            return model.ImportStatusResponse(import_id, new_status.name, None, None)
+        # we may need to sync permissions to tdr if this is a tdr snapshot. Do it before we commit to Done, so if it
+        # fails we can say so, but outside any transaction, since it means calling Sam.
+        if imp is None:
+            return _update_missing_import(import_id, new_status)
+        if not _should_transition(import_id, imp.status, new_status):
+            return model.ImportStatusResponse(import_id, new_status.name, imp.filetype, None)
+        try:
+            sync.sync_permissions_if_necessary(imp, new_status)
+        except Exception as err:
+            logging.error(f"Error during permission syncing for import {import_id}: {traceback.format_exc()}")
+            error_message = f"All data imported successfully, but failed to synchronize permissions for import {import_id}: {err}"
+
+    # The transition rules are in the UPDATE itself, so in the usual case this is the only query we make.
+    logging.info(f"Attempting to update import {import_id} status from {msg.get('current_status')} to {new_status} ...")
     with db.session_ctx() as sess:
-        imp: model.Import = model.Import.get(import_id, sess)
-
-        # if the import job is already in a terminal state, this is an error.
-        if imp.status in ImportStatus.terminal_statuses():
-            raise exceptions.TerminalStatusChangeException(import_id, new_status, imp.status)
-
-        # if the import job is already in the requested state, noop. Possibly pub/sub double delivery.
-        elif new_status.value == imp.status.value:
-            logging.info(f"Attempt to move import {import_id}: from {imp.status} to {imp.status}. Likely pub/sub double delivery.")
-
-        # if the requested state would move the import job backwards, this is an error.
-        elif new_status.value < imp.status.value:
-            logging.info(f"Attempt to move import {import_id}: from {imp.status} to {imp.status}. Possible pub/sub out of order.")
-            raise exceptions.IllegalStatusChangeException(import_id, new_status, imp.status)
-
-        # if the requested state would move the import job forward, attempt to save.
-        else: # new_status.value > imp.status.value:
-            if new_status == ImportStatus.Error:
-                imp.write_error(msg.get("error_message", "External service set this import to Error"))
-            else:
-                current_status: ImportStatus = ImportStatus.from_string(msg["current_status"])
-
-                # we may need to sync permissions to tdr if this is a tdr snapshot
-                failed_sync = False
-                try:
-                    sync.sync_permissions_if_necessary(imp, new_status)
-                except Exception as err:
-                    failed_sync = True
-                    logging.error(f"Error during permission syncing for import {import_id}: {traceback.format_exc()}")
-                    imp.write_error(f"All data imported successfully, but failed to synchronize permissions for import {import_id}: {err}")
-                if not failed_sync:
-                    model.Import.update_status_exclusively(import_id, imp.status, new_status, sess)
-
-    if not update_successful:
-        logging.warning(f"Failed to update status for import {import_id}: wanted {current_status}->{new_status}, actually {imp.status}.")
+        moved = model.Import.transition_status(import_id, ImportStatus.Error if error_message else new_status, sess,
+                                               error_message)
+        # only go back for the status if the UPDATE didn't match, to find out why
+        current_status = None if moved else \
+            sess.query(model.Import.status).filter(model.Import.id == import_id).scalar()
+    if not moved and current_status is None:
+        return _update_missing_import(import_id, new_status)
+
+    if current_status is not None and _should_transition(import_id, current_status, new_status):
+        # the import was somewhere we could have moved it from, but it moved on before our UPDATE. Treat it like a
+        # late message: whatever moved it knew more recent news than we do.
+        logging.info(f"Import {import_id} changed status while we were moving it to {new_status}; now {current_status}.")
 
     # This goes back to Pub/Sub, nobody reads it
-    return model.ImportStatusResponse(import_id, new_status.name, imp.filetype, None)
+    return model.ImportStatusResponse(import_id, new_status.name, None, None)
+
+
+def _update_missing_import(import_id: str, new_status: ImportStatus) -> model.ImportStatusResponse:
+    """A status update for an import that isn't in the imports table. If it's been archived, it finished long ago and
+    this message is very late, so there's nothing to do. If it's not there either, we've never heard of it."""
+    with db.session_ctx() as sess:
+        archived_status = sess.query(model.ArchivedImport.status).filter(model.ArchivedImport.id == import_id).scalar()
+    if archived_status is None:
+        logging.warning(f"Got an update to {new_status} for import {import_id}, which doesn't exist")
+        raise exceptions.NotFoundException(f"Import {import_id} not found")
+    logging.info(f"Ignoring update of archived import {import_id} to {new_status}; it finished as {archived_status}")
+    return model.ImportStatusResponse(import_id, new_status.name, None, None)
+
+
+def _should_transition(import_id: str, current_status: ImportStatus, new_status: ImportStatus) -> bool:
+    """The same rules transition_status applies, but with reasons: raises if moving from current_status to new_status
+    is illegal, and returns False if it'd be a no-op."""
+    # if the import job is already in a terminal state, this is an error.
+    if current_status in ImportStatus.terminal_statuses():
+        raise exceptions.TerminalStatusChangeException(import_id, new_status, current_status)
+
+    # if the import job is already in the requested state, noop. Possibly pub/sub double delivery.
+    elif new_status.value == current_status.value:
+        logging.info(f"Attempt to move import {import_id}: from {current_status} to {new_status}. Likely pub/sub double delivery.")
+        return False
+
+    # if the requested state would move the import job backwards, this is an error.
+    elif new_status.value < current_status.value:
+        logging.info(f"Attempt to move import {import_id}: from {current_status} to {new_status}. Possible pub/sub out of order.")
+        raise exceptions.IllegalStatusChangeException(import_id, new_status, current_status)
+
+    return True
@@ -0,0 +1,92 @@
+"""Lets a request wait for an import's status to change; see the ?wait parameter on GET .../imports/<import_id>.
+
+Status changes committed on this instance wake waiters as soon as the transaction commits. Changes made on other
+instances are only seen by re-checking, so waiters also check the database every POLL_SECONDS."""
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, Set
+
+import sqlalchemy.event
+import sqlalchemy.orm
+
+from app.db.model import STATUS_CHANGED_KEY
+from app.util import metrics
+
+# Longest a client may ask us to wait.
+MAX_WAIT_SECONDS = int(os.environ.get("STATUS_MAX_WAIT_SECONDS", "50"))
+# How often a waiter checks the database for changes made on other instances.
+POLL_SECONDS = float(os.environ.get("STATUS_WAIT_POLL_SECONDS", "5"))
+# Threads per gunicorn worker; must match --threads in the Dockerfile.
+SERVER_THREADS = int(os.environ.get("SERVER_THREADS", "8"))
+# Most requests we hold open at once in this worker. Each one ties up a server thread, so past this we answer straight
+# away and the client polls instead. Always fewer than SERVER_THREADS, so waiters can never starve the pubsub pushes
+# and status updates that would wake them.
+MAX_WAITERS = min(int(os.environ.get("STATUS_MAX_WAITERS", str(SERVER_THREADS // 2))), SERVER_THREADS - 1)
+
+_lock = threading.Lock()
+_waiters: Dict[str, Set[threading.Event]] = {}
+_num_waiters = 0
+
+
+def wait_until(import_id: str, changed: Callable[[], bool], timeout: float) -> bool:
+    """Block until changed() returns True or timeout seconds pass, and return its last answer. changed() is called
+    whenever a status change to import_id commits on this instance, and every POLL_SECONDS in case it changed elsewhere.
+    If MAX_WAITERS requests are already waiting, don't wait at all."""
+    global _num_waiters
+    event = threading.Event()
+    with _lock:
+        if _num_waiters >= MAX_WAITERS:
+            metrics.increment("status_wait.rejected")
+            return False
+        _num_waiters += 1
+        _waiters.setdefault(import_id, set()).add(event)
+
+    try:
+        with metrics.timed("status_wait"):
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                event.wait(min(remaining, POLL_SECONDS))
+                event.clear()
+                if changed():
+                    return True
+    finally:
+        with _lock:
+            _num_waiters -= 1
+            events = _waiters[import_id]
+            events.discard(event)
+            if not events:
+                del _waiters[import_id]
+
+
+def notify(import_ids: Iterable[str]) -> None:
+    """Wake anyone waiting on these imports."""
+    with _lock:
+        for import_id in import_ids:
+            for event in _waiters.get(import_id, ()):
+                event.set()
+
+
+def num_waiters() -> int:
+    with _lock:
+        return _num_waiters
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_commit")
+def _after_commit(session: sqlalchemy.orm.Session) -> None:
+    changed = session.info.pop(STATUS_CHANGED_KEY, None)
+    if changed:
+        try:
+            notify(changed)
+        except Exception:
+            # the commit already happened, so never let this fail it; waiters will notice when they next poll
+            logging.exception("Failed to notify status waiters")
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_rollback")
+def _after_rollback(session: sqlalchemy.orm.Session) -> None:
+    session.info.pop(STATUS_CHANGED_KEY, None)
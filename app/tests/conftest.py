@@ -17,6 +17,7 @@ from unittest import mock
 from app import create_app
 from app.auth import service_auth, userinfo
 from app.db import db, model
+from app.external import rawls
 from app.external.rawls import RawlsWorkspaceResponse
 
 
@@ -133,3 +134,11 @@ def user_has_ws_access(monkeypatch):
 def pubsub_publish(monkeypatch):
     """Replace the publish to google pub/sub with a no-op one"""
     monkeypatch.setattr("app.external.pubsub.publish_self", mock.MagicMock())
+
+
+@pytest.fixture(scope="function", autouse=True)
+def empty_workspace_info_cache() -> Iterator[None]:
+    """The Rawls workspace info cache is process-wide, so don't let it leak between tests."""
+    rawls.clear_workspace_info_cache()
+    yield
+    rawls.clear_workspace_info_cache()
@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta
+from typing import Optional
+from unittest import mock
+
+from app import cleanup, translate
+from app.db import db
+from app.db.model import ArchivedImport, Import, ImportStatus, ImportStatusTransition, StagedTDRManifest
+
+
+def _add_import(status: ImportStatus, age_hours: int, lease_expired_minutes_ago: Optional[int] = None,
+                attempts: int = 0) -> str:
+    with db.session_ctx() as sess:
+        imprt = Import("name", "namespace", "uuid", "project", "hello@me.com", "http://path", "pfb")
+        imprt.status = status
+        imprt.submit_time = datetime.now() - timedelta(hours=age_hours)
+        if lease_expired_minutes_ago is not None:
+            imprt.lease_owner = "someone"
+            imprt.lease_expires = datetime.now() - timedelta(minutes=lease_expired_minutes_ago)
+        imprt.translation_attempts = attempts
+        sess.add(imprt)
+        return imprt.id
+
+
+def _status(import_id: str) -> ImportStatus:
+    with db.session_ctx() as sess:
+        return Import.get(import_id, sess).status
+
+
+def test_clean_up_stale_imports():
+    stalled = [_add_import(ImportStatus.Pending, 48), _add_import(ImportStatus.Upserting, 40)]
+    recent = _add_import(ImportStatus.Translating, 1)
+    done = _add_import(ImportStatus.Done, 48)
+    errored = _add_import(ImportStatus.Error, 48)
+
+    assert sorted(cleanup.clean_up_stale_imports(job_age_hours=36)) == sorted(stalled)
+
+    assert all(_status(i) == ImportStatus.TimedOut for i in stalled)
+    assert _status(recent) == ImportStatus.Translating
+    assert _status(done) == ImportStatus.Done
+    assert _status(errored) == ImportStatus.Error
+
+    # nothing left to do the second time round
+    assert cleanup.clean_up_stale_imports(job_age_hours=36) == []
+
+
+def test_clean_up_stale_imports_in_batches(monkeypatch):
+    monkeypatch.setattr(cleanup, "CLEANUP_BATCH_SIZE", 2)
+    monkeypatch.setattr(cleanup, "CLEANUP_MAX_BATCHES", 2)
+    stalled = [_add_import(ImportStatus.Pending, 48) for _ in range(5)]
+
+    # two batches of two, then we stop and leave the rest for next time
+    first = cleanup.clean_up_stale_imports(job_age_hours=36)
+    assert len(first) == 4
+    assert cleanup.clean_up_stale_imports(job_age_hours=36) == [i for i in stalled if i not in first]
+
+
+def test_recover_stalled_translations(monkeypatch):
+    publish_self = mock.MagicMock()
+    monkeypatch.setattr("app.external.pubsub.publish_self", publish_self)
+    monkeypatch.setattr(translate, "MAX_TRANSLATION_ATTEMPTS", 3)
+
+    dead = _add_import(ImportStatus.Translating, 1, lease_expired_minutes_ago=5, attempts=1)
+    dead_too_often = _add_import(ImportStatus.Translating, 1, lease_expired_minutes_ago=5, attempts=3)
+    alive = _add_import(ImportStatus.Translating, 1, lease_expired_minutes_ago=-5, attempts=1)
+    upserting = _add_import(ImportStatus.Upserting, 1, lease_expired_minutes_ago=5, attempts=1)
+
+    assert cleanup.recover_stalled_translations() == ([dead], [dead_too_often])
+
+    assert _status(dead) == ImportStatus.Pending
+    publish_self.assert_called_once_with({"action": "translate", "import_id": dead})
+    assert _status(dead_too_often) == ImportStatus.Error
+    assert _status(alive) == ImportStatus.Translating
+    assert _status(upserting) == ImportStatus.Upserting
+
+
+def test_archive_terminal_imports(monkeypatch):
+    monkeypatch.setattr(cleanup, "ARCHIVE_AFTER_DAYS", 30)
+    old_done = _add_import(ImportStatus.Done, 24 * 40)
+    old_error = _add_import(ImportStatus.Error, 24 * 40)
+    old_running = _add_import(ImportStatus.Upserting, 24 * 40)
+    recent_done = _add_import(ImportStatus.Done, 1)
+
+    assert cleanup.archive_terminal_imports() == 2
+
+    with db.session_ctx() as sess:
+        assert {row.id for row in sess.query(Import.id)} == {old_running, recent_done}
+        archived = {row.id: row for row in sess.query(ArchivedImport)}
+    assert archived.keys() == {old_done, old_error}
+    assert archived[old_error].status == ImportStatus.Error
+    assert archived[old_done].import_url == "http://path"
+
+
+def test_purge_staged_manifests(monkeypatch):
+    monkeypatch.setattr(cleanup, "CLEANUP_BATCH_SIZE", 1)
+    waiting, translating, errored, timed_out = [_add_import(status, 1) for status in
+                                                (ImportStatus.Pending, ImportStatus.Translating,
+                                                 ImportStatus.Error, ImportStatus.TimedOut)]
+    with db.session_ctx() as sess:
+        # the last is for an import that's since been archived
+        sess.add_all([StagedTDRManifest(import_id, b'{"snapshot": {}}')
+                      for import_id in (waiting, translating, errored, timed_out, "archived")])
+
+    assert cleanup.purge_staged_manifests() == 3
+
+    with db.session_ctx() as sess:
+        assert {row.import_id for row in sess.query(StagedTDRManifest.import_id)} == {waiting, translating}
+        assert StagedTDRManifest.get(waiting, sess) == b'{"snapshot": {}}'
+
+
+def test_purge_old_transitions(monkeypatch):
+    monkeypatch.setattr(cleanup, "CLEANUP_BATCH_SIZE", 2)
+    now = datetime.now()
+    with db.session_ctx() as sess:
+        sess.add_all([ImportStatusTransition(f"old{i}", ImportStatus.Pending, "pfb", now - timedelta(days=31))
+                      for i in range(3)])
+        sess.add(ImportStatusTransition("recent", ImportStatus.Pending, "pfb", now - timedelta(days=29)))
+
+    assert cleanup.purge_old_transitions() == 3
+
+    with db.session_ctx() as sess:
+        assert [row.import_id for row in sess.query(ImportStatusTransition.import_id)] == ["recent"]
@@ -1,4 +1,5 @@
 from app.db import db, model
+from app.util import metrics
 from sqlalchemy.sql import text
 
 
@@ -72,3 +73,10 @@ def test_raise_inside_session(fake_import: model.Import):
     with db.session_ctx() as sess3:
         imp: model.Import = model.Import.get(fake_import.id, sess3)
         assert imp is not None
+
+
+def test_session_ctx_records_checkout_wait():
+    metrics.reset()
+    with db.session_ctx() as sess:
+        sess.execute(text("select 1"))
+    assert metrics.snapshot()["timings"]["db.pool.checkout_wait"]["count"] == 1
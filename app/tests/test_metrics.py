@@ -0,0 +1,47 @@
+from unittest import mock
+
+import pytest
+
+from app.auth import service_auth
+from app.util import exceptions, metrics
+
+
+@pytest.fixture(scope="function", autouse=True)
+def empty_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_timings():
+    for ms in range(1, 101):
+        metrics.observe_seconds("thing", ms / 1000)
+
+    thing = metrics.snapshot()["timings"]["thing"]
+    assert thing["count"] == 100
+    assert thing["max_seconds"] == 0.1
+    assert thing["p50_seconds"] == pytest.approx(0.051)
+    assert thing["p99_seconds"] == pytest.approx(0.1)
+
+
+def test_timed_records_on_exception():
+    with pytest.raises(KeyError):
+        with metrics.timed("broken"):
+            raise KeyError
+    assert metrics.snapshot()["timings"]["broken"]["count"] == 1
+
+
+def test_counters(client, monkeypatch):
+    monkeypatch.setattr(service_auth, "verify_operator", mock.MagicMock())
+    metrics.increment("things")
+    metrics.increment("things", 2)
+    assert metrics.snapshot()["counters"] == {"things": 3}
+
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.json["counters"] == {"things": 3}
+
+
+def test_metrics_endpoint_needs_operator(client, monkeypatch):
+    monkeypatch.setattr(service_auth, "verify_operator", mock.MagicMock(side_effect=exceptions.AuthorizationException()))
+    assert client.get("/metrics").status_code == 403
@@ -3,6 +3,7 @@ import pytest
 from app.db import db, model
 from app.db.model import ImportStatus
 import copy
+from flask_restx import marshal
 
 
 def test_eq(fake_import: model.Import):
@@ -98,3 +99,37 @@ def test_save_snapshot_id_exclusively(fake_import: model.Import):
 
         updated_import = model.Import.get(fake_import.id, sess2)
         assert updated_import.snapshot_id == "fake_snapshot_id"
+
+
+@pytest.mark.parametrize("message", [None, "broke"])
+def test_status_response_to_dict_matches_marshal(fake_import: model.Import, message):
+    fake_import.error_message = message
+    with db.session_ctx() as sess:
+        sess.add(fake_import)
+
+    with db.session_ctx() as sess:
+        row = sess.query(*model.Import.status_response_columns()).filter(model.Import.id == fake_import.id).one()
+        response = model.Import.status_response_from_row(row)
+
+    assert vars(response) == vars(fake_import.to_status_response())
+    assert response.to_dict() == marshal(response, model.ImportStatusResponse.get_model(), skip_none=True)
+
+
+def test_transition_status(fake_import: model.Import):
+    fake_import.status = ImportStatus.ReadyForUpsert
+    with db.session_ctx() as sess:
+        sess.add(fake_import)
+
+    with db.session_ctx() as sess:
+        # backwards and no-op transitions don't match
+        assert not model.Import.transition_status(fake_import.id, ImportStatus.Translating, sess)
+        assert not model.Import.transition_status(fake_import.id, ImportStatus.ReadyForUpsert, sess)
+        assert model.Import.transition_status(fake_import.id, ImportStatus.Upserting, sess)
+        assert model.Import.transition_status(fake_import.id, ImportStatus.Error, sess, error_message="a" * 3000)
+        # and nothing gets out of a terminal status
+        assert not model.Import.transition_status(fake_import.id, ImportStatus.Done, sess)
+
+    with db.session_ctx() as sess:
+        imp = model.Import.get(fake_import.id, sess)
+        assert imp.status == ImportStatus.Error
+        assert imp.error_message is not None and len(imp.error_message) == model.Import.MAX_ERROR_MESSAGE_LENGTH
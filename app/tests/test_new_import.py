@@ -1,6 +1,9 @@
 import flask.testing
+import io
 import json
 import pytest
+import requests.exceptions
+from datetime import datetime, timedelta
 from unittest import mock
 
 from app.tests import testutils
@@ -55,6 +58,10 @@ def test_tdr_json_golden_path(client):
     assert dbres[0].is_tdr_sync_required is True # could just assert True, adding check to be explicit
     assert resp.headers["Content-Type"] == "application/json"
 
+    # we keep the manifest, so translation doesn't have to download it again
+    with open("app/tests/resources/test_tdr_response_gcp.json", 'rb') as manifest:
+        assert StagedTDRManifest.get(id, sess) == manifest.read()
+
 @pytest.mark.usefixtures("sam_valid_user", "user_has_ws_access")
 def test_wrong_path(client: flask.testing.FlaskClient):
     resp = client.post('/imports')
@@ -247,3 +254,151 @@ def test_blocks_cross_platform_tdr_imports(monkeypatch, client, manifest, worksp
     resp = client.post('/mynamespace/myname/imports', json=good_tdr_json, headers=good_headers)
     assert resp.status_code == 400
     assert resp.text == "Import Not Allowed - Unable to import TDR data across cloud platforms"
+
+
+@pytest.mark.usefixtures("sam_valid_user", "user_has_ws_access", "pubsub_fake_env")
+def test_publish_failure_leaves_message_in_outbox(client, monkeypatch):
+    """If pub/sub is unavailable the import is still accepted, and the translate message waits in the outbox."""
+    monkeypatch.setattr("app.external.pubsub.publish_self", mock.MagicMock(side_effect=RuntimeError("pubsub is down")))
+    resp = client.post('/mynamespace/myname/imports', json=good_json, headers=good_headers)
+    assert resp.status_code == 201
+
+    with db.session_ctx() as sess:
+        [msg] = sess.query(PubSubOutboxMessage).all()
+        assert json.loads(msg.attributes) == {"action": "translate", "import_id": resp.json["jobId"]}
+        assert msg.sent_time is None
+
+
+@pytest.mark.usefixtures("sam_valid_user", "pubsub_publish", "pubsub_fake_env")
+def test_bulk_imports(client, monkeypatch):
+    ws_auth = mock.MagicMock(return_value=RawlsWorkspaceResponse("some-uuid", "some-project", "gcp", set(), "fc-secure-12345678-a901-23b4-c5d6-7ef8a90b1cd2"))
+    monkeypatch.setattr("app.auth.user_auth.workspace_uuid_and_project_with_auth", ws_auth)
+    bad_json = {"path": "https://evilsite.com/some/path", "filetype": "pfb"}
+
+    resp = client.post('/mynamespace/myname/imports/bulk', json={"imports": [good_json, bad_json, {**good_json, "isUpsert": False}]},
+                       headers=good_headers)
+    assert resp.status_code == 200
+    ws_auth.assert_called_once()
+
+    good, bad, not_upsert = resp.json
+    assert bad["statusCode"] == 400
+    assert "Path Not Allowed" in bad["message"]
+    assert (good["statusCode"], good["status"]) == (201, ImportStatus.Pending.name)
+    assert (not_upsert["statusCode"], not_upsert["status"]) == (201, ImportStatus.Pending.name)
+
+    with db.session_ctx() as sess:
+        imports = {i.id: i for i in sess.query(Import).all()}
+        assert imports.keys() == {good["jobId"], not_upsert["jobId"]}
+        assert imports[good["jobId"]].is_upsert and not imports[not_upsert["jobId"]].is_upsert
+        messages = [json.loads(msg.attributes)["import_id"] for msg in sess.query(PubSubOutboxMessage).all()]
+        assert sorted(messages) == sorted(imports.keys())
+
+
+@pytest.mark.parametrize("manifest", [mock.MagicMock(return_value=io.BytesIO(b"not json")),
+                                      mock.MagicMock(return_value=io.BytesIO(b'{"snapshot": {}}')),
+                                      mock.MagicMock(side_effect=requests.exceptions.ConnectionError("unreachable"))])
+@pytest.mark.usefixtures("sam_valid_user", "user_has_ws_access", "pubsub_publish", "pubsub_fake_env")
+def test_bulk_imports_bad_tdr_manifest(client, monkeypatch, manifest):
+    """A TDR manifest that can't be read fails only its own import."""
+    monkeypatch.setattr(new_import.http, "http_as_filelike", manifest)
+    resp = client.post('/mynamespace/myname/imports/bulk', json={"imports": [good_tdr_json, good_json]},
+                       headers=good_headers)
+    assert resp.status_code == 200
+
+    bad, good = resp.json
+    assert bad["statusCode"] == 400
+    assert "Unable to read TDR manifest" in bad["message"]
+    assert good["statusCode"] == 201
+    with db.session_ctx() as sess:
+        assert [i.id for i in sess.query(Import).all()] == [good["jobId"]]
+
+
+@pytest.mark.parametrize("body", [{}, {"imports": []}, {"imports": [good_json] * (new_import.MAX_BULK_IMPORTS + 1)},
+                                  {"imports": [{"filetype": "pfb"}]}])
+@pytest.mark.usefixtures("sam_valid_user", "user_has_ws_access", "pubsub_publish", "pubsub_fake_env")
+def test_bulk_imports_bad_json(client, body):
+    resp = client.post('/mynamespace/myname/imports/bulk', json=body, headers=good_headers)
+    assert resp.status_code == 400
+    with db.session_ctx() as sess:
+        assert sess.query(Import).count() == 0
+
+
+@pytest.mark.usefixtures("sam_valid_user", "user_has_ws_access", "pubsub_publish", "pubsub_fake_env")
+def test_idempotency_key(client, monkeypatch):
+    headers = {**good_headers, "Idempotency-Key": "load-42"}
+    first = client.post('/mynamespace/myname/imports', json=good_json, headers=headers)
+    assert first.status_code == 201
+
+    retry = client.post('/mynamespace/myname/imports', json=good_json, headers=headers)
+    assert retry.status_code == 200
+    assert retry.json["jobId"] == first.json["jobId"]
+
+    # the key is only reused within a workspace
+    elsewhere = client.post('/mynamespace/othername/imports', json=good_json, headers=headers)
+    assert elsewhere.status_code == 201
+
+    different = client.post('/mynamespace/myname/imports', json={**good_json, "path": good_json["path"] + "2"}, headers=headers)
+    assert different.status_code == 422
+    not_upsert = client.post('/mynamespace/myname/imports', json={**good_json, "isUpsert": False}, headers=headers)
+    assert not_upsert.status_code == 422
+
+    # keys aren't supported in bulk
+    bulk = client.post('/mynamespace/myname/imports/bulk', json={"imports": [good_json]}, headers=headers)
+    assert bulk.status_code == 400
+
+    # a concurrent retry that gets past the first check loses at the unique index, and gets the winner's import
+    with db.session_ctx() as sess:
+        winner = Import.get(first.json["jobId"], sess)
+    monkeypatch.setattr(new_import, "_find_existing_import", mock.MagicMock(side_effect=[None, winner]))
+    racer = client.post('/mynamespace/myname/imports', json=good_json, headers=headers)
+    assert racer.status_code == 200
+    assert racer.json["jobId"] == first.json["jobId"]
+
+    with db.session_ctx() as sess:
+        assert sess.query(Import).count() == 2
+        assert sess.query(PubSubOutboxMessage).count() == 2
+
+
+@pytest.mark.usefixtures("sam_valid_user", "user_has_ws_access", "pubsub_publish", "pubsub_fake_env")
+def test_idempotency_key_of_archived_import(client):
+    headers = {**good_headers, "Idempotency-Key": "load-42"}
+    first = client.post('/mynamespace/myname/imports', json=good_json, headers=headers)
+    with db.session_ctx() as sess:
+        sess.query(Import).update({Import.status: ImportStatus.Done,
+                                   Import.submit_time: datetime.now() - timedelta(days=60)})
+    with db.session_ctx() as sess:
+        assert ArchivedImport.archive_terminal_imports(sess, datetime.now() - timedelta(days=30), 10) == \
+            [first.json["jobId"]]
+
+    retry = client.post('/mynamespace/myname/imports', json=good_json, headers=headers)
+    assert retry.status_code == 200
+    assert (retry.json["jobId"], retry.json["status"]) == (first.json["jobId"], ImportStatus.Done.name)
+    different = client.post('/mynamespace/myname/imports', json={**good_json, "isUpsert": False}, headers=headers)
+    assert different.status_code == 422
+
+    with db.session_ctx() as sess:
+        assert sess.query(Import).count() == 0
+
+
+@pytest.mark.usefixtures("sam_valid_user", "user_has_ws_access", "pubsub_publish", "pubsub_fake_env")
+def test_deduplicate_in_flight_imports(client):
+    dedupe_json = {**good_json, "options": {"deduplicate": True}}
+    first = client.post('/mynamespace/myname/imports', json=dedupe_json, headers=good_headers)
+    assert first.status_code == 201
+
+    # without asking for deduplication, you get another import
+    second = client.post('/mynamespace/myname/imports', json=good_json, headers=good_headers)
+    assert second.status_code == 201
+    # nor is an import that upserts a duplicate of one that doesn't
+    assert client.post('/mynamespace/myname/imports', json={**dedupe_json, "isUpsert": False}, headers=good_headers).status_code == 201
+
+    with db.session_ctx() as sess:
+        Import.transition_status(first.json["jobId"], ImportStatus.Translating, sess)
+    # the second plain import is newer, and just as much in flight
+    dupe = client.post('/mynamespace/myname/imports', json=dedupe_json, headers=good_headers)
+    assert dupe.status_code == 200
+    assert dupe.json["jobId"] == second.json["jobId"]
+
+    with db.session_ctx() as sess:
+        sess.query(Import).update({Import.status: ImportStatus.Done})
+    assert client.post('/mynamespace/myname/imports', json=dedupe_json, headers=good_headers).status_code == 201
@@ -0,0 +1,97 @@
+import json
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pytest
+
+from app import outbox
+from app.db import db
+from app.db.model import PubSubOutboxMessage
+
+
+@pytest.fixture(scope="function")
+def fake_publish(monkeypatch):
+    publish_self = mock.MagicMock()
+    publish_rawls = mock.MagicMock()
+    monkeypatch.setattr("app.external.pubsub.publish_self", publish_self)
+    monkeypatch.setattr("app.external.pubsub.publish_rawls", publish_rawls)
+    yield publish_self, publish_rawls
+
+
+def _all_messages():
+    with db.session_ctx() as sess:
+        return sess.query(PubSubOutboxMessage).order_by(PubSubOutboxMessage.id).all()
+
+
+def test_relay_publishes_and_marks_sent(fake_publish):
+    publish_self, publish_rawls = fake_publish
+    with db.session_ctx() as sess:
+        outbox.enqueue(sess, outbox.SELF, {"action": "translate", "import_id": "1"})
+        outbox.enqueue(sess, outbox.RAWLS, {"jobId": "2"})
+
+    assert outbox.relay_pending() == 2
+    publish_self.assert_called_once_with({"action": "translate", "import_id": "1"})
+    publish_rawls.assert_called_once_with({"jobId": "2"})
+    assert all(msg.sent_time is not None for msg in _all_messages())
+
+    # nothing left to send
+    assert outbox.relay_pending() == 0
+    assert publish_self.call_count == 1
+
+
+def test_enqueue_rolls_back_with_transaction(fake_publish):
+    with pytest.raises(NotImplementedError):
+        with db.session_ctx() as sess:
+            outbox.enqueue(sess, outbox.SELF, {"action": "translate", "import_id": "1"})
+            raise NotImplementedError
+
+    assert _all_messages() == []
+
+
+def test_failed_publish_is_retried(fake_publish):
+    publish_self, _ = fake_publish
+    publish_self.side_effect = RuntimeError("pubsub is down")
+    with db.session_ctx() as sess:
+        outbox.enqueue(sess, outbox.SELF, {"action": "translate", "import_id": "1"})
+
+    assert outbox.relay_pending() == 1
+    [msg] = _all_messages()
+    assert msg.sent_time is None
+    assert msg.attempts == 1
+
+    # still claimed, so nobody retries straight away
+    assert outbox.relay_pending() == 0
+
+    # once the claim expires, it's retried
+    publish_self.side_effect = None
+    with db.session_ctx() as sess:
+        sess.execute(PubSubOutboxMessage.__table__.update().values(claimed_until=datetime.now() - timedelta(seconds=1)))
+    assert outbox.relay_pending() == 1
+    [msg] = _all_messages()
+    assert msg.sent_time is not None
+    assert msg.attempts == 2
+
+
+def test_relay_batch_limit(fake_publish):
+    publish_self, _ = fake_publish
+    with db.session_ctx() as sess:
+        for i in range(5):
+            outbox.enqueue(sess, outbox.SELF, {"action": "translate", "import_id": str(i)})
+
+    assert outbox.relay_pending(limit=3) == 3
+    assert outbox.relay_pending(limit=3) == 2
+    assert sorted(c.args[0]["import_id"] for c in publish_self.call_args_list) == ["0", "1", "2", "3", "4"]
+
+
+def test_purge_sent(fake_publish):
+    with db.session_ctx() as sess:
+        outbox.enqueue(sess, outbox.SELF, {"action": "translate", "import_id": "1"})
+        outbox.enqueue(sess, outbox.SELF, {"action": "translate", "import_id": "2"})
+    outbox.relay_pending(limit=1)
+    with db.session_ctx() as sess:
+        sess.execute(PubSubOutboxMessage.__table__.update().values(sent_time=datetime.now() - timedelta(hours=25))
+                     .where(PubSubOutboxMessage.sent_time.isnot(None)))
+
+    assert outbox.purge_sent(older_than_hours=24) == 1
+    [msg] = _all_messages()
+    assert json.loads(msg.attributes)["import_id"] == "2"
@@ -0,0 +1,54 @@
+from unittest import mock
+
+import pytest
+
+from app.external import pubsub
+from app.util import metrics
+
+
+@pytest.fixture(scope="function")
+def fake_publisher_client(monkeypatch):
+    """Replace the real PublisherClient class with a mock, and make sure we start without a cached client."""
+    fake_client_class = mock.MagicMock()
+    monkeypatch.setattr(pubsub, "PublisherClient", fake_client_class)
+    monkeypatch.setattr(pubsub, "_publisher_client", None)
+    monkeypatch.setattr(pubsub, "_publisher_client_pid", None)
+    monkeypatch.setattr("app.auth.service_auth.get_isvc_refreshing_credential", mock.MagicMock())
+    yield fake_client_class
+
+
+@pytest.mark.usefixtures("pubsub_fake_env")
+def test_publisher_client_is_reused(fake_publisher_client):
+    pubsub.publish_self({"action": "translate", "import_id": "1"})
+    pubsub.publish_self({"action": "translate", "import_id": "2"})
+    pubsub.publish_rawls({"jobId": "1"})
+
+    fake_publisher_client.assert_called_once()
+    batch_settings = fake_publisher_client.call_args.kwargs["batch_settings"]
+    assert batch_settings.max_messages == pubsub.PUBLISH_BATCH_MAX_MESSAGES
+    assert batch_settings.max_latency == pubsub.PUBLISH_BATCH_MAX_LATENCY_SECONDS
+
+    publish = fake_publisher_client.return_value.publish
+    assert publish.call_count == 3
+    # we still wait for every message to be acknowledged
+    assert publish.return_value.result.call_count == 3
+
+
+@pytest.mark.usefixtures("pubsub_fake_env")
+def test_publisher_client_remade_after_fork(fake_publisher_client, monkeypatch):
+    pubsub.publish_self({"action": "translate", "import_id": "1"})
+    monkeypatch.setattr(pubsub.os, "getpid", lambda: -1)
+    pubsub.publish_self({"action": "translate", "import_id": "2"})
+
+    assert fake_publisher_client.call_count == 2
+
+
+@pytest.mark.usefixtures("pubsub_fake_env")
+def test_publish_latency_metrics(fake_publisher_client):
+    metrics.reset()
+    pubsub.publish_self({"action": "translate", "import_id": "1"})
+    pubsub.publish_rawls({"jobId": "1"})
+
+    timings = metrics.snapshot()["timings"]
+    assert timings["pubsub.publish_self"]["count"] == 1
+    assert timings["pubsub.publish_rawls"]["count"] == 1
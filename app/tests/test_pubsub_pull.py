@@ -4,33 +4,74 @@ import pytest
 
 from app import db
 from app.external import pubsub_pull
+from app.server.requestutils import PUBSUB_STATUS_RETRY
 
 
-def test_pubsub_pull(fake_import, client, monkeypatch):
+def fake_message(attributes: dict) -> mock.MagicMock:
+    """Something that looks like a message handed to us by a streaming pull."""
+    msg = mock.MagicMock()
+    msg.attributes = attributes
+    return msg
+
+
+def test_pubsub_pull(fake_import, client):
     """Test the pubsub pull mechanism by faking a message updating the status of an import."""
 
     # Add a fake import to the db.
     with db.session_ctx() as sess:
         sess.add(fake_import)
 
-    def fake_pull_self(_howmany: int):
-        """Fake version of pubsub.pull_self.
-        First call yields something that looks like a message.
-        Second call raises an exception so that loop() doesn't loop forever."""
-        fake_message = mock.MagicMock()
-        fake_message.message = mock.MagicMock()
-        fake_message.message.attributes = {"action": "status", "import_id": fake_import.id,
-                                           "current_status": "Pending",
-                                           "new_status": "Upserting"}
-        return [fake_message]
+    msg = fake_message({"action": "status", "import_id": fake_import.id,
+                        "current_status": "Pending",
+                        "new_status": "Upserting"})
 
-    # Overwrite the pubsub module to use fake_pull_self.
-    monkeypatch.setattr("app.external.pubsub.pull_self", fake_pull_self)
-    monkeypatch.setattr("app.external.pubsub.acknowledge_self_messages", mock.MagicMock())
-
-    # Now, calling poll should get a message asking to flip the fake_import to Upserting.
-    pubsub_pull.poll(client.application)
+    # Now, handling the message should flip the fake_import to Upserting.
+    pubsub_pull.handle_message(client.application, msg)
 
     with db.session_ctx() as sess2:
         imp: model.Import = model.Import.get(fake_import.id, sess2)
         assert imp.status == model.ImportStatus.Upserting
+
+    msg.ack.assert_called_once()
+    msg.nack.assert_not_called()
+
+
+def test_pubsub_pull_retry(client, monkeypatch):
+    """If the app asks for the message to be retried, we nack it rather than acking it."""
+    retry_response = mock.MagicMock()
+    retry_response.status_code = PUBSUB_STATUS_RETRY
+    monkeypatch.setattr(pubsub_pull, "process_one", mock.MagicMock(return_value=retry_response))
+
+    msg = fake_message({"action": "translate", "import_id": "some-id"})
+    pubsub_pull.handle_message(client.application, msg)
+
+    msg.nack.assert_called_once()
+    msg.ack.assert_not_called()
+
+
+def test_pubsub_pull_loop_stops(client, monkeypatch):
+    """loop() keeps a streaming pull going until stop() is called, resubscribing if the stream dies."""
+    monkeypatch.setattr(pubsub_pull, "_stopping", pubsub_pull.threading.Event())
+    monkeypatch.setattr(pubsub_pull, "RESUBSCRIBE_DELAY_SECONDS", 0)
+
+    dead_stream = mock.MagicMock()
+    dead_stream.done.return_value = True
+    dead_stream.result.side_effect = RuntimeError("stream died")
+    stopped_stream = mock.MagicMock()
+    stopped_stream.done.return_value = False
+
+    def stop_while_pulling():
+        pubsub_pull.stop()
+        # stop() runs in a signal handler, so it leaves cancelling the stream to the pull loop
+        stopped_stream.cancel.assert_not_called()
+    stopped_stream.done.side_effect = lambda: stop_while_pulling() or False
+
+    fake_subscribe = mock.MagicMock(side_effect=[dead_stream, stopped_stream])
+    monkeypatch.setattr("app.external.pubsub.subscribe_self", fake_subscribe)
+
+    pubsub_pull.loop(client.application)
+
+    assert fake_subscribe.call_count == 2
+    flow_control = fake_subscribe.call_args.args[1]
+    assert flow_control.max_messages == pubsub_pull.PULL_MAX_OUTSTANDING_MESSAGES
+    stopped_stream.cancel.assert_called_once()
@@ -34,3 +34,27 @@ def test_check_workspace_iam_action():
     with testutils.patch_request("app.external.rawls", "get", status_code = 500, text="barf"):
         with pytest.raises(exceptions.ISvcException):
             rawls.check_workspace_iam_action("a", "a", "a", "a")
+
+
+def test_workspace_info_cache(monkeypatch):
+    ws = RawlsWorkspaceResponse("the-uuid", "proj", "gcp")
+    assert rawls.get_cached_workspace_info("a", "b") is None
+
+    rawls.cache_workspace_info("a", "b", ws)
+    assert rawls.get_cached_workspace_info("a", "b") == ws
+    assert rawls.get_cached_workspace_info("a", "c") is None
+
+    # explicit invalidation
+    rawls.invalidate_workspace_info("a", "b")
+    assert rawls.get_cached_workspace_info("a", "b") is None
+
+    # entries expire after the TTL
+    rawls.cache_workspace_info("a", "b", ws)
+    monkeypatch.setattr(rawls.time, "monotonic", lambda: float("inf"))
+    assert rawls.get_cached_workspace_info("a", "b") is None
+
+
+def test_workspace_info_cache_disabled(monkeypatch):
+    monkeypatch.setattr(rawls, "WORKSPACE_INFO_CACHE_TTL_SECONDS", 0)
+    rawls.cache_workspace_info("a", "b", RawlsWorkspaceResponse("the-uuid", "proj", "gcp"))
+    assert rawls.get_cached_workspace_info("a", "b") is None
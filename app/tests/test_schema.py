@@ -0,0 +1,148 @@
+from typing import Optional
+from unittest import mock
+
+import pytest
+import sqlalchemy
+from sqlalchemy import inspect
+
+from app.db import model, schema
+
+
+@pytest.fixture(scope="function")
+def empty_engine() -> sqlalchemy.engine.Engine:
+    """A database of our own, so we can see what bootstrapping does to it."""
+    return sqlalchemy.create_engine('sqlite://')
+
+
+def _version(engine) -> Optional[int]:
+    with engine.connect() as conn:
+        return schema._get_version(conn)
+
+
+def test_bootstrap_fresh_db(empty_engine):
+    schema.bootstrap(empty_engine)
+
+    assert inspect(empty_engine).has_table(model.Import.__tablename__)
+    assert _version(empty_engine) == schema.SCHEMA_VERSION
+
+
+def test_bootstrap_is_noop_when_current(empty_engine, monkeypatch):
+    schema.bootstrap(empty_engine)
+
+    create_all = mock.MagicMock()
+    monkeypatch.setattr(model.Base.metadata, "create_all", create_all)
+    schema.bootstrap(empty_engine)
+    create_all.assert_not_called()
+
+
+def test_bootstrap_leaves_newer_schema_alone(empty_engine, monkeypatch):
+    # a newer instance has already migrated the database past what we know about
+    schema.bootstrap(empty_engine)
+    with empty_engine.begin() as conn:
+        schema._set_version(conn, schema.SCHEMA_VERSION + 1)
+
+    create_all = mock.MagicMock()
+    monkeypatch.setattr(model.Base.metadata, "create_all", create_all)
+    schema.bootstrap(empty_engine)
+    create_all.assert_not_called()
+    assert _version(empty_engine) == schema.SCHEMA_VERSION + 1
+
+
+def test_bootstrap_lock_timeout():
+    conn = mock.MagicMock()
+    conn.dialect.name = "mysql"
+    conn.execute.return_value.scalar.return_value = 0
+    with pytest.raises(RuntimeError):
+        with schema._bootstrap_lock(conn):
+            pytest.fail("shouldn't migrate without the lock")
+    # we never had the lock, so there's nothing to release
+    assert conn.execute.call_count == 1
+
+
+def test_bootstrap_migrates_existing_db(empty_engine, monkeypatch):
+    # a database from before we versioned the schema: it has tables but no version
+    model.Base.metadata.create_all(empty_engine)
+
+    migration = mock.MagicMock()
+    monkeypatch.setattr(schema, "SCHEMA_VERSION", 2)
+    monkeypatch.setattr(schema, "MIGRATIONS", {2: migration})
+
+    schema.bootstrap(empty_engine)
+    migration.assert_called_once()
+    assert _version(empty_engine) == 2
+
+
+def test_bootstrap_fresh_db_skips_migrations(empty_engine, monkeypatch):
+    migration = mock.MagicMock()
+    monkeypatch.setattr(schema, "SCHEMA_VERSION", 2)
+    monkeypatch.setattr(schema, "MIGRATIONS", {2: migration})
+
+    schema.bootstrap(empty_engine)
+    migration.assert_not_called()
+    assert _version(empty_engine) == 2
+
+
+def test_migration_2_adds_imports_indexes(empty_engine):
+    # an imports table from before the indexes existed
+    model.Base.metadata.create_all(empty_engine)
+    with empty_engine.begin() as conn:
+        for index in model.Import.__table__.indexes:
+            conn.execute(sqlalchemy.text(f"DROP INDEX {index.name}"))
+    assert inspect(empty_engine).get_indexes(model.Import.__tablename__) == []
+
+    schema.bootstrap(empty_engine)
+    index_names = {ix["name"] for ix in inspect(empty_engine).get_indexes(model.Import.__tablename__)}
+    assert {"ix_imports_workspace_submit_time", "ix_imports_workspace_status_submit_time_filetype",
+            "ix_imports_status_submit_time"} <= index_names
+
+
+def test_migration_7_replaces_workspace_status_index(empty_engine):
+    model.Base.metadata.create_all(empty_engine)
+    with empty_engine.begin() as conn:
+        conn.execute(sqlalchemy.text("DROP INDEX ix_imports_workspace_status_submit_time_filetype"))
+        conn.execute(sqlalchemy.text("CREATE INDEX ix_imports_workspace_status_submit_time "
+                                     "ON imports (workspace_namespace, workspace_name, status, submit_time)"))
+        schema._set_version(conn, 6)
+
+    schema.bootstrap(empty_engine)
+    index_names = {ix["name"] for ix in inspect(empty_engine).get_indexes(model.Import.__tablename__)}
+    assert "ix_imports_workspace_status_submit_time_filetype" in index_names
+    assert "ix_imports_workspace_status_submit_time" not in index_names
+
+
+def test_migration_10_adds_archive_summary_index(empty_engine):
+    model.Base.metadata.create_all(empty_engine)
+    with empty_engine.begin() as conn:
+        conn.execute(sqlalchemy.text("DROP INDEX ix_imports_archive_workspace_status_filetype"))
+        schema._set_version(conn, 9)
+
+    schema.bootstrap(empty_engine)
+    index_names = {ix["name"] for ix in inspect(empty_engine).get_indexes(model.ArchivedImport.__tablename__)}
+    assert {"ix_imports_archive_workspace_submit_time", "ix_imports_archive_workspace_status_filetype"} <= index_names
+
+
+def test_migration_11_adds_archive_idempotency_key_index(empty_engine):
+    model.Base.metadata.create_all(empty_engine)
+    with empty_engine.begin() as conn:
+        conn.execute(sqlalchemy.text("DROP INDEX ix_imports_archive_idempotency_key"))
+        schema._set_version(conn, 10)
+
+    schema.bootstrap(empty_engine)
+    index_names = {ix["name"] for ix in inspect(empty_engine).get_indexes(model.ArchivedImport.__tablename__)}
+    assert "ix_imports_archive_idempotency_key" in index_names
+
+
+def test_migrations_3_and_4_add_translation_columns(empty_engine):
+    # an imports table from before the heartbeat columns existed
+    with empty_engine.begin() as conn:
+        conn.execute(sqlalchemy.text("CREATE TABLE imports (id VARCHAR(36) PRIMARY KEY, status VARCHAR(14) NOT NULL, "
+                                     "workspace_namespace VARCHAR(100), workspace_name VARCHAR(100), "
+                                     "submit_time DATETIME, filetype VARCHAR(10))"))
+        conn.execute(sqlalchemy.text("INSERT INTO imports (id, status) VALUES ('old', 'Translating')"))
+        schema._set_version(conn, 2)
+
+    schema.bootstrap(empty_engine)
+    columns = {col["name"] for col in inspect(empty_engine).get_columns(model.Import.__tablename__)}
+    assert {"heartbeat_time", "translation_attempts", "lease_owner", "lease_expires"} <= columns
+    with empty_engine.connect() as conn:
+        assert conn.execute(sqlalchemy.text("SELECT translation_attempts FROM imports")).scalar() == 0
@@ -3,6 +3,7 @@ import unittest.mock as mock
 import datetime
 import flask
 import pytest
+import threading
 import time
 import json
 from google.auth import transport as gtransport
@@ -66,6 +67,31 @@ def test_verify_pubsub_jwt():
         service_auth.verify_pubsub_jwt(wrong_sa)
 
 
+def fake_operator_request(email: str, email_verified: bool = True) -> flask.Request:
+    mockrq = mock.MagicMock()
+    payload = {"aud": "gcloud", "email": email, "email_verified": email_verified, "iss": "https://accounts.google.com"}
+    mockrq.headers = {"Authorization": f"Bearer {json.dumps(payload)}"}
+    return mockrq
+
+
+def test_verify_operator(monkeypatch):
+    monkeypatch.setattr(service_auth.id_token, "verify_oauth2_token", lambda token, request, audience: json.loads(token))
+    monkeypatch.setenv("IMPORT_SVC_SA_EMAIL", "isvc@sa.org")
+    monkeypatch.setenv("OPERATOR_EMAILS", "ops@me.com, oncall@me.com")
+
+    for email in ["isvc@sa.org", "ops@me.com", "oncall@me.com"]:
+        assert service_auth.verify_operator(fake_operator_request(email)) is None
+
+    for rq in [fake_operator_request("someone@else.com"), fake_operator_request("ops@me.com", email_verified=False)]:
+        with pytest.raises(exceptions.AuthorizationException):
+            service_auth.verify_operator(rq)
+
+    no_token = mock.MagicMock()
+    no_token.headers = {}
+    with pytest.raises(exceptions.AuthorizationException):
+        service_auth.verify_operator(no_token)
+
+
 @pytest.mark.usefixtures(
     testutils.fxpatch(
         "app.auth.service_auth._get_isvc_token_from_google",
@@ -91,3 +117,164 @@ def test_google_expiretime_to_datetime():
 
     # test that nothing breaks if there are no nanoseconds
     assert service_auth.CachedCreds._google_expiretime_to_datetime("2014-10-02T15:01:23Z") == datetime.datetime(2014, 10, 2, 15, 1, 23)
+
+
+def test_isvc_creds_single_flight(monkeypatch):
+    """Concurrent callers with no usable creds should wait on a single refresh."""
+    calls = []
+
+    def slow_token_from_google():
+        calls.append(1)
+        time.sleep(0.2)
+        expiry = (datetime.datetime.utcnow() + datetime.timedelta(hours=1)).isoformat() + "Z"
+        return {"accessToken": "ya29.google", "expireTime": expiry}
+
+    monkeypatch.setattr(service_auth, "_get_isvc_token_from_google", slow_token_from_google)
+    monkeypatch.setattr(service_auth, "_cached_isvc_creds", None)
+
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(service_auth.get_isvc_token())) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert tokens == ["ya29.google"] * 5
+    assert len(calls) == 1
+
+
+@pytest.mark.usefixtures(
+    testutils.fxpatch(
+        "app.auth.service_auth._get_isvc_token_from_google",
+        return_value = {"accessToken": "ya29.google", "expireTime": "2014-10-02T15:01:23Z"}))
+def test_isvc_creds_background_refresh():
+    # creds that are fine for requests but within the background margin get refreshed early
+    with mock.patch("app.auth.service_auth._cached_isvc_creds",
+                    fake_credentials("ya29.cached", datetime.timedelta(minutes=10))):
+        assert service_auth.get_isvc_token() == "ya29.cached"
+        # the new creds from google are already expired, so we should be told to try again straight away
+        assert service_auth._refresh_isvc_creds_in_background() == 1
+        assert service_auth.get_isvc_token() == "ya29.google"
+
+    # creds with plenty of life left are left alone until they get near the margin
+    with mock.patch("app.auth.service_auth._cached_isvc_creds",
+                    fake_credentials("ya29.cached", datetime.timedelta(hours=1))):
+        wait = service_auth._refresh_isvc_creds_in_background()
+        assert 40 * 60 < wait <= 45 * 60
+        assert service_auth.get_isvc_token() == "ya29.cached"
+
+
+@pytest.mark.usefixtures(
+    testutils.fxpatch("app.auth.service_auth._get_isvc_token_from_google", side_effect = RuntimeError("google is down")))
+def test_isvc_creds_background_refresh_failure():
+    with mock.patch("app.auth.service_auth._cached_isvc_creds", None):
+        assert service_auth._refresh_isvc_creds_in_background() == service_auth.BACKGROUND_RETRY_SECONDS
+
+
+class FakeCertsTransport:
+    """Stands in for a grequests.Request(), counting how many times Google's certs are fetched."""
+    def __init__(self, key_ids, cache_control="public, max-age=100"):
+        self.key_ids = key_ids
+        self.cache_control = cache_control
+        self.status = 200
+        self.calls = 0
+
+    def __call__(self, url, method="GET", **kwargs):
+        self.calls += 1
+        response = mock.MagicMock()
+        response.status = self.status
+        response.headers = {"Cache-Control": self.cache_control, "Age": "10"}
+        response.data = json.dumps({kid: "cert" for kid in self.key_ids}).encode()
+        return response
+
+
+@pytest.fixture(scope="function")
+def fake_certs_transport(monkeypatch):
+    transport = FakeCertsTransport(["kid1"])
+    monkeypatch.setattr(service_auth.grequests, "Request", mock.MagicMock(return_value=transport))
+    return transport
+
+
+def test_cached_certs(fake_certs_transport):
+    certs = service_auth.CachedCerts()
+
+    # first request fetches, second is served from the cache
+    assert json.loads(certs(service_auth.GOOGLE_OAUTH2_CERTS_URL).data) == {"kid1": "cert"}
+    assert json.loads(certs(service_auth.GOOGLE_OAUTH2_CERTS_URL).data) == {"kid1": "cert"}
+    assert fake_certs_transport.calls == 1
+
+    # max-age minus age
+    assert 0 < certs._expires_at - time.monotonic() <= 90
+
+    # known key ids don't trigger a refetch
+    assert not certs.refresh_if_unknown_key("kid1")
+    # unknown key ids don't either if we only just fetched
+    assert not certs.refresh_if_unknown_key("kid2")
+    assert fake_certs_transport.calls == 1
+
+    # but they do once we're past the minimum refresh interval
+    certs._fetched_at -= service_auth.CERTS_MIN_FORCED_REFRESH_SECONDS
+    fake_certs_transport.key_ids = ["kid1", "kid2"]
+    assert certs.refresh_if_unknown_key("kid2")
+    assert fake_certs_transport.calls == 2
+    assert not certs.refresh_if_unknown_key("kid2")
+
+
+def test_cached_certs_stale_refreshes_in_background(fake_certs_transport):
+    certs = service_auth.CachedCerts()
+    certs.get()
+
+    # once stale, the old certs are served immediately and new ones fetched in the background
+    certs._expires_at = time.monotonic() - 1
+    fake_certs_transport.key_ids = ["kid2"]
+    assert json.loads(certs.get().data) == {"kid1": "cert"}
+
+    deadline = time.monotonic() + 5
+    while certs._refreshing and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert fake_certs_transport.calls == 2
+    assert json.loads(certs.get().data) == {"kid2": "cert"}
+
+    # certs that are too stale to use are fetched synchronously
+    certs._expires_at = time.monotonic() - service_auth.CERTS_MAX_STALE_SECONDS - 1
+    fake_certs_transport.key_ids = ["kid3"]
+    assert json.loads(certs.get().data) == {"kid3": "cert"}
+
+
+def test_cached_certs_back_off_after_failure(fake_certs_transport):
+    certs = service_auth.CachedCerts()
+    fake_certs_transport.status = 503
+    assert certs.get().status == 503
+    # Google is having a bad time, so don't pile on
+    assert certs.get().status == 503
+    assert not certs.refresh_if_unknown_key("kid1")
+    assert fake_certs_transport.calls == 1
+
+    fake_certs_transport.status = 200
+    certs._retry_at = time.monotonic() - 1
+    assert json.loads(certs.get().data) == {"kid1": "cert"}
+    assert fake_certs_transport.calls == 2
+
+    # stale certs aren't refreshed in the background while we're backing off either
+    fake_certs_transport.status = 503
+    certs._expires_at = time.monotonic() - 1
+    certs._retry_at = time.monotonic() + service_auth.CERTS_FAILURE_BACKOFF_SECONDS
+    assert json.loads(certs.get().data) == {"kid1": "cert"}
+    assert not certs._refreshing
+    assert fake_certs_transport.calls == 2
+
+
+def test_cached_certs_max_age():
+    assert service_auth.CachedCerts._max_age_seconds({"Cache-Control": "public, max-age=19479, must-revalidate"}) == 19479
+    assert service_auth.CachedCerts._max_age_seconds({"cache-control": "max-age=100", "age": "30"}) == 70
+    assert service_auth.CachedCerts._max_age_seconds({}) == service_auth.CERTS_DEFAULT_MAX_AGE_SECONDS
+
+
+def test_isvc_refreshing_credential():
+    with mock.patch("app.auth.service_auth._cached_isvc_creds",
+                    fake_credentials("ya29.cached", datetime.timedelta(hours=1))):
+        creds = service_auth.get_isvc_refreshing_credential()
+        assert not creds.valid
+        creds.refresh(None)
+        assert creds.valid
+        assert creds.token == "ya29.cached"
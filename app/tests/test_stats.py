@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pytest
+
+from app import stats
+from app.auth import service_auth
+from app.util import exceptions
+from app.db import db
+from app.db.model import Import, ImportStatus, ImportStatusTransition
+
+T0 = datetime(2023, 1, 1, 12, 0, 0)
+
+
+def _add_history(import_id: str, filetype: str, *transitions):
+    """transitions are (status, minutes after T0)"""
+    with db.session_ctx() as sess:
+        for status, minutes in transitions:
+            sess.add(ImportStatusTransition(import_id, status, filetype, T0 + timedelta(minutes=minutes)))
+
+
+def test_stage_durations():
+    _add_history("done", "pfb", (ImportStatus.Pending, 0), (ImportStatus.Translating, 1),
+                 (ImportStatus.ReadyForUpsert, 11), (ImportStatus.Upserting, 12), (ImportStatus.Done, 32))
+    _add_history("still going", "pfb", (ImportStatus.Pending, 0), (ImportStatus.Translating, 3))
+    _add_history("tdr", "tdrexport", (ImportStatus.Pending, 0), (ImportStatus.Translating, 5),
+                 (ImportStatus.Error, 6))
+    # everything about this one happened before the window
+    _add_history("old", "pfb", (ImportStatus.Pending, -120), (ImportStatus.Translating, -100))
+
+    durations = stats.stage_durations(T0, T0 + timedelta(hours=1))
+    assert sorted(durations["Pending"]) == [60, 180, 300]
+    assert sorted(durations["Translating"]) == [60, 600]
+    assert durations["ReadyForUpsert"] == [60]
+    assert durations["Upserting"] == [1200]
+    assert sorted(durations[stats.TOTAL]) == [360, 1920]
+
+    assert stats.stage_durations(T0, T0 + timedelta(hours=1), "tdrexport") == \
+        {"Pending": [300], "Translating": [60], "ReadyForUpsert": [], "Upserting": [], stats.TOTAL: [360]}
+
+
+def test_stage_durations_bounded(monkeypatch):
+    _add_history("done", "pfb", (ImportStatus.Pending, 0), (ImportStatus.Translating, 1), (ImportStatus.Error, 2))
+    monkeypatch.setattr(stats, "MAX_TRANSITIONS", 2)
+    with pytest.raises(exceptions.BadJsonException):
+        stats.stage_durations(T0, T0 + timedelta(hours=1))
+    monkeypatch.setattr(stats, "MAX_TRANSITIONS", 3)
+    assert stats.stage_durations(T0, T0 + timedelta(hours=1))[stats.TOTAL] == [120]
+
+
+def test_stage_durations_endpoint_needs_operator(client, monkeypatch):
+    monkeypatch.setattr(service_auth, "verify_operator", mock.MagicMock(side_effect=exceptions.AuthorizationException()))
+    assert client.get("/stats/stage-durations").status_code == 403
+
+
+def test_stage_durations_endpoint(client, monkeypatch):
+    monkeypatch.setattr(service_auth, "verify_operator", mock.MagicMock())
+    _add_history("done", "pfb", (ImportStatus.Pending, 0), (ImportStatus.Translating, 1))
+
+    resp = client.get(f"/stats/stage-durations?since={T0.isoformat()}&until={(T0 + timedelta(hours=1)).isoformat()}")
+    assert resp.status_code == 200
+    assert resp.json["stages"]["Pending"] == {"count": 1, "mean_seconds": 60.0, "max_seconds": 60.0,
+                                              "p50_seconds": 60.0, "p95_seconds": 60.0, "p99_seconds": 60.0}
+    assert resp.json["stages"]["Upserting"]["count"] == 0
+
+    assert client.get("/stats/stage-durations?since=yesterday").status_code == 400
+    assert client.get(f"/stats/stage-durations?since={T0.isoformat()}&until={T0.isoformat()}").status_code == 400
+
+
+def test_status_changes_are_recorded(fake_import: Import):
+    with db.session_ctx() as sess:
+        sess.add(fake_import)
+
+    with db.session_ctx() as sess:
+        assert Import.start_translating(fake_import.id, "me", 600, 3, sess)
+        assert Import.finish_translating(fake_import.id, "me", sess)
+        assert Import.transition_status(fake_import.id, ImportStatus.Upserting, sess)
+        # this one doesn't happen, so it isn't recorded
+        assert not Import.transition_status(fake_import.id, ImportStatus.Translating, sess)
+    with db.session_ctx() as sess:
+        Import.get(fake_import.id, sess).write_error("broke")
+
+    with db.session_ctx() as sess:
+        recorded = sess.query(ImportStatusTransition.status, ImportStatusTransition.filetype) \
+            .filter(ImportStatusTransition.import_id == fake_import.id).order_by(ImportStatusTransition.id).all()
+    assert recorded == [(ImportStatus.Translating, "pfb"), (ImportStatus.ReadyForUpsert, "pfb"),
+                        (ImportStatus.Upserting, "pfb"), (ImportStatus.Error, "pfb")]
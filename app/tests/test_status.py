@@ -1,9 +1,13 @@
 import pytest
+import sqlalchemy
 import unittest.mock as mock
+from datetime import datetime, timedelta
+from typing import Iterator
 
-from app import new_import
-from app.db import db
+from app import cleanup, new_import, status, status_watch
+from app.db import db, model
 from app.db.model import Import, ImportStatus
+from app.server import routes
 from app.server.requestutils import PUBSUB_STATUS_NOTOK
 from app.tests import testutils
 
@@ -22,6 +26,56 @@ def test_get_import_status(client):
     assert resp.json == {'jobId': import_id, 'filetype': 'pfb', 'status': ImportStatus.Pending.name}
 
 
+@pytest.mark.usefixtures("sam_valid_user", "user_has_ws_access", "pubsub_publish", "pubsub_fake_env")
+@pytest.mark.parametrize("path", ["/namespace/name/imports/{import_id}", "/namespace/name/imports"])
+def test_status_etags(client, path):
+    import_id = client.post('/namespace/name/imports', json=good_json, headers=good_headers).json["jobId"]
+    path = path.format(import_id=import_id)
+
+    resp = client.get(path, headers=good_headers)
+    assert resp.status_code == 200
+    etag = resp.headers["ETag"]
+
+    # nothing's changed, so the client's copy is still good
+    resp = client.get(path, headers={**good_headers, "If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.get_data() == b""
+    assert resp.headers["ETag"] == etag
+
+    with db.session_ctx() as sess:
+        Import.transition_status(import_id, ImportStatus.Translating, sess)
+    resp = client.get(path, headers={**good_headers, "If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+    assert ImportStatus.Translating.name in resp.get_data(as_text=True)
+
+
+@pytest.mark.usefixtures("sam_valid_user", "user_has_ws_access", "pubsub_publish", "pubsub_fake_env")
+def test_bulk_import_status(client):
+    running, finished = [Import("name", "namespace", "uuid", "project", "hello@me.com", "http://path", "pfb")
+                         for _ in range(2)]
+    finished.status = ImportStatus.Done
+    finished.submit_time = datetime.now() - timedelta(days=60)
+    elsewhere = Import("other", "namespace", "uuid", "project", "hello@me.com", "http://path", "pfb")
+    with db.session_ctx() as sess:
+        sess.add_all([running, finished, elsewhere])
+    with db.session_ctx() as sess:
+        model.ArchivedImport.archive_terminal_imports(sess, datetime.now() - timedelta(days=30), 10)
+
+    resp = client.post('/namespace/name/imports/status', headers=good_headers,
+                       json={"importIds": [finished.id, "nonexistent", elsewhere.id, running.id, finished.id]})
+    assert resp.status_code == 200
+    assert [(imp["jobId"], imp["status"]) for imp in resp.json] == \
+        [(finished.id, ImportStatus.Done.name), (running.id, ImportStatus.Pending.name)]
+
+    resp = client.post('/namespace/name/imports/status', headers={**good_headers, "If-None-Match": resp.headers["ETag"]},
+                       json={"importIds": [finished.id, running.id]})
+    assert resp.status_code == 304
+
+    for body in [{}, {"importIds": []}, {"importIds": [1]}, {"importIds": ["x"] * (status.MAX_BULK_STATUS_IDS + 1)}]:
+        assert client.post('/namespace/name/imports/status', json=body, headers=good_headers).status_code == 400
+
+
 @pytest.mark.usefixtures("sam_valid_user", "user_has_ws_access", "pubsub_publish", "pubsub_fake_env")
 def test_get_import_status_404(client):
     fake_id = "fake_id"
@@ -67,6 +121,113 @@ def test_get_all_running_with_one(client):
     assert resp.json == [{"jobId": import_id, "filetype": "pfb", "status": ImportStatus.Pending.name}]
 
 
+@pytest.mark.usefixtures("sam_valid_user", "user_has_ws_access", "pubsub_publish", "pubsub_fake_env")
+def test_list_imports_paginated(client):
+    with db.session_ctx() as sess:
+        imports = [Import("name", "namespace", "uuid", "project", "hello@me.com", "http://path", "pfb") for _ in range(5)]
+        # two imports submitted at the same moment, so we page through a tie on submit_time
+        base_time = datetime(2020, 1, 1)
+        for i, imprt in enumerate(imports):
+            imprt.submit_time = base_time + timedelta(minutes=min(i, 3))
+        sess.add_all(imports)
+        expected_ids = [imprt.id for imprt in sorted(imports, key=lambda imp: (imp.submit_time, imp.id), reverse=True)]
+
+    seen_ids = []
+    resp = client.get('/namespace/name/imports?page_size=2', headers=good_headers)
+    while True:
+        assert resp.status_code == 200
+        seen_ids += [imp["jobId"] for imp in resp.json]
+        token = resp.headers.get(routes.NEXT_PAGE_TOKEN_HEADER)
+        if token is None:
+            break
+        assert len(resp.json) == 2
+        resp = client.get(f'/namespace/name/imports?page_size=2&page_token={token}', headers=good_headers)
+
+    assert seen_ids == expected_ids
+
+    # without page_size we still get everything at once
+    resp = client.get('/namespace/name/imports', headers=good_headers)
+    assert [imp["jobId"] for imp in resp.json] == expected_ids
+    assert routes.NEXT_PAGE_TOKEN_HEADER not in resp.headers
+
+
+@pytest.mark.usefixtures("sam_valid_user", "user_has_ws_access", "pubsub_publish", "pubsub_fake_env")
+@pytest.mark.parametrize("query", ["page_size=0", "page_size=lots", f"page_size={status.MAX_PAGE_SIZE + 1}", "page_token=garbage"])
+def test_list_imports_bad_pagination(client, query):
+    resp = client.get(f'/namespace/name/imports?{query}', headers=good_headers)
+    assert resp.status_code == 400
+
+
+@pytest.mark.usefixtures("sam_valid_user", "user_has_ws_access", "pubsub_publish", "pubsub_fake_env")
+def test_archived_imports_are_still_visible(client, monkeypatch):
+    with db.session_ctx() as sess:
+        old = Import("name", "namespace", "uuid", "project", "hello@me.com", "http://path", "pfb")
+        old.status = ImportStatus.Done
+        old.submit_time = datetime.now() - timedelta(days=60)
+        running = Import("name", "namespace", "uuid", "project", "hello@me.com", "http://path", "pfb")
+        sess.add_all([old, running])
+    monkeypatch.setattr(cleanup, "ARCHIVE_AFTER_DAYS", 30)
+    assert cleanup.archive_terminal_imports() == 1
+
+    resp = client.get(f'/namespace/name/imports/{old.id}', headers=good_headers)
+    assert resp.status_code == 200
+    assert resp.json == {'jobId': old.id, 'filetype': 'pfb', 'status': ImportStatus.Done.name}
+
+    resp = client.get('/namespace/name/imports', headers=good_headers)
+    assert [imp["jobId"] for imp in resp.json] == [running.id, old.id]
+    resp = client.get('/namespace/name/imports?page_size=1', headers=good_headers)
+    assert [imp["jobId"] for imp in resp.json] == [running.id]
+    resp = client.get(f'/namespace/name/imports?page_size=1&page_token={resp.headers[routes.NEXT_PAGE_TOKEN_HEADER]}',
+                      headers=good_headers)
+    assert [imp["jobId"] for imp in resp.json] == [old.id]
+    assert routes.NEXT_PAGE_TOKEN_HEADER not in resp.headers
+    resp = client.get('/namespace/name/imports?running_only', headers=good_headers)
+    assert [imp["jobId"] for imp in resp.json] == [running.id]
+
+
+@pytest.fixture(scope="function")
+def replica(monkeypatch) -> Iterator[sqlalchemy.engine.Engine]:
+    """A separate database standing in for a read replica, which we can let fall behind the primary."""
+    replica_db = sqlalchemy.create_engine('sqlite://')
+    model.Base.metadata.create_all(replica_db)
+    monkeypatch.setattr(db, "_replica_db", replica_db)
+    monkeypatch.setattr(db, "_replica_sessionmaker", None)
+    yield replica_db
+    replica_db.dispose()
+
+
+@pytest.mark.usefixtures("sam_valid_user", "user_has_ws_access", "pubsub_publish", "pubsub_fake_env")
+def test_status_reads_use_replica(client, replica):
+    old = Import("name", "namespace", "uuid", "project", "hello@me.com", "http://path", "pfb")
+    old.submit_time = datetime.now() - timedelta(hours=1)
+    # the replica has old, but is behind on its status
+    with replica.begin() as conn:
+        conn.execute(Import.__table__.insert().values(
+            {c.name: getattr(old, c.name) for c in Import.__table__.columns}))
+    old.status = ImportStatus.Upserting
+    new = Import("name", "namespace", "uuid", "project", "hello@me.com", "http://path", "pfb")
+    with db.session_ctx() as sess:
+        sess.add_all([old, new])
+
+    # old is served from the replica
+    resp = client.get(f'/namespace/name/imports/{old.id}', headers=good_headers)
+    assert resp.json["status"] == ImportStatus.Pending.name
+    # new is too recent for the replica to have, so it comes from the primary
+    resp = client.get(f'/namespace/name/imports/{new.id}', headers=good_headers)
+    assert resp.status_code == 200
+    assert resp.json["jobId"] == new.id
+
+    resp = client.get('/namespace/name/imports', headers=good_headers)
+    assert [(imp["jobId"], imp["status"]) for imp in resp.json] == \
+        [(new.id, ImportStatus.Pending.name), (old.id, ImportStatus.Pending.name)]
+    resp = client.get('/namespace/name/imports?page_size=1', headers=good_headers)
+    assert [imp["jobId"] for imp in resp.json] == [new.id]
+
+    resp = client.post('/namespace/name/imports/status', json={"importIds": [new.id, old.id]}, headers=good_headers)
+    assert [(imp["jobId"], imp["status"]) for imp in resp.json] == \
+        [(new.id, ImportStatus.Pending.name), (old.id, ImportStatus.Pending.name)]
+
+
 @pytest.mark.usefixtures("incoming_valid_pubsub")
 def test_good_update_status(fake_import, client):
     """External service moves import from existing status to wherever."""
@@ -111,6 +272,67 @@ def test_tdr_upsert_completed_status(fake_import, client):
     assert resp.status_code == 200
 
 
+@pytest.mark.usefixtures("incoming_valid_pubsub")
+def test_upsert_completed_status_without_sync(fake_import, client):
+    """An import with no permissions to sync goes straight to Done, without reading it to check."""
+    fake_import.status = ImportStatus.Upserting
+    with db.session_ctx() as sess:
+        sess.add(fake_import)
+
+    with mock.patch("app.translators.sync_permissions.sync_permissions_if_necessary") as mock_sync:
+        resp = client.post("/_ah/push-handlers/receive_messages",
+                           json=testutils.pubsub_json_body({"action": "status", "import_id": fake_import.id,
+                                                            "current_status": "Upserting",
+                                                            "new_status": "Done"}))
+    mock_sync.assert_not_called()
+
+    with db.session_ctx() as sess2:
+        assert Import.get(fake_import.id, sess2).status == ImportStatus.Done
+
+    assert resp.status_code == 200
+
+
+@pytest.mark.usefixtures("incoming_valid_pubsub")
+def test_tdr_upsert_completed_status_sync_fails(fake_import, client):
+    """Permission syncing fails after the data is in: the import ends up in Error, saying so."""
+    fake_import.status = ImportStatus.Upserting
+    fake_import.is_tdr_sync_required = True
+    fake_import.snapshot_id = "fake_snapshot_id"
+    with db.session_ctx() as sess:
+        sess.add(fake_import)
+
+    with mock.patch("app.external.sam.admin_get_pet_auth_header", side_effect=Exception("sam is down")):
+        resp = client.post("/_ah/push-handlers/receive_messages",
+                           json=testutils.pubsub_json_body({"action": "status", "import_id": fake_import.id,
+                                                            "current_status": "Upserting",
+                                                            "new_status": "Done"}))
+
+    with db.session_ctx() as sess2:
+        imp: Import = Import.get(fake_import.id, sess2)
+        assert imp.status == ImportStatus.Error
+        assert "failed to synchronize permissions" in imp.error_message
+        assert "sam is down" in imp.error_message
+
+    assert resp.status_code == 200
+
+
+@pytest.mark.usefixtures("incoming_valid_pubsub")
+def test_done_status_double_delivery_does_not_resync(fake_import, client):
+    fake_import.status = ImportStatus.Done
+    fake_import.is_tdr_sync_required = True
+    fake_import.snapshot_id = "fake_snapshot_id"
+    with db.session_ctx() as sess:
+        sess.add(fake_import)
+
+    with mock.patch("app.translators.sync_permissions.sync_permissions") as mock_sync:
+        resp = client.post("/_ah/push-handlers/receive_messages",
+                           json=testutils.pubsub_json_body({"action": "status", "import_id": fake_import.id,
+                                                            "current_status": "Upserting",
+                                                            "new_status": "Done"}))
+    mock_sync.assert_not_called()
+    assert resp.status_code == PUBSUB_STATUS_NOTOK
+
+
 @pytest.mark.usefixtures("incoming_valid_pubsub")
 def test_good_update_status_wrong_current(fake_import, client):
     """External service attempts to move import from wrong current status to wherever."""
@@ -185,6 +407,38 @@ def test_fail_update_status_from_terminal(fake_import: Import, client):
 
     assert resp.status_code == PUBSUB_STATUS_NOTOK
 
+@pytest.mark.parametrize("new_status", ["Upserting", "Done"])
+@pytest.mark.usefixtures("incoming_valid_pubsub")
+def test_update_status_of_archived_import(fake_import: Import, client, new_status):
+    """A very late update for an import that's since been archived is acked and changes nothing."""
+    fake_import.status = ImportStatus.Done
+    fake_import.submit_time = datetime.now() - timedelta(days=60)
+    with db.session_ctx() as sess:
+        sess.add(fake_import)
+    with db.session_ctx() as sess:
+        model.ArchivedImport.archive_terminal_imports(sess, datetime.now() - timedelta(days=30), 10)
+
+    resp = client.post("/_ah/push-handlers/receive_messages",
+                       json=testutils.pubsub_json_body({"action": "status", "import_id": fake_import.id,
+                                                        "current_status": "ReadyForUpsert",
+                                                        "new_status": new_status}))
+    assert resp.status_code == 200
+    with db.session_ctx() as sess:
+        assert sess.query(model.ArchivedImport).filter(model.ArchivedImport.id == fake_import.id).one().status == \
+            ImportStatus.Done
+
+
+@pytest.mark.parametrize("new_status", ["Upserting", "Done"])
+@pytest.mark.usefixtures("incoming_valid_pubsub")
+def test_fail_update_status_of_unknown_import(client, new_status):
+    """An update for an import that was never here isn't acked as a success."""
+    resp = client.post("/_ah/push-handlers/receive_messages",
+                       json=testutils.pubsub_json_body({"action": "status", "import_id": "nonexistent",
+                                                        "current_status": "ReadyForUpsert",
+                                                        "new_status": new_status}))
+    assert resp.status_code == PUBSUB_STATUS_NOTOK
+
+
 @pytest.mark.usefixtures("incoming_valid_pubsub")
 def test_fail_update_status_backwards(fake_import: Import, client):
     """External service attempts to move import backwards in status, fails."""
@@ -202,3 +456,72 @@ def test_fail_update_status_backwards(fake_import: Import, client):
         assert imp.status == ImportStatus.Upserting  # unchanged
 
     assert resp.status_code == PUBSUB_STATUS_NOTOK
+
+
+@pytest.mark.usefixtures("sam_valid_user", "user_has_ws_access", "pubsub_publish", "pubsub_fake_env")
+def test_get_import_status_wait(client, monkeypatch):
+    import_id = client.post('/namespace/name/imports', json=good_json, headers=good_headers).json["jobId"]
+    path = f'/namespace/name/imports/{import_id}?wait=30'
+    threaded = {"wsgi.multithread": True}
+
+    def change_while_waiting(waited_id, changed, timeout):
+        assert (waited_id, timeout) == (import_id, 30)
+        assert not changed()
+        with db.session_ctx() as sess:
+            Import.transition_status(import_id, ImportStatus.Translating, sess)
+        assert changed()
+        return True
+
+    monkeypatch.setattr(status_watch, "wait_until", change_while_waiting)
+    resp = client.get(path, headers=good_headers, environ_overrides=threaded)
+    assert resp.status_code == 200
+    assert resp.json["status"] == ImportStatus.Translating.name
+
+    never_waits = mock.MagicMock()
+    monkeypatch.setattr(status_watch, "wait_until", never_waits)
+    # the client's ETag is out of date, so it gets the new status straight away
+    resp = client.get(path, headers={**good_headers, "If-None-Match": '"stale"'}, environ_overrides=threaded)
+    assert resp.status_code == 200
+    # a single-threaded server can't afford to hold the request
+    assert client.get(path, headers=good_headers).status_code == 200
+    # nor is there any point waiting for a finished import to change
+    with db.session_ctx() as sess:
+        Import.transition_status(import_id, ImportStatus.Error, sess)
+    assert client.get(path, headers=good_headers, environ_overrides=threaded).status_code == 200
+    never_waits.assert_not_called()
+
+    for bad_wait in ["soon", "-1", str(status_watch.MAX_WAIT_SECONDS + 1)]:
+        resp = client.get(f'/namespace/name/imports/{import_id}?wait={bad_wait}', headers=good_headers)
+        assert resp.status_code == 400
+
+
+@pytest.mark.usefixtures("sam_valid_user", "user_has_ws_access", "pubsub_publish", "pubsub_fake_env")
+def test_import_summary(client):
+    resp = client.get('/namespace/name/imports/summary', headers=good_headers)
+    assert resp.status_code == 200
+    assert resp.json["total"] == 0
+    assert set(resp.json["byStatus"].values()) == {0}
+    assert resp.json["oldestRunningAgeSeconds"] is None
+
+    def new_import(filetype, status, age_days):
+        imprt = Import("name", "namespace", "uuid", "project", "hello@me.com", "http://path", filetype)
+        imprt.status = status
+        imprt.submit_time = datetime.now() - timedelta(days=age_days)
+        return imprt
+
+    with db.session_ctx() as sess:
+        sess.add_all([new_import("pfb", ImportStatus.Translating, 2), new_import("pfb", ImportStatus.Pending, 1),
+                      new_import("pfb", ImportStatus.Done, 3), new_import("tdrexport", ImportStatus.Error, 60),
+                      new_import("tdrexport", ImportStatus.Done, 60), new_import("tdrexport", ImportStatus.Upserting, 0)])
+        # not in this workspace
+        sess.add(Import("other", "namespace", "uuid", "project", "hello@me.com", "http://path", "pfb"))
+    with db.session_ctx() as sess:
+        model.ArchivedImport.archive_terminal_imports(sess, datetime.now() - timedelta(days=30), 10)
+
+    resp = client.get('/namespace/name/imports/summary', headers=good_headers)
+    assert resp.json["total"] == 6
+    assert resp.json["byStatus"] == {**{s.name: 0 for s in ImportStatus},
+                                     "Pending": 1, "Translating": 1, "Upserting": 1, "Done": 2, "Error": 1}
+    assert resp.json["byFiletype"] == {"pfb": {"Pending": 1, "Translating": 1, "Done": 1},
+                                       "tdrexport": {"Upserting": 1, "Done": 1, "Error": 1}}
+    assert 2 * 86400 - 60 < resp.json["oldestRunningAgeSeconds"] < 2 * 86400 + 60
@@ -0,0 +1,70 @@
+import threading
+import time
+
+import pytest
+
+from app import status_watch
+from app.db import db
+from app.db.model import Import, ImportStatus
+
+
+def test_wait_until_woken_by_notify(monkeypatch):
+    monkeypatch.setattr(status_watch, "POLL_SECONDS", 60)
+    changed = threading.Event()
+
+    def change():
+        changed.set()
+        status_watch.notify(["some-id"])
+
+    threading.Timer(0.1, change).start()
+    start = time.monotonic()
+    assert status_watch.wait_until("some-id", changed.is_set, timeout=30)
+    assert time.monotonic() - start < 10
+    assert status_watch.num_waiters() == 0
+
+
+def test_wait_until_polls_and_times_out(monkeypatch):
+    monkeypatch.setattr(status_watch, "POLL_SECONDS", 0.05)
+    checks = []
+    assert not status_watch.wait_until("some-id", lambda: checks.append(1) and False, timeout=0.3)
+    # nobody notified us, but we checked anyway in case it changed on another instance
+    assert len(checks) >= 2
+    assert status_watch.num_waiters() == 0
+
+
+def test_waiters_leave_threads_free():
+    assert 0 < status_watch.MAX_WAITERS < status_watch.SERVER_THREADS
+
+
+def test_wait_until_bounded(monkeypatch):
+    monkeypatch.setattr(status_watch, "MAX_WAITERS", 1)
+    monkeypatch.setattr(status_watch, "POLL_SECONDS", 60)
+    release = threading.Event()
+    waiter = threading.Thread(target=status_watch.wait_until, args=("some-id", release.is_set, 30))
+    waiter.start()
+    try:
+        while status_watch.num_waiters() == 0:
+            time.sleep(0.01)
+        # the only slot is taken, so this returns without waiting
+        assert not status_watch.wait_until("other-id", lambda: pytest.fail("shouldn't check"), timeout=30)
+    finally:
+        release.set()
+        status_watch.notify(["some-id"])
+        waiter.join()
+
+
+@pytest.mark.parametrize("commit", [True, False])
+def test_commit_notifies(fake_import, monkeypatch, commit):
+    with db.session_ctx() as sess:
+        sess.add(fake_import)
+
+    notified = []
+    monkeypatch.setattr(status_watch, "notify", notified.extend)
+    sess = db.get_session()
+    Import.transition_status(fake_import.id, ImportStatus.Translating, sess)
+    if commit:
+        sess.commit()
+    else:
+        sess.rollback()
+    sess.close()
+    assert notified == ([fake_import.id] if commit else [])
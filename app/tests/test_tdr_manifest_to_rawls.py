@@ -1,8 +1,11 @@
 import io
 import uuid
+from dataclasses import asdict
 from datetime import datetime
+from unittest import mock
 from typing import IO, Dict, Generator, Sequence
 
+import fsspec
 import numpy as np
 import pandas as pd
 import pyarrow as pa
@@ -13,7 +16,7 @@ from app.external.rawls_entity_model import AddListMember, AddUpdateAttribute, A
     CreateAttributeEntityReferenceList, CreateAttributeValueList, Entity, EntityReference, RemoveAttribute
 from app.external.tdr_manifest import TDRTable, TDRManifestParser
 from app.translators.tdr_manifest_to_rawls import ParquetTranslator, TDRManifestToRawls
-from app.translators import tdr_manifest_to_rawls
+from app.translators import fragment_cache, tdr_manifest_to_rawls
 import json
 
 def _import_timestamp(dt: datetime) -> AddUpdateAttribute:
@@ -363,3 +366,69 @@ def test_translate_cyclic_table(monkeypatch):
     #All the references should be at the end
     ref_ops = all_ops[len(first_ops):]
     assert ref_ops == list(filter(lambda op: "_ref" in op.attributeName, ref_ops))
+
+
+def test_translate_cached(monkeypatch, tmp_path):
+    monkeypatch.setattr(fragment_cache, "CACHE_BUCKET", str(tmp_path))
+    monkeypatch.setattr(fragment_cache, "_filesystem", lambda: fsspec.filesystem("file", auto_mkdir=True))
+    monkeypatch.setattr(ParquetTranslator, "source_generation", lambda self: "1")
+    df = pd.DataFrame(data={'datarepo_row_id': ['a', 'b'], 'two': ['foo', 'bar']})
+
+    def translate_once(self, ref_only=False):
+        return self.translate_data_frame(df, ['datarepo_row_id', 'two'], False, ref_only)
+
+    # the first import of the file translates it, and caches the result
+    first_time = datetime(2023, 1, 1)
+    monkeypatch.setattr(ParquetTranslator, "translate", translate_once)
+    first = [json.loads(e.json) for e in get_fake_parquet_translator(first_time).translate_cached()]
+    assert [e["operations"][0] for e in first] == [asdict(_import_timestamp(first_time))] * 2
+
+    # the next one copies it, with its own timestamp
+    second_time = datetime(2023, 6, 1)
+    monkeypatch.setattr(ParquetTranslator, "translate", mock.MagicMock(side_effect=AssertionError("should be cached")))
+    second = [json.loads(e.json) for e in get_fake_parquet_translator(second_time).translate_cached()]
+    assert [e["operations"][0] for e in second] == [asdict(_import_timestamp(second_time))] * 2
+    assert [e["operations"][1:] for e in second] == [e["operations"][1:] for e in first]
+    assert [e["name"] for e in second] == ['a', 'b']
+
+    # a new version of the file is a different fragment
+    monkeypatch.setattr(ParquetTranslator, "source_generation", lambda self: "2")
+    monkeypatch.setattr(ParquetTranslator, "translate", translate_once)
+    assert len(list(get_fake_parquet_translator(second_time).translate_cached())) == 2
+
+
+def test_translate_cached_failure_leaves_nothing_cached(monkeypatch, tmp_path):
+    monkeypatch.setattr(fragment_cache, "CACHE_BUCKET", str(tmp_path))
+    monkeypatch.setattr(fragment_cache, "_filesystem", lambda: fsspec.filesystem("file", auto_mkdir=True))
+    monkeypatch.setattr(ParquetTranslator, "source_generation", lambda self: "1")
+
+    def translate_halfway(self, ref_only=False):
+        yield Entity('a', 'unittest', [])
+        raise IOError("connection reset")
+    monkeypatch.setattr(ParquetTranslator, "translate", translate_halfway)
+
+    with pytest.raises(IOError):
+        list(get_fake_parquet_translator().translate_cached())
+    assert [p for p in tmp_path.rglob("*") if p.is_file()] == []
+
+
+def test_source_generation_https(monkeypatch):
+    translator = get_fake_parquet_translator()
+    translator.filelocation = "https://storage.googleapis.com/bucket/file.parquet?signed"
+    get = mock.MagicMock()
+    get.return_value.__enter__.return_value.status_code = 206
+    get.return_value.__enter__.return_value.headers = {"ETag": '"abc"'}
+    monkeypatch.setattr(tdr_manifest_to_rawls.requests, "get", get)
+
+    assert translator.source_generation() == '"abc"'
+    # we never read the body, and never wait forever for the headers
+    assert get.call_args.kwargs["stream"] is True
+    assert get.call_args.kwargs["timeout"] == tdr_manifest_to_rawls.SOURCE_GENERATION_TIMEOUT_SECONDS
+
+    # a server that ignores the Range header gets hung up on, and the file isn't cached
+    get.return_value.__enter__.return_value.status_code = 200
+    assert translator.source_generation() is None
+    assert get.return_value.__exit__.called
+
+    get.side_effect = tdr_manifest_to_rawls.requests.exceptions.ReadTimeout()
+    assert translator.source_generation() is None
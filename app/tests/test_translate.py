@@ -1,8 +1,11 @@
 import io
+import json
 import os
+import threading
 import unittest.mock as mock
 import urllib.error
 from contextlib import contextmanager
+from datetime import datetime, timedelta
 from typing import IO, Any, Dict, Iterator
 
 import gcsfs.retry
@@ -13,7 +16,8 @@ from app.db import model
 from app.external.rawls_entity_model import Entity
 from app.server import requestutils
 from app.tests import testutils
-from app.translators import Translator
+from app.translators import SerializedEntity, Translator
+from app.util import exceptions
 
 # necessary to set this env var for unit tests; at runtime this is set by app.yaml
 # if we don't set it here, assertions that compare gs:// paths can fail with
@@ -73,6 +77,20 @@ def test_stream_translate(tmp_path):
     bad_noop_translate()
 
 
+def test_stream_translate_serialized_entities():
+    """Entities a translator has already serialized are written out as they are, alongside the others."""
+    class MixedTranslator(Translator):
+        def translate(self, import_details: model.Import, file_like: IO) -> Iterator[Any]:
+            yield Entity('a', 'line', [])
+            yield SerializedEntity('{"name": "b", "entityType": "line", "operations": []}')
+            yield Entity('c', 'line', [])
+
+    import_details = model.Import("aa", "aa", "uuid", "project", "aa@aa.aa", "gs://aa/aa", "pfb")
+    dest = io.BytesIO()
+    translate._stream_translate(import_details, io.BytesIO(), dest, MixedTranslator())
+    assert [e["name"] for e in json.loads(dest.getvalue())] == ['a', 'b', 'c']
+
+
 @pytest.fixture(scope="function")
 def good_http_pfb(monkeypatch, fake_pfb):
     monkeypatch.setattr(translate.http, "http_as_filelike", mock.MagicMock(return_value=fake_pfb))
@@ -197,10 +215,101 @@ def bad_gcs_dest(monkeypatch, pubsub_fake_env):
     gcsfs_mock.return_value.open.return_value.__exit__ = mock.MagicMock(side_effect = gcsfs.retry.HttpError(error_msg))
 
 
+def test_heartbeat_stops_abandoned_translation(fake_import):
+    with db.session_ctx() as sess:
+        sess.add(fake_import)
+    with db.session_ctx() as sess:
+        assert model.Import.start_translating(fake_import.id, "first", 600, 3, sess)
+
+    heartbeat = translate._Heartbeat(fake_import.id, "first")
+    heartbeat.renew()
+    heartbeat()
+
+    # our lease ran out, and another instance took the import over
+    with db.session_ctx() as sess:
+        sess.execute(model.Import.__table__.update().where(model.Import.id == fake_import.id)
+                     .values(lease_expires=datetime.now() - timedelta(seconds=1)))
+        assert model.Import.start_translating(fake_import.id, "second", 600, 3, sess)
+    heartbeat.renew()
+    with pytest.raises(exceptions.TranslationAbandonedException):
+        heartbeat()
+    with db.session_ctx() as sess:
+        assert not model.Import.finish_translating(fake_import.id, "first", sess)
+        assert model.Import.finish_translating(fake_import.id, "second", sess)
+
+
+def test_heartbeat_renews_in_background(monkeypatch):
+    monkeypatch.setattr(translate, "HEARTBEAT_INTERVAL_SECONDS", 0.01)
+    renewals = []
+    lost = threading.Event()
+
+    def renew(self):
+        renewals.append(1)
+        # the first renewal fails, and we carry on; the third finds the lease gone
+        if len(renewals) == 1:
+            raise RuntimeError("database blip")
+        if len(renewals) == 3:
+            self.lost = True
+            lost.set()
+
+    monkeypatch.setattr(translate._Heartbeat, "renew", renew)
+    # nobody calls the heartbeat in the meantime, e.g. because we're stuck waiting on the source file
+    with translate._Heartbeat("some-id", "me") as heartbeat:
+        assert lost.wait(10)
+        with pytest.raises(exceptions.TranslationAbandonedException):
+            heartbeat()
+    heartbeat._thread.join(10)
+    assert len(renewals) == 3
+
+
+def test_start_translating_takes_over_expired_leases(fake_import):
+    with db.session_ctx() as sess:
+        sess.add(fake_import)
+    with db.session_ctx() as sess:
+        assert model.Import.start_translating(fake_import.id, "first", 600, 2, sess)
+        # the lease is still good
+        assert not model.Import.start_translating(fake_import.id, "second", 600, 2, sess)
+
+    with db.session_ctx() as sess:
+        sess.execute(model.Import.__table__.update().where(model.Import.id == fake_import.id)
+                     .values(lease_expires=datetime.now() - timedelta(seconds=1)))
+        assert model.Import.start_translating(fake_import.id, "second", 600, 2, sess)
+
+    # that's the most attempts we'll make, so once this lease runs out nobody else can take it over
+    with db.session_ctx() as sess:
+        sess.execute(model.Import.__table__.update().where(model.Import.id == fake_import.id)
+                     .values(lease_expires=datetime.now() - timedelta(seconds=1)))
+        assert not model.Import.start_translating(fake_import.id, "third", 600, 2, sess)
+        imp = model.Import.get(fake_import.id, sess)
+        assert (imp.lease_owner, imp.translation_attempts) == ("second", 2)
+
+
+@pytest.mark.usefixtures("good_http_pfb", "good_gcs_dest", "incoming_valid_pubsub")
+def test_redelivered_message_takes_over_dead_translation(fake_import, fake_publish_rawls, client):
+    """The instance translating this import died, and Pub/Sub redelivered the translate message."""
+    fake_import.status = model.ImportStatus.Translating
+    fake_import.translation_attempts = 1
+    fake_import.lease_owner = "dead instance"
+    fake_import.lease_expires = datetime.now() - timedelta(minutes=1)
+    with db.session_ctx() as sess:
+        sess.add(fake_import)
+
+    resp = client.post("/_ah/push-handlers/receive_messages",
+                       json=testutils.pubsub_json_body({"action": "translate", "import_id": fake_import.id}))
+    assert resp.status_code == 200
+
+    with db.session_ctx() as sess:
+        imp: model.Import = model.Import.get(fake_import.id, sess)
+        assert imp.status == model.ImportStatus.ReadyForUpsert
+        assert imp.translation_attempts == 2
+        assert imp.lease_owner is None
+    fake_publish_rawls.assert_called_once()
+
+
 @pytest.fixture(scope="function")
 def fake_publish_rawls(monkeypatch, pubsub_fake_env):
     mm = mock.MagicMock()
-    monkeypatch.setattr(translate.pubsub, "publish_rawls", mm)
+    monkeypatch.setattr("app.external.pubsub.publish_rawls", mm)
     yield mm
 
 
@@ -257,6 +366,32 @@ def _test_golden_path_tdr_manifest(fake_import_tdr_manifest, fake_publish_rawls,
     # rawls should have been told to do something
     fake_publish_rawls.assert_called_once()
 
+@pytest.mark.usefixtures("good_gcs_dest", "incoming_valid_pubsub", "sam_valid_pet_key")
+def test_tdr_manifest_staged_at_submit_time(fake_import_tdr_manifest_gcp_gs, fake_publish_rawls, client, monkeypatch):
+    """If we kept the manifest when the import was submitted, we translate that rather than downloading it again."""
+    @contextmanager
+    def open_parquet_file_only(project: str, bucket: str, path: str, submitter: str, pet_key: Dict[str, Any] = None) -> Iterator[IO]:  # type: ignore
+        assert path.endswith('parquet'), f"shouldn't have downloaded {path}"
+        with open("app/tests/empty.parquet", 'rb') as out:
+            yield out
+    monkeypatch.setattr(translate.gcs, "open_file", open_parquet_file_only)
+
+    with open("app/tests/resources/test_tdr_response_gcp.json", 'rb') as manifest, db.session_ctx() as sess:
+        sess.add(fake_import_tdr_manifest_gcp_gs)
+        sess.add(model.StagedTDRManifest(fake_import_tdr_manifest_gcp_gs.id, manifest.read()))
+
+    resp = client.post("/_ah/push-handlers/receive_messages",
+                       json=testutils.pubsub_json_body({"action":"translate", "import_id":fake_import_tdr_manifest_gcp_gs.id}))
+    assert resp.status_code == 200
+
+    with db.session_ctx() as sess:
+        imp: model.Import = model.Import.get(fake_import_tdr_manifest_gcp_gs.id, sess)
+        assert imp.status == model.ImportStatus.ReadyForUpsert
+        assert imp.snapshot_id == "9516afec-583f-11ec-bf63-0242ac130002"
+        # it's done its job
+        assert model.StagedTDRManifest.get(imp.id, sess) is None
+    fake_publish_rawls.assert_called_once()
+
 @pytest.mark.usefixtures("bad_tdr_manifest_or_parquet_file_gcp_https", "good_gcs_dest", "incoming_valid_pubsub", "sam_valid_pet_key")
 def test_bad_actor_path_tdr_manifest_gcs_http(fake_import_tdr_manifest_gcp_https, fake_publish_rawls, client):
     _test_bad_actor_path_tdr_manifest_azure(fake_import_tdr_manifest_gcp_https, fake_publish_rawls, client)
@@ -303,9 +438,18 @@ def test_publish_rawls_is_upsert_passed_on(is_upsert, fake_publish_rawls, client
             "workspaceName": "bb",
             "userEmail": "bb@bb.bb",
             "jobId": imp.id,
-            "upsertFile": f"unittest-allowed-bucket/{imp.id}.rawlsUpsert",
+            "upsertFile": mock.ANY,
             "isUpsert": str(is_upsert)
         })
+        upsert_file = fake_publish_rawls.call_args.args[0]["upsertFile"]
+        assert upsert_file.startswith(f"unittest-allowed-bucket/{imp.id}.") and upsert_file.endswith(".rawlsUpsert")
+
+
+def test_upsert_file_is_per_attempt(monkeypatch):
+    monkeypatch.setenv("BATCH_UPSERT_BUCKET", "bucket")
+    first = translate._upsert_file("some-id", "instance/123/aaaa")
+    assert first == "bucket/some-id.instance-123-aaaa.rawlsUpsert"
+    assert translate._upsert_file("some-id", "instance/123/bbbb") != first
 
 @pytest.mark.usefixtures("forbidden_http_pfb", "good_gcs_dest", "incoming_valid_pubsub")
 def test_forbidden_pfb(fake_import, fake_publish_rawls, client):
@@ -371,3 +515,29 @@ def test_bad_gcs(fake_import, fake_publish_rawls, client):
 
     # no pubsub message should have been sent
     fake_publish_rawls.assert_not_called()
+
+
+@pytest.mark.usefixtures("good_gcs_dest", "incoming_valid_pubsub")
+def test_failed_translation_after_losing_lease(fake_import, fake_publish_rawls, client, monkeypatch):
+    """A translation that fails after its lease was taken over leaves the import to its new owner."""
+    with db.session_ctx() as sess:
+        sess.add(fake_import)
+
+    def take_over_and_fail(url: str):
+        with db.session_ctx() as sess:
+            sess.execute(model.Import.__table__.update().where(model.Import.id == fake_import.id)
+                         .values(lease_expires=datetime.now() - timedelta(seconds=1)))
+            assert model.Import.start_translating(fake_import.id, "second", 600, 3, sess)
+        raise ValueError("too slow")
+    monkeypatch.setattr(translate.http, "http_as_filelike", take_over_and_fail)
+
+    resp = client.post("/_ah/push-handlers/receive_messages",
+                       json=testutils.pubsub_json_body({"action":"translate", "import_id":fake_import.id}))
+    assert resp.status_code == requestutils.PUBSUB_STATUS_NOTOK
+
+    with db.session_ctx() as sess:
+        imp: model.Import = model.Import.get(fake_import.id, sess)
+        assert imp.status == model.ImportStatus.Translating
+        assert imp.lease_owner == "second"
+        assert imp.error_message is None
+    fake_publish_rawls.assert_not_called()
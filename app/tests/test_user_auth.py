@@ -5,6 +5,7 @@ import pytest
 from werkzeug.test import EnvironBuilder
 
 import app.external.rawls
+import app.external.sam
 from app.auth import user_auth
 from app.external.rawls import RawlsWorkspaceResponse
 from app.util import exceptions
@@ -73,3 +74,34 @@ def test_workspace_uuid():
         with mock.patch.object(app.external.rawls, "check_workspace_iam_action", return_value = True) as mock_rawls_getaction:
             assert user_auth.workspace_uuid_and_project_with_auth("wsns", "wsn", "bearer", "write") == RawlsWorkspaceResponse("the-uuid", "proj", "gcp")
             mock_rawls_getaction.assert_called_once()
+
+
+def test_workspace_uuid_cached():
+    ws = RawlsWorkspaceResponse("the-uuid", "proj", "gcp")
+
+    # first lookup goes to rawls and populates the cache
+    with mock.patch.object(app.external.rawls, "get_rawls_workspace_info", return_value = ws) as mock_rawls_info:
+        assert user_auth.workspace_uuid_and_project_with_auth("wsns", "wsn", "bearer", "read") == ws
+        mock_rawls_info.assert_called_once()
+
+    # cache hit for read: only sam is asked about the permission
+    with mock.patch.object(app.external.rawls, "get_rawls_workspace_info") as mock_rawls_info:
+        with mock.patch.object(app.external.sam, "get_user_action_on_resource", return_value = True) as mock_sam_action:
+            assert user_auth.workspace_uuid_and_project_with_auth("wsns", "wsn", "bearer", "read") == ws
+            mock_rawls_info.assert_not_called()
+            mock_sam_action.assert_called_once_with("workspace", "the-uuid", "read", "bearer")
+
+    # cache hit for write: only rawls' iam check is called
+    with mock.patch.object(app.external.rawls, "get_rawls_workspace_info") as mock_rawls_info:
+        with mock.patch.object(app.external.rawls, "check_workspace_iam_action", return_value = True) as mock_rawls_getaction:
+            assert user_auth.workspace_uuid_and_project_with_auth("wsns", "wsn", "bearer", "write") == ws
+            mock_rawls_info.assert_not_called()
+            mock_rawls_getaction.assert_called_once()
+
+    # cache hit, but sam says no: fall back to rawls, which gets to decide the error
+    with mock.patch.object(app.external.rawls, "get_rawls_workspace_info", side_effect = exceptions.ISvcException("not found", 404)) as mock_rawls_info:
+        with mock.patch.object(app.external.sam, "get_user_action_on_resource", return_value = False):
+            with pytest.raises(exceptions.ISvcException):
+                user_auth.workspace_uuid_and_project_with_auth("wsns", "wsn", "bearer", "read")
+            mock_rawls_info.assert_called_once()
+    assert app.external.rawls.get_cached_workspace_info("wsns", "wsn") is None
@@ -1,10 +1,16 @@
+import contextlib
+import io
 import logging
 import os
+import re
+import socket
+import threading
 import traceback
+import uuid
 from dataclasses import asdict
 from json import JSONEncoder
 from time import time
-from typing import IO, Dict, Optional
+from typing import IO, Callable, ContextManager, Dict, Iterator, Optional, Union
 from urllib.parse import urlparse
 
 import flask
@@ -15,11 +21,12 @@ from gcsfs.core import GCSFileSystem
 from app.auth import service_auth
 from app.auth.userinfo import UserInfo
 from app.db import db
-from app.db.model import Import, ImportStatus, ImportStatusResponse
-from app.external import gcs, pubsub
-from app.translators import PFBToRawls, TDRManifestToRawls, Translator
+from app.db.model import Import, ImportStatus, ImportStatusResponse, StagedTDRManifest
+from app import outbox
+from app.external import gcs
+from app.external.rawls_entity_model import Entity
+from app.translators import PFBToRawls, SerializedEntity, TDRManifestToRawls, Translator
 from app.util import exceptions, http
-from app.util.json import StreamArray
 
 # these filetypes get stream-translated
 FILETYPE_TRANSLATORS = {"pfb": PFBToRawls, "tdrexport": TDRManifestToRawls}
@@ -29,12 +36,87 @@ FILETYPE_NOTRANSLATION = "rawlsjson"
 
 VALID_TDR_SCHEMES = ["gs", "https"]
 
+# How long a translation lease lasts. If whoever is translating an import doesn't renew its lease in time, we assume it
+# died: a redelivered translate message may take the import over, and cleanup will requeue it.
+LEASE_SECONDS = int(os.environ.get("TRANSLATION_LEASE_SECONDS", "600"))
+# How often we renew the lease while translating. Keep this well under LEASE_SECONDS, so one slow renewal doesn't get a
+# healthy translation taken over.
+HEARTBEAT_INTERVAL_SECONDS = int(os.environ.get("TRANSLATION_HEARTBEAT_INTERVAL_SECONDS", "60"))
+# How many times we'll start translating an import before giving up on it, so a file that kills whoever translates it
+# can't take out instance after instance.
+MAX_TRANSLATION_ATTEMPTS = int(os.environ.get("MAX_TRANSLATION_ATTEMPTS", "3"))
+
+
+def _new_lease_owner() -> str:
+    """A name for this translation attempt that's unique across instances and readable in the database."""
+    return f"{os.environ.get('GAE_INSTANCE', socket.gethostname())[-100:]}/{os.getpid()}/{uuid.uuid4()}"
+
+
+def _upsert_file(import_id: str, owner: str) -> str:
+    """Where this translation attempt writes its output. Named after the attempt as well as the import, so if we took
+    over from a translation that's actually still going, it can't overwrite the file we tell Rawls about, or vice versa."""
+    attempt = re.sub(r"[^A-Za-z0-9._-]", "-", owner)
+    return f'{os.environ.get("BATCH_UPSERT_BUCKET")}/{import_id}.{attempt}.rawlsUpsert'
+
+
+class _Heartbeat:
+    """While the with block runs, renews the translation lease every HEARTBEAT_INTERVAL_SECONDS from a background
+    thread, so the lease stays ours even while translation is stuck waiting on a slow download. Call it every so often
+    while translating: once we've lost the lease it raises TranslationAbandonedException."""
+    def __init__(self, import_id: str, owner: str):
+        self.import_id = import_id
+        self.owner = owner
+        self.lost = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"lease-heartbeat-{import_id}", daemon=True)
+
+    def __enter__(self) -> "_Heartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        # no need to wait for the thread: a renewal that lands after we finish changes nothing, since finishing releases
+        # the lease and renew_lease only touches a lease that's still ours
+        self._stopped.set()
+
+    def __call__(self) -> None:
+        if self.lost:
+            raise exceptions.TranslationAbandonedException(self.import_id, self.owner)
+
+    def renew(self) -> None:
+        with db.session_ctx() as sess:
+            still_ours = Import.renew_lease(self.import_id, self.owner, LEASE_SECONDS, sess)
+        if not still_ours:
+            logging.warning(f"Lost the translation lease on import {self.import_id}; someone else has it now")
+            self.lost = True
+
+    def _run(self) -> None:
+        # start_translating took out the lease, so the first renewal can wait
+        while not self.lost and not self._stopped.wait(HEARTBEAT_INTERVAL_SECONDS):
+            try:
+                self.renew()
+            except Exception:
+                # probably a database blip; the lease has room for a few missed renewals
+                logging.warning(f"Failed to renew the translation lease on import {self.import_id}:\n"
+                                f"{traceback.format_exc()}")
+
+
+def _failed(import_id: str, owner: str, exc: exceptions.ISvcException) -> exceptions.ISvcException:
+    """Error the import with exc's message if owner still holds its lease, and return exc to raise. We do this here
+    rather than leaving it to pubsubify_excs, which errors the import whoever has it now."""
+    with db.session_ctx() as sess:
+        if not Import.fail_translating(import_id, owner, exc.message, sess):
+            logging.warning(f"Not erroring import {import_id}: {owner} lost its translation lease")
+    exc.imports = []
+    return exc
+
 
 def handle(msg: Dict[str, str]) -> ImportStatusResponse:
     import_id = msg["import_id"]
+    owner = _new_lease_owner()
     with db.session_ctx() as sess:
-        # flip the status to Translating, and then get the row
-        update_successful = Import.update_status_exclusively(import_id, ImportStatus.Pending, ImportStatus.Translating, sess)
+        # flip the status to Translating (or take over a translation whose lease ran out), and then get the row
+        update_successful = Import.start_translating(import_id, owner, LEASE_SECONDS, MAX_TRANSLATION_ATTEMPTS, sess)
         import_details: Import = Import.get(import_id, sess)
 
     if not update_successful:
@@ -43,7 +125,11 @@ def handle(msg: Dict[str, str]) -> ImportStatusResponse:
         logging.info(f"Failed to update status exclusively for translating import {import_id}: expected Pending, got {import_details.status}. PubSub probably delivered this message twice.")
         return flask.make_response(f"Failed to update status exclusively for translating import {import_id}: expected Pending, got {import_details.status}. PubSub probably delivered this message twice.", 409) # type: ignore
 
-    dest_file = f'{os.environ.get("BATCH_UPSERT_BUCKET")}/{import_details.id}.rawlsUpsert'
+    if import_details.translation_attempts > 1:
+        logging.warning(f"Starting translation attempt {import_details.translation_attempts} for import {import_id}; "
+                        f"the previous attempt stopped renewing its lease")
+
+    dest_file = _upsert_file(import_id, owner)
 
     logging.info(f"Starting translation for import {import_id} from {import_details.import_url} to {dest_file} ...")
     try:
@@ -58,7 +144,16 @@ def handle(msg: Dict[str, str]) -> ImportStatusResponse:
             logging.info(f"import {import_id} is of type {import_details.filetype}; attempting stream-translate ...")
 
             parsedurl = urlparse(import_details.import_url)
-            if import_details.filetype == "tdrexport" and parsedurl.scheme in VALID_TDR_SCHEMES:
+            staged_manifest = None
+            if import_details.filetype == "tdrexport":
+                with db.session_ctx() as sess:
+                    staged_manifest = StagedTDRManifest.get(import_id, sess)
+
+            filereader: ContextManager[IO]
+            if staged_manifest is not None:
+                # we downloaded the manifest when the import was submitted, so no need to do it again
+                filereader = contextlib.nullcontext(io.BytesIO(staged_manifest))
+            elif import_details.filetype == "tdrexport" and parsedurl.scheme in VALID_TDR_SCHEMES:
                 if parsedurl.scheme == "gs":
                     filereader = gcs.open_file(import_details.workspace_google_project, parsedurl.netloc, parsedurl.path, import_details.submitter)
                 elif parsedurl.scheme == "https":
@@ -73,10 +168,14 @@ def handle(msg: Dict[str, str]) -> ImportStatusResponse:
             else:
                 filereader = http.http_as_filelike(import_details.import_url)
 
-            with filereader as pfb_file:
+            with _Heartbeat(import_id, owner) as heartbeat, filereader as pfb_file:
                 with gcs_project.open(dest_file, 'wb') as dest_upsert:
-                    _stream_translate(import_details, pfb_file, dest_upsert, translator = FILETYPE_TRANSLATORS[import_details.filetype]())
+                    _stream_translate(import_details, pfb_file, dest_upsert, translator = FILETYPE_TRANSLATORS[import_details.filetype](),
+                                      heartbeat = heartbeat)
 
+    except exceptions.TranslationAbandonedException:
+        # someone else has this import now; leave it be
+        raise
     except (FileNotFoundError, IOError, gcsfs.retry.HttpError, requests.exceptions.ProxyError) as e:
         # These are errors thrown by the gcsfs library, see here:
         #   https://github.com/dask/gcsfs/blob/d7b832e13de6b5b0df00eeb7454c6547bf30d7b9/gcsfs/core.py#L151
@@ -85,50 +184,69 @@ def handle(msg: Dict[str, str]) -> ImportStatusResponse:
         # Note that we open the import URL using urllib's urlopen, which raises subclasses of URLError,
         # so we're not at risk of confusing import failures with bucket write failures.
         logging.error(f"Read/write error during translation for import {import_id}: {traceback.format_exc()}")
-        raise exceptions.SystemException([import_details], e)
+        raise _failed(import_id, owner, exceptions.SystemException([import_details], e))
     except Exception as e:
         # Something went wrong with the translate. Raising an exception will fail the import.
         # Over time we should be able to narrow down the kinds of exception we might get, and perhaps
         # give users clearer messaging instead of logging them all.
         # For now, this is a last-ditch catch-all.
         logging.error(f"Unexpected error during translation for import {import_id}: {traceback.format_exc()}")
-        raise exceptions.FileTranslationException(import_details, e)
-
-    with db.session_ctx() as sess:
-        # This should always succeed as we started this function by getting an exclusive lock on the import row.
-        Import.update_status_exclusively(import_id, ImportStatus.Translating, ImportStatus.ReadyForUpsert, sess)
+        raise _failed(import_id, owner, exceptions.FileTranslationException(import_details, e))
 
     logging.info(f"Completed translation for import {import_id} from {import_details.import_url} to {dest_file}")
     logging.info(f"Requesting Rawls upsert for import {import_id}...")
 
-    # Tell Rawls to import the result.
-    pubsub.publish_rawls({
-        "workspaceNamespace": import_details.workspace_namespace,
-        "workspaceName": import_details.workspace_name,
-        "userEmail": import_details.submitter,
-        "jobId": import_details.id,
-        "upsertFile": dest_file,
-        "isUpsert": str(import_details.is_upsert)
-    })
+    with db.session_ctx() as sess:
+        # This only fails if we lost our lease, in which case someone else has the import now.
+        if not Import.finish_translating(import_id, owner, sess):
+            raise exceptions.TranslationAbandonedException(import_id, owner)
+        StagedTDRManifest.discard(import_id, sess)
+
+        # Tell Rawls to import the result. This goes out once the status change is committed.
+        outbox.enqueue(sess, outbox.RAWLS, {
+            "workspaceNamespace": import_details.workspace_namespace,
+            "workspaceName": import_details.workspace_name,
+            "userEmail": import_details.submitter,
+            "jobId": import_details.id,
+            "upsertFile": dest_file,
+            "isUpsert": str(import_details.is_upsert)
+        })
+
+    outbox.relay_soon()
 
     return ImportStatusResponse(import_id, ImportStatus.ReadyForUpsert.name, import_details.filetype, None)
 
 
-def _stream_translate(import_details: Import, source: IO, dest: IO, translator: Translator) -> None:
+def _stream_translate(import_details: Import, source: IO, dest: IO, translator: Translator,
+                      heartbeat: Optional[Callable[[], None]] = None) -> None:
     translated_entity_gen = translator.translate(import_details, source)  # doesn't actually translate, just returns a generator
-    # translated_entity_gen returns an Iterator[Entity]. Turn those Entity objects into dicts so they can be json-encoded
-    translated_gen = (asdict(e) for e in translated_entity_gen)
 
     start_time = time()
     last_log_time = time()
     num_chunks = 0
 
-    for chunk in JSONEncoder(indent=0).iterencode(StreamArray(translated_gen)):
+    for chunk in _encode_entities(translated_entity_gen):
         chunk_time = time()
         num_chunks = num_chunks + 1
         if (chunk_time - last_log_time >= 30):
             elapsed = chunk_time - start_time
             logging.info(f"still translating for import {import_details.id}: total time {elapsed}s, chunks processed {num_chunks}")
             last_log_time = chunk_time
+        if heartbeat:
+            heartbeat()
 
         dest.write(chunk.encode())  # encodes as utf-8 by default
+
+
+def _encode_entities(entities: Iterator[Union[Entity, SerializedEntity]]) -> Iterator[str]:
+    """Stream a json array of the entities, a chunk at a time, without holding them all in memory."""
+    encoder = JSONEncoder(indent=0)
+    yield "["
+    for i, entity in enumerate(entities):
+        if i > 0:
+            yield ","
+        if isinstance(entity, SerializedEntity):
+            yield entity.json
+        else:
+            yield from encoder.iterencode(asdict(entity))
+    yield "]"
@@ -1,3 +1,3 @@
-from app.translators.translator import Translator
+from app.translators.translator import SerializedEntity, Translator
 from app.translators.pfb_to_rawls import PFBToRawls
 from app.translators.tdr_manifest_to_rawls import TDRManifestToRawls
@@ -0,0 +1,81 @@
+"""Cache of translated TDR parquet files, shared by every import of the same snapshot.
+
+The same snapshot often gets imported into many workspaces, and each import would otherwise download and translate the
+same parquet files to the same entities. The only thing that differs is the import:timestamp attribute, so we cache
+each file's entities serialized with a placeholder timestamp, and swap in the import's own as we copy them out.
+
+Fragments are keyed by everything the translation depends on, including the source file's generation, so they never
+need invalidating; bump TRANSLATION_VERSION when a change to ParquetTranslator changes its output. Expiring old
+fragments is left to the bucket's lifecycle rules. Callers must check the user can read the source file before using a
+fragment of it."""
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import uuid
+from typing import IO, Iterator, Optional
+
+from gcsfs.core import GCSFileSystem
+
+from app.auth import service_auth
+
+# Where fragments go. Unset turns the cache off.
+CACHE_BUCKET = os.environ.get("TDR_FRAGMENT_CACHE_BUCKET")
+TRANSLATION_VERSION = 1
+# Stands in for the import:timestamp attribute's value in cached fragments.
+TIMESTAMP_PLACEHOLDER = "@@import:timestamp@@"
+_PLACEHOLDER_JSON = json.dumps(TIMESTAMP_PLACEHOLDER)
+
+
+def enabled() -> bool:
+    return bool(CACHE_BUCKET)
+
+
+def fragment_path(snapshot_id: str, location: str, generation: str, table_name: str, is_cyclical: bool,
+                  ref_only: bool) -> str:
+    """Where the fragment for this translation of this version of a file goes. location may be a signed URL, which
+    differs from export to export of the same file, so we leave its query string out."""
+    source = location.split("?", 1)[0]
+    key = hashlib.sha256(json.dumps([source, generation, table_name, is_cyclical, ref_only]).encode()).hexdigest()
+    return f"{CACHE_BUCKET}/v{TRANSLATION_VERSION}/{snapshot_id}/{key}.jsonl"
+
+
+def _filesystem() -> GCSFileSystem:
+    return GCSFileSystem(os.environ.get("PUBSUB_PROJECT"), token=service_auth.get_isvc_credential())
+
+
+@contextlib.contextmanager
+def read_fragment(path: str) -> Iterator[Optional[Iterator[str]]]:
+    """The fragment's entities, one json object per item, or None if it isn't cached."""
+    fs = _filesystem()
+    try:
+        fragment = fs.open(path, "rb")
+    except FileNotFoundError:
+        yield None
+        return
+    with fragment:
+        yield (line.decode().rstrip("\n") for line in fragment)
+
+
+@contextlib.contextmanager
+def write_fragment(path: str) -> Iterator[IO]:
+    """Write a fragment, one entity json per line. It only appears in the cache if the with block finishes, so a
+    translation that fails halfway never leaves half a fragment behind."""
+    fs = _filesystem()
+    temp_path = f"{path}.{uuid.uuid4()}.tmp"
+    try:
+        with fs.open(temp_path, "wb") as fragment:
+            yield fragment
+        fs.mv(temp_path, path)
+    finally:
+        try:
+            if fs.exists(temp_path):
+                fs.rm(temp_path)
+        except Exception:
+            logging.warning(f"Failed to delete temporary fragment {temp_path}", exc_info=True)
+
+
+def with_timestamp(entity_json: str, import_timestamp: str) -> str:
+    """Swap the placeholder in a cached entity for an import's timestamp."""
+    return entity_json.replace(_PLACEHOLDER_JSON, json.dumps(import_timestamp))
@@ -1,10 +1,15 @@
 import logging
+from sqlalchemy import or_
 
 from app.db.model import Import, ImportStatus
 from app.external import sam
 
 READER_ROLES = ["reader", "writer", "owner", "project-owner"]
 
+# The imports sync_permissions_if_necessary leaves alone, as a query condition.
+SYNC_NOT_REQUIRED = or_(Import.is_tdr_sync_required.is_(None), Import.is_tdr_sync_required.is_(False),
+                        Import.snapshot_id.is_(None))
+
 def sync_permissions_if_necessary(import_details: Import, import_status: ImportStatus):
     """Check if the status update is for a tdr snapshot sync that just completed, if yes, sync permissions."""
     if import_status != ImportStatus.Done or not import_details.is_tdr_sync_required:
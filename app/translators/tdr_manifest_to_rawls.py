@@ -1,9 +1,11 @@
+import asyncio
 import copy
 import itertools
 import json
 import logging
 import os
-from typing import IO, Any, Dict, Iterator, List
+from dataclasses import asdict
+from typing import IO, Any, Dict, Iterator, List, Optional, Union
 from urllib.parse import urlparse
 import io
 import uuid
@@ -12,6 +14,8 @@ import numpy as np
 import pandas as pd
 import pyarrow
 import pyarrow.parquet as pq
+import requests
+from gcsfs.core import GCSFileSystem
 
 from app.auth.userinfo import UserInfo
 from app.db import db
@@ -23,11 +27,14 @@ from app.external.rawls_entity_model import (AddListMember, AddUpdateAttribute,
                                              CreateAttributeValueList, Entity,
                                              EntityReference, RemoveAttribute)
 from app.external.tdr_manifest import TDRManifestParser, TDRTable
-from app.translators.translator import Translator
-from app.util import http, exceptions
+from app.translators import fragment_cache
+from app.translators.translator import SerializedEntity, Translator
+from app.util import http, exceptions, metrics
 
 VALID_AZURE_DOMAIN = "core.windows.net"
 GOOGLE_STORAGE_DOMAIN = "storage.googleapis.com"
+# How long we wait for each request when looking up a parquet file's version for the fragment cache.
+SOURCE_GENERATION_TIMEOUT_SECONDS = int(os.environ.get("TDR_SOURCE_GENERATION_TIMEOUT_SECONDS", "30"))
 
 class TDRManifestToRawls(Translator):
     def __init__(self, options=None):
@@ -38,7 +45,7 @@ class TDRManifestToRawls(Translator):
         defaults = {}
         self.options = {**defaults, **options}
 
-    def translate(self, import_details: Import, file_like: IO) -> Iterator[Entity]:
+    def translate(self, import_details: Import, file_like: IO) -> Iterator[Union[Entity, SerializedEntity]]:
         logging.info(f'{import_details.id} executing a TDRManifestToRawls translation for {import_details.filetype}: {file_like}')
         jso = json.load(file_like)
         parsed_manifest = TDRManifestParser(jso, import_details.id)
@@ -51,7 +58,7 @@ class TDRManifestToRawls(Translator):
         return itertools.chain(*self.translate_tables(import_details, source_snapshot_id, tables, parsed_manifest.is_cyclical()))
 
     @classmethod
-    def translate_tables(cls, import_details: Import, source_snapshot_id: str, tables: List[TDRTable], is_cyclical: bool) -> Iterator[Iterator[Entity]]:
+    def translate_tables(cls, import_details: Import, source_snapshot_id: str, tables: List[TDRTable], is_cyclical: bool) -> Iterator[Iterator[Union[Entity, SerializedEntity]]]:
         """Converts a list of TDR tables, each of which contain urls to parquet files, to an iterator of Entity objects."""
         pet_key = sam.admin_get_pet_key(import_details.workspace_google_project, import_details.submitter)
         if not is_cyclical:
@@ -60,12 +67,12 @@ class TDRManifestToRawls(Translator):
             yield from itertools.chain(TDRManifestToRawls.translate_table_parquet_files(import_details, source_snapshot_id, tables, True, pet_key, False), TDRManifestToRawls.translate_table_parquet_files(import_details, source_snapshot_id, tables, True, pet_key, True))
     @classmethod
     def translate_table_parquet_files(cls, import_details: Import, source_snapshot_id: str, tables: List[TDRTable],
-                                      is_cyclical: bool, pet_key: Dict[str, Any], translate_ref: bool) -> Iterator[Iterator[Entity]]:
+                                      is_cyclical: bool, pet_key: Dict[str, Any], translate_ref: bool) -> Iterator[Iterator[Union[Entity, SerializedEntity]]]:
         """Converts only the ref/non_ref attributes from a list of TDR tables to an iterator of Entity objects."""
         for t in tables:
             for f in t.parquet_files:
                 pt = ParquetTranslator(t, f, import_details, source_snapshot_id, pet_key, is_cyclical)
-                yield pt.translate(translate_ref)
+                yield pt.translate_cached(translate_ref) if fragment_cache.enabled() else pt.translate(translate_ref)
 
     @staticmethod
     def save_snapshot_id(import_id: str, snapshot_id: str):
@@ -82,6 +89,7 @@ class ParquetTranslator:
     def __init__(self, table: TDRTable, filelocation: str, import_details: Import, source_snapshot_id: str, auth_key: Dict[str, Any] = None, is_cyclical: bool = False):  # type: ignore
         """Translator for Parquet files coming from a TDR manifest."""
         self.table = table
+        self.import_timestamp = import_details.submit_time.isoformat()
         self.import_details = import_details
         self.filelocation = filelocation
         self.auth_key = auth_key
@@ -89,6 +97,56 @@ class ParquetTranslator:
         self.source_snapshot_id = source_snapshot_id
         self.is_cyclical = is_cyclical
 
+    def translate_cached(self, ref_only: bool = False) -> Iterator[Union[Entity, SerializedEntity]]:
+        """Like translate, but copies the entities from the fragment cache if another import of the snapshot already
+        translated this file, and caches them if not. The user must be able to read the file either way."""
+        generation = self.source_generation()
+        if generation is None:
+            yield from self.translate(ref_only)
+            return
+
+        path = fragment_cache.fragment_path(self.source_snapshot_id, self.filelocation, generation, self.table.name,
+                                            self.is_cyclical, ref_only)
+        import_timestamp = self.import_timestamp
+        with fragment_cache.read_fragment(path) as cached:
+            if cached is not None:
+                logging.info(f'{self.import_details.id} copying already-translated {self.file_nickname} from {path}')
+                metrics.increment("tdr_fragment_cache.hit")
+                for entity_json in cached:
+                    yield SerializedEntity(fragment_cache.with_timestamp(entity_json, import_timestamp))
+                return
+
+        metrics.increment("tdr_fragment_cache.miss")
+        self.import_timestamp = fragment_cache.TIMESTAMP_PLACEHOLDER
+        with fragment_cache.write_fragment(path) as fragment:
+            for entity in self.translate(ref_only):
+                entity_json = json.dumps(asdict(entity))
+                fragment.write(f"{entity_json}\n".encode())
+                yield SerializedEntity(fragment_cache.with_timestamp(entity_json, import_timestamp))
+
+    def source_generation(self) -> Optional[str]:
+        """The version of the parquet file, as the submitter sees it: this fails if they can't read it. None if we can't
+        tell, including if asking takes too long, in which case it's not safe to cache."""
+        parsedurl = urlparse(self.filelocation)
+        try:
+            if parsedurl.scheme == 'gs':
+                fs = GCSFileSystem(project=self.import_details.workspace_google_project, token=self.auth_key,
+                                   requests_timeout=SOURCE_GENERATION_TIMEOUT_SECONDS)
+                generation = fs.info(f"{parsedurl.netloc}{parsedurl.path}").get("generation")
+            elif parsedurl.scheme == 'https':
+                # signed URLs are only good for GETs, so ask for the first byte. stream, so that if the server ignores
+                # the Range header, closing the response hangs up rather than downloading the whole file.
+                with requests.get(self.filelocation, headers={"Range": f"bytes={http.BYTE_RANGE}"}, stream=True,
+                                  timeout=SOURCE_GENERATION_TIMEOUT_SECONDS) as response:
+                    generation = response.headers.get("ETag") if response.status_code == 206 else None
+            else:
+                generation = None
+        except (asyncio.TimeoutError, TimeoutError, requests.exceptions.Timeout):
+            logging.warning(f'{self.import_details.id} timed out looking up the version of {self.file_nickname}; '
+                            f'translating it without the cache')
+            return None
+        return str(generation) if generation else None
+
     def translate(self, ref_only: bool = False) -> Iterator[Entity]:
         """Converts a parquet file, represented as a url, to an iterator of Entity objects."""
         logging.info(f'{self.import_details.id} attempting parquet translation of {self.file_nickname} from {self.filelocation} ...')
@@ -153,7 +211,7 @@ class ParquetTranslator:
         all_attr_ops = []
         if not self.is_cyclical or not ref_only:
             # annotate row with the timestamp of the import
-            tsattr = self.translate_parquet_attr('import:timestamp', self.import_details.submit_time.isoformat())
+            tsattr = self.translate_parquet_attr('import:timestamp', self.import_timestamp)
             # annotate row with the snapshotid from TDR
             sourceidattr = self.translate_parquet_attr('import:snapshot_id', self.source_snapshot_id)
             all_attr_ops.extend([tsattr, sourceidattr])
@@ -1,11 +1,17 @@
 from abc import ABC, abstractmethod
-from typing import IO, Iterator
+from typing import IO, Iterator, NamedTuple, Union
 
 from app.db.model import Import
 from app.external.rawls_entity_model import Entity
 
 
+class SerializedEntity(NamedTuple):
+    """An entity that's already been serialized to json, e.g. one that came out of a cache. Translators can produce
+    these instead of Entities, and they're written out as-is."""
+    json: str
+
+
 class Translator(ABC):
     @abstractmethod
-    def translate(self, import_details: Import, file_like: IO) -> Iterator[Entity]:
+    def translate(self, import_details: Import, file_like: IO) -> Iterator[Union[Entity, SerializedEntity]]:
         pass
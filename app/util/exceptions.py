@@ -69,6 +69,10 @@ class InvalidFiletypeException(ISvcException):
         audit_logs = [AuditLog(f"User {user_info.subject_id} {user_info.user_email} attempted to import from filetype {import_filetype}", logging.ERROR)]
         super().__init__(f"Path Not Allowed - {hint}: {import_filetype}", 400, audit_logs=audit_logs)
 
+class IdempotencyKeyReusedException(ISvcException):
+    def __init__(self):
+        super().__init__("This Idempotency-Key was already used for a different import", 422)
+
 class ForbiddenImportException(ISvcException):
     def __init__(self, import_url: str, user_info: UserInfo, hint: str):
         audit_logs = [AuditLog(f"User {user_info.subject_id} {user_info.user_email} attempted to import from path {import_url}", logging.ERROR)]
@@ -106,6 +110,14 @@ class SystemException(ISvcException):
         super().__init__(user_msg, 500, imprts, audit_logs=audit_logs)
 
 
+class TranslationAbandonedException(ISvcException):
+    """We were translating an import, but lost the translation lease: we took too long to renew it, and the import has
+    since been taken over, requeued or errored. Stop work without touching the import: it's someone else's now."""
+    def __init__(self, import_id: str, owner: str):
+        msg = f"Translation of import {import_id} by {owner} was abandoned after it lost its lease"
+        super().__init__(msg, 409, audit_logs=[AuditLog(msg, logging.WARN)])
+
+
 class TerminalStatusChangeException(ISvcException):
     """An external service requested changing the state of an import, but the import was already in a terminal state."""
     def __init__(self, import_id: str, requested_status: ImportStatus, current_terminal_status: ImportStatus):
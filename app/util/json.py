@@ -1,27 +0,0 @@
-
-class StreamArray(list):
-    """
-    Converts a generator into a list object that can be json serialisable
-    while still retaining the iterative nature of a generator.
-
-    IE. It converts it to a list without having to exhaust the generator
-    and keep its contents in memory.
-
-    Lifted from https://stackoverflow.com/a/45143995/2941784
-    """
-    def __init__(self, generator):
-        self.generator = generator
-        self._len = 1
-
-    def __iter__(self):
-        self._len = 0
-        for item in self.generator:
-            yield item
-            self._len += 1
-
-    def __len__(self):
-        """
-        Json parser looks for a this method to confirm whether or not it can
-        be parsed
-        """
-        return self._len
@@ -0,0 +1,81 @@
+"""Lightweight in-process metrics. Each instance keeps its own counts and timings; GET /metrics returns a snapshot.
+We don't ship these anywhere, but they're cheap to record and useful to look at when something is slow."""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterable, Iterator
+
+# how many recent samples we keep per timing to compute percentiles from
+RECENT_SAMPLES = 1000
+
+
+class Timing:
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.recent: Deque[float] = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.recent.append(seconds)
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean_seconds": self.total_seconds / self.count if self.count else 0.0,
+            "max_seconds": self.max_seconds,
+            **percentiles(self.recent)
+        }
+
+
+def percentiles(samples: Iterable[float]) -> Dict[str, float]:
+    """p50/p95/p99 of some durations in seconds, or zeroes if there aren't any."""
+    ordered = sorted(samples)
+
+    def percentile(p: float) -> float:
+        return ordered[min(int(p * len(ordered)), len(ordered) - 1)] if ordered else 0.0
+
+    return {"p50_seconds": percentile(0.5), "p95_seconds": percentile(0.95), "p99_seconds": percentile(0.99)}
+
+
+_lock = threading.Lock()
+_timings: Dict[str, Timing] = {}
+_counters: Dict[str, int] = {}
+
+
+def observe_seconds(name: str, seconds: float) -> None:
+    with _lock:
+        _timings.setdefault(name, Timing()).observe(seconds)
+
+
+def increment(name: str, amount: int = 1) -> None:
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    """Record how long the body of the with block takes, whether or not it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_seconds(name, time.perf_counter() - start)
+
+
+def snapshot() -> dict:
+    with _lock:
+        return {
+            "timings": {name: t.to_dict() for name, t in _timings.items()},
+            "counters": dict(_counters)
+        }
+
+
+def reset() -> None:
+    with _lock:
+        _timings.clear()
+        _counters.clear()
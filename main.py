@@ -11,6 +11,18 @@ else:
 
 app = create_app()
 
+# Keep the import service SA's token fresh in the background, so requests never have to wait for a new one.
+from app.auth import service_auth
+service_auth.start_isvc_creds_refresher()
+
+# Publish the Pub/Sub messages that request handlers leave in the outbox.
+from app import outbox
+outbox.start_relay()
+
+# Requeue translations that died (or whose instance did) without waiting for the cleanup cron.
+from app import cleanup
+cleanup.start_translation_recovery()
+
 # FiaB instances of this service live inside the Broad network and thus PubSub can't push notifications to the REST
 # handler. Setting PULL_PUBSUB will spin up a thread that pulls messages from PubSub instead.
 pull_pubsub = os.environ.get("PULL_PUBSUB", "False")
@@ -20,3 +32,4 @@ if pull_pubsub.lower() == "true":
     pubsub.create_topic_and_sub()
     pubsub_pull_thread = threading.Thread(target=pubsub_pull.loop, args=(app,))
     pubsub_pull_thread.start()
+    pubsub_pull.stop_on_sigterm()